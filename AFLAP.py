@@ -1,29 +1,146 @@
 import argparse
 import os
+import pandas as pd
 import subprocess
 
+from bin.genotype_store import configure_chunk_mem
+from bin.get_LA_info import get_LA_info
 from bin.ped_analysis import pedigree_analysis
 from bin.marker_reduction import marker_reduction
+from bin.task_graph import Task, parse_mem, physical_mem, run_task_graph
 from bin.update_individual import update_individual
 
+def build_tasks(args, DIR:str, max_mem:int, opts:dict)->list:
+    # count(ind) -> dump(parent) -> presence -> markers(parent) -> query(progeny) -> table(parent) -> stats -> export -> LepMap3
+    tasks = list()
+    bin_dir = f"{DIR}/bin"
+    list_of_Gs = get_LA_info()
+    parents = pd.read_csv("AFLAP_tmp/Pedigree_F0.txt", sep='\t')["Individual"].astype(str).unique().tolist()
+    progeny = {f_type: pd.read_csv(f"AFLAP_tmp/Pedigree_{f_type}.txt", sep='\t') for f_type in ["F1", "F2"]}
+    reads = dict()
+    for f_type in ["F0", "F1", "F2"]:
+        for ind, path in pd.read_csv(f"AFLAP_tmp/Pedigree_{f_type}.txt", sep='\t', usecols=["Individual", "Path"]).astype(str).values:
+            reads.setdefault(ind, list()).append(path)
+
+    # count jobs share the memory budget of the concurrent count slots
+    job_threads = max(1, args.threads // args.jobs) if args.jobs else max(1, min(args.job_threads, args.threads))
+    count_mem = (parse_mem(args.mem_budget) if args.mem_budget else max_mem) // max(1, args.threads // job_threads)
+    count_opts = f" -t {job_threads} -j 1 --mem-budget {count_mem}" + (" --singleton-filter" if args.singleton_filter else '')
+    counted = parents + ([str(prog) for prog_df in progeny.values() for prog in prog_df["Individual"].unique()] if args.genotyper == "jellyfish" else [])
+    for ind in counted:
+        tasks.append(Task(f"count:{ind}", f"python3 {bin_dir}/01_JELLYFISH.py -m {args.kmer} -i {ind}{count_opts}{opts['cache']}",
+                          threads=job_threads, mem=count_mem, inputs=reads[ind], params={"reads": reads[ind]}))
+
+    # parental k-mers and markers
+    for G, LO, UP, _, _ in list_of_Gs:
+        tasks.append(Task(f"dump:{G}", f"python3 {bin_dir}/02_ExtractSingleCopyMers.py -m {args.kmer} -p {G}{opts['bounds']}{opts['cache']}{opts['plot']}",
+                          deps=[f"count:{G}"], inputs=[f"AFLAP_tmp/01/F0Count/{G}.jf{args.kmer}"], params={"LO": LO, "UP": UP}))
+    partners = list(dict.fromkeys(op for G_info in list_of_Gs for op in G_info[3].split('_') if op))
+    tasks.append(Task("presence", f"python3 {bin_dir}/03_ObtainMarkers.py -m {args.kmer} -s presence{opts['cache']}",
+                      deps=[f"dump:{G_info[0]}" for G_info in list_of_Gs] + [f"count:{op}" for op in partners], threads=len(partners),
+                      inputs=[f"AFLAP_tmp/02/{G}_m{args.kmer}_L{LO}_U{UP}.kset" for G, LO, UP, _, _ in list_of_Gs] + [f"AFLAP_tmp/01/F0Count/{op}.jf{args.kmer}" for op in partners]))
+    marker_threads = max(1, args.threads // len(list_of_Gs)) if args.assembler == "unitig" else 1
+    for G, LO, UP, P0, _ in list_of_Gs:
+        tasks.append(Task(f"markers:{G}", f"python3 {bin_dir}/03_ObtainMarkers.py -m {args.kmer} -s markers -p {G} -t {marker_threads} -a {args.assembler}{opts['cache']}",
+                          deps=["presence"], threads=marker_threads, inputs=[f"AFLAP_tmp/02/{G}_m{args.kmer}_L{LO}_U{UP}.kset", f"AFLAP_tmp/03/Presence/*_m{args.kmer}.kset"],
+                          params={"P0": P0}))
+    marker_files = [f"AFLAP_tmp/03/F0Markers/{G}_m{args.kmer}_MARKERS_L{LO}_U{UP}_{P0}.fa" for G, LO, UP, P0, _ in list_of_Gs]
+    tasks.append(Task("loci", f"python3 {bin_dir}/03_ObtainMarkers.py -m {args.kmer} -s loci{opts['cache']}",
+                      deps=[f"markers:{G_info[0]}" for G_info in list_of_Gs], inputs=marker_files))
+
+    # progeny genotypes per parent and genotype tables
+    geno_opts = f" -m {args.kmer} -x {args.LowCov} -e {args.genotyper}{opts['cache']}"
+    tables = list()
+    names = {task.name for task in tasks}
+    for f_type, prog_df in progeny.items():
+        for G, _, _, _, _ in list_of_Gs:
+            progs = prog_df[(prog_df["MP"].astype(str) == G) | (prog_df["FP"].astype(str) == G)]["Individual"].astype(str).unique().tolist()
+            if not progs: continue
+            queries = list()
+            for prog in progs:
+                # one query counts the markers of every parent of the progeny at once
+                name = f"query:{f_type}:{prog}"
+                queries.append(name)
+                if name in names: continue
+                prog_Gs = set(prog_df[prog_df["Individual"].astype(str) == prog][["MP", "FP"]].astype(str).values.ravel())
+                deps = [f"markers:{G_info[0]}" for G_info in list_of_Gs if G_info[0] in prog_Gs]
+                prog_markers = [marker_file for G_info, marker_file in zip(list_of_Gs, marker_files) if G_info[0] in prog_Gs]
+                if args.genotyper == "scan":
+                    tasks.append(Task(name, f"python3 {bin_dir}/04_Genotyping.py -s count -f {f_type} --progeny {prog} -t 1{geno_opts}", deps=deps,
+                                      inputs=prog_markers + reads[prog], params={"reads": reads[prog]}))
+                else:
+                    jf_file = f"AFLAP_tmp/01/{f_type}Count/{prog}.jf{args.kmer}"
+                    tasks.append(Task(name, f"python3 {bin_dir}/04_Genotyping.py -s count -f {f_type} --progeny {prog}{geno_opts}",
+                                      deps=deps + [f"count:{prog}"], mem=lambda jf_file=jf_file: os.path.getsize(jf_file), io=1, inputs=prog_markers + [jf_file]))
+                names.add(name)
+            tables.append(f"table:{f_type}:{G}")
+            tasks.append(Task(tables[-1], f"python3 {bin_dir}/04_Genotyping.py -s table -f {f_type} -p {G}{geno_opts}{opts['export']}",
+                              deps=queries + (["loci"] if f_type == "F2" else []),
+                              inputs=[f"AFLAP_tmp/04/{f_type}/Count/*_{G}_m{args.kmer}_*"] + (["AFLAP_tmp/03/SimGroups/*"] if f_type == "F2" else [])))
+
+    # a sweep of filter settings ends the graph after the genotype stores
+    # tables are filtered and exported in chunks of marker rows, so those tasks need about the chunk memory
+    stats_opts = f" -m {args.kmer} -L {args.LOD} -d {args.SDL} -D {args.SDU}{opts['fxx']} --chunk-mem {args.chunk_mem}"
+    chunk_mem = parse_mem(args.chunk_mem)
+    stores = ["AFLAP_tmp/04/F1/*.store/*", "AFLAP_tmp/04/F2/*.store/*", "AFLAP_Results/IdenticalLoci.txt"]
+    if opts['sweep']:
+        tasks.append(Task("sweep", f"python3 {bin_dir}/05_ObtainSegStats.py{stats_opts} -x {args.LowCov}{opts['sweep']}", deps=tables, mem=chunk_mem, inputs=stores))
+        return tasks
+
+    # statistics, export and linkage mapping over all parents
+    tasks.append(Task("stats", f"python3 {bin_dir}/05_ObtainSegStats.py{stats_opts}{opts['plot']}", deps=tables, mem=chunk_mem, inputs=stores))
+    export_deps = ["stats"]
+    tables = [f"AFLAP_tmp/05/*_m{args.kmer}*.Genotypes.MarkerID.Filtered.tsv"]
+    if args.Max is not None:
+        tasks.append(Task("reduce", func=marker_reduction, args=(args.kmer, args.Max, args.bin_distance), deps=["stats"], mem=chunk_mem, inputs=tables))
+        export_deps = ["reduce"]
+        tables = [f"AFLAP_tmp/05/*_m{args.kmer}*.Genotypes.MarkerID.Reduced.tsv"]
+    lepmap_opts = f" --lepmap-data {args.lepmap_data} --chunk-mem {args.chunk_mem}" + (" --reduced" if args.Max is not None else '')
+    tasks.append(Task("export", f"python3 {bin_dir}/06_ExportToLepMap3.py -m {args.kmer}{lepmap_opts}", deps=export_deps, mem=chunk_mem, inputs=tables))
+    tasks.append(Task("lepmap3", f"python3 {bin_dir}/07_LepMap3.py -m {args.kmer} -t {args.threads} -L {args.LOD} -n {args.nLG}{lepmap_opts}",
+                      deps=["export"], threads=args.threads, inputs=tables if args.lepmap_data == "pipe" else [f"AFLAP_Results/*_m{args.kmer}*.ForLepMap3.tsv*"]))
+    return tasks
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='AFLAP', description="A script to run all stages of AFLAP.")
     parser.add_argument('-P', '--Pedigree', type=str, required=True, help="Pedigree file (required). See AFLAP README for more information.")
     parser.add_argument('-m', '--kmer', type=int, default=31, help='K-mer size. Default [31].')
     parser.add_argument('-t', '--threads', type=int, default=4, help='Threads for JELLYFISH counting. Default [4].')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='Number of individuals counted concurrently by JELLYFISH. Overrides --job-threads when set. Default [threads / job threads].')
+    parser.add_argument('--job-threads', type=int, default=4, help='Threads given to each concurrent JELLYFISH count job. Default [4].')
+    parser.add_argument('--mem-budget', type=str, default=None, help='Memory shared by all concurrent JELLYFISH jobs (e.g. 64G). Default [90%% of physical memory].')
+    parser.add_argument('--singleton-filter', action='store_true', help='Drop singleton k-mers with a JELLYFISH bloom counter pass before counting.')
+    parser.add_argument('-g', '--genotyper', choices=["jellyfish", "scan"], default="jellyfish", help='Genotype progeny by querying their JELLYFISH hashes or by scanning their reads for marker k-mers, which skips progeny hashes. Default [jellyfish].')
+    parser.add_argument('-a', '--assembler', choices=["abyss", "unitig"], default="abyss", help='Assemble parent specific k-mers with ABySS or compact them into unitigs within AFLAP, which does not need ABySS. Default [abyss].')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Shared directory in which intermediate files are stored by input digest and linked into AFLAP_tmp, so they can be reused across projects. Default [None].')
+    parser.add_argument('--checksum', action='store_true', help='Identify input files by a full checksum instead of their size and modification time.')
     parser.add_argument('-r', '--remove', type=str, help='Individual to remove. All other options will be ignored.')
+    parser.add_argument('-b', '--bounds', nargs='+', default=[], help='Additional LO:UP k-mer bounds to extract for every parent in the same pass over its hash, so they can be tried later without rescanning (e.g. 20:90 30:120).')
     parser.add_argument('-L', '--LOD', type=int, default=2, help='LOD score - Will run LepMap3 with minimum LOD. Default [2].')
     parser.add_argument('-d', '--SDL', type=float, default=0.2, help='Lower boundary for marker cut off. Can be used to filter for segregation distortion. Default [0.2].')
     parser.add_argument('-D', '--SDU', type=float, default=0.8, help='Upper boundary for marker cut off. Can be used to filter for segregation distortion. Default [0.8].')
     parser.add_argument('-f', '--fXX', type=float, default=None, help='Limit for how many XX can exist in a row. If surpassed then sequence is not considered for analysis. Default [None].')
     parser.add_argument('-x', '--LowCov', type=int, default=2, help='Run with low coverage parameters.')
     parser.add_argument('-n', '--nLG', type=int, default=10, help='Minimum number of linkage groups needed to continue F2 LepMap3 analysis. Default [10].')
+    parser.add_argument('--export-tsv', action='store_true', help='Also export the genotype store of every parent as a Genotypes.MarkerID.tsv table.')
+    parser.add_argument('--no-plots', action='store_true', help='Do not render histogram, coverage and segregation plots.')
+    parser.add_argument('--executor', choices=["graph", "sequential"], default="graph", help='Run AFLAP as a graph of per-individual tasks that start as soon as their inputs exist, or stage by stage. Default [graph].')
+    parser.add_argument('--io-jobs', type=int, default=2, help='Progeny JELLYFISH hashes loaded from disk at once when genotyping. Default [2].')
+    parser.add_argument('--max-mem', type=str, default=None, help='Memory shared by concurrent tasks of the graph executor (e.g. 256G). Default [90%% of physical memory].')
+    parser.add_argument('--chunk-mem', type=str, default="1G", help='Memory used to hold a chunk of marker rows while genotype tables are filtered and exported (e.g. 512M). Default [1G].')
+    parser.add_argument('--lepmap-data', choices=["tsv", "gzip", "pipe"], default="tsv", help='Export LepMap3 data as a tsv file, a gzip-compressed tsv file, or stream it from the filtered genotype tables into LepMap3 without writing it (pipe). Default [tsv].')
     parser.add_argument('-U', '--Max', type=int, help='Maximum number of markers to output in the genotype tables output under ./AFLAP_Results/')
+    parser.add_argument('--bin-distance', type=int, default=0, help='With -U, also bin markers whose genotypes differ in at most this many progeny. Default [0].')
+    parser.add_argument('--sweep-SDL', type=float, nargs='+', default=None, help='Lower boundaries to sweep. Sweeping stops AFLAP after summarizing every combination of filter settings. Default [SDL].')
+    parser.add_argument('--sweep-SDU', type=float, nargs='+', default=None, help='Upper boundaries to sweep. Default [SDU].')
+    parser.add_argument('--sweep-fXX', type=float, nargs='+', default=None, help='XX limits to sweep. Default [fXX].')
+    parser.add_argument('--sweep-LowCov', type=int, nargs='+', default=None, help='Minimum marker counts of a call to sweep. Default [LowCov].')
+    parser.add_argument('--sweep-export', type=int, nargs='+', default=[], help='Sweep points whose filtered tables are written to AFLAP_tmp/05/Sweep/Point<n>. Default [None].')
     args = parser.parse_args()
 
     # check for dependencies
     print("Checking for dependencies used in AFLAP...")
-    for module in ["jellyfish", "ABYSS", "lepmap3"]:
+    for module in ["jellyfish", "lepmap3"] + (["ABYSS"] if args.assembler == "abyss" else []):
         try:
             subprocess.check_output(args=f"ls $CONDA_PREFIX/bin | grep {module}", shell=True)
         except:
@@ -52,40 +169,71 @@ if __name__ == "__main__":
     print("Information from pedigree file extracted.")
 
     DIR = os.path.dirname(os.path.abspath(__file__))
+    bounds_opts = f" -b {' '.join(args.bounds)}" if args.bounds else ''
+    plot_opts = " --no-plots" if args.no_plots else ''
+    fxx_opts = f" -f {args.fXX}" if args.fXX is not None else ''
+    export_opts = " --export-tsv" if args.export_tsv else ''
+    sweep_grids = {"SDL": args.sweep_SDL, "SDU": args.sweep_SDU, "fXX": args.sweep_fXX, "LowCov": args.sweep_LowCov}
+    sweep_opts = ''.join(f" --sweep-{name} {' '.join(str(val) for val in grid)}" for name, grid in sweep_grids.items() if grid is not None)
+    if sweep_opts and args.sweep_export: sweep_opts += f" --sweep-export {' '.join(str(point) for point in args.sweep_export)}"
+    cache_opts = (f" --cache-dir {args.cache_dir}" if args.cache_dir else '') + (" --checksum" if args.checksum else '')
+    jf_opts = (f" --mem-budget {args.mem_budget}" if args.mem_budget else '') + (" --singleton-filter" if args.singleton_filter else '') + \
+              (" --parents-only" if args.genotyper == "scan" else '')
+
+    # marker reduction runs within AFLAP in both executors, so it reads its tables in chunks of --chunk-mem here
+    configure_chunk_mem(parse_mem(args.chunk_mem))
+
+    # run ready tasks concurrently, resuming from the tasks finished in a previous run
+    if args.executor == "graph":
+        max_mem = parse_mem(args.max_mem) if args.max_mem else int(physical_mem() * 0.9)
+        tasks = build_tasks(args, DIR, max_mem, {"bounds": bounds_opts, "plot": plot_opts, "cache": cache_opts, "fxx": fxx_opts, "export": export_opts, "sweep": sweep_opts})
+        print(f"\nRunning {len(tasks)} tasks with up to {args.threads} threads and {max_mem} bytes of memory...\n")
+        # sweeps keep their own task state, so they do not forget the finished tasks of the full pipeline
+        state_file = "AFLAP_tmp/TaskState.sweep.json" if sweep_opts else "AFLAP_tmp/TaskState.json"
+        run_task_graph(tasks, args.threads, max_mem, state_file, "AFLAP_tmp/TaskLogs", args.io_jobs)
+        print("AFLAP sweep complete! See AFLAP_Results/*.SegStatsSweep.tsv." if sweep_opts else "AFLAP complete!")
+        exit(0)
 
     try:
         # 01_JELLYFISH.py
         print("\nStep 1/6: Jellyfish Counting\n")
-        subprocess.run(f"python3 {DIR}/bin/01_JELLYFISH.py -t {args.threads} -m {args.kmer}",
+        subprocess.run(f"python3 {DIR}/bin/01_JELLYFISH.py -t {args.threads} -j {args.jobs} --job-threads {args.job_threads} -m {args.kmer}{jf_opts}{cache_opts}",
                        check=True, shell=True)
         # 02_ExtractSingleCopyMers.py
         print("\nStep 2/6: Extracting Single-Copy K-Mers\n")
-        subprocess.run(f"python3 {DIR}/bin/02_ExtractSingleCopyMers.py -m {args.kmer}",
+        subprocess.run(f"python3 {DIR}/bin/02_ExtractSingleCopyMers.py -m {args.kmer}{bounds_opts}{cache_opts}{plot_opts}",
                        check=True, shell=True)
         # 03_ObtainMarkers.py
         print("\nStep 3/6: Obtaining Markers\n")
-        subprocess.run(f"python3 {DIR}/bin/03_ObtainMarkers.py -m {args.kmer}",
+        subprocess.run(f"python3 {DIR}/bin/03_ObtainMarkers.py -m {args.kmer} -t {args.threads} -a {args.assembler}{cache_opts}",
                        check=True, shell=True)
         # 04_Genotyping.py
         print("\nStep 4/6: Creating Genotype Table\n")
-        subprocess.run(f"python3 {DIR}/bin/04_Genotyping.py -m {args.kmer} -x {args.LowCov}",
+        subprocess.run(f"python3 {DIR}/bin/04_Genotyping.py -m {args.kmer} -x {args.LowCov} -t {args.threads} --io-jobs {args.io_jobs} -e {args.genotyper}{cache_opts}{export_opts}",
                        check=True, shell=True)
         # 05_ObtainSegStats.py
+        stats_opts = f" -m {args.kmer} -L {args.LOD} -d {args.SDL} -D {args.SDU}{fxx_opts} --chunk-mem {args.chunk_mem}"
+        if sweep_opts:
+            print("\nStep 5/6: Sweeping Segment Statistics Filters\n")
+            subprocess.run(f"python3 {DIR}/bin/05_ObtainSegStats.py{stats_opts} -x {args.LowCov}{sweep_opts}", check=True, shell=True)
+            print("AFLAP sweep complete! See AFLAP_Results/*.SegStatsSweep.tsv.")
+            exit(0)
         print("\nStep 5/6: Obtaining Segment Statistics\n")
-        subprocess.run(f"python3 {DIR}/bin/05_ObtainSegStats.py -m {args.kmer} -L {args.LOD} -f {args.fXX}",
+        subprocess.run(f"python3 {DIR}/bin/05_ObtainSegStats.py{stats_opts}{plot_opts}",
                        check=True, shell=True)
 
         if (args.Max is not None):
             print("\nExtra Step 5/6: Reducing Number of Markers\n")
-            marker_reduction(args.kmer, args.Max)
+            marker_reduction(args.kmer, args.Max, args.bin_distance)
 
         # 06_ExportToLepMap3.py
         print("\nStep 6/6: Making Information Usable for LepMap3\n")
-        subprocess.run(f"python3 {DIR}/bin/06_ExportToLepMap3.py -m {args.kmer}",
+        lepmap_opts = f" --lepmap-data {args.lepmap_data} --chunk-mem {args.chunk_mem}" + (" --reduced" if args.Max is not None else '')
+        subprocess.run(f"python3 {DIR}/bin/06_ExportToLepMap3.py -m {args.kmer}{lepmap_opts}",
                        check=True, shell=True)
         # 07_LepMap3.py
         print("\nRunning LepMap3\n")
-        subprocess.run(f"python3 {DIR}/bin/07_LepMap3.py -m {args.kmer} -t {args.threads} -L {args.LOD} -n {args.nLG}",
+        subprocess.run(f"python3 {DIR}/bin/07_LepMap3.py -m {args.kmer} -t {args.threads} -L {args.LOD} -n {args.nLG}{lepmap_opts}",
                        check=True, shell=True)
 
         print("AFLAP complete!")
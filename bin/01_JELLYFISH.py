@@ -1,29 +1,48 @@
 import argparse
+import multiprocessing as mp
 import os
 import pandas as pd
+import statistics
 import subprocess
+import time
+
+from artifact_cache import configure_cache, tool_version, artifact_key, fetch_artifact, store_artifact
+from read_streams import write_generators, report_throughput
+from task_graph import parse_mem, physical_mem
+from hash_size import estimate_bases, estimate_genome_size, estimate_distinct_kmers, \
+                      fit_hash_size, fit_bloom_size
 
 ###########################################################
 #	A Python script to be ran as part of the AFLAP pipeline.
 #	This script will sanity check the pedigree file then run JELLYFISH on parents and progeny specified in the pedigree file.
+#	Several individuals are counted at once, splitting the thread and memory budgets between concurrent jobs.
+#	Hash sizes are estimated per individual from its read files so no job outgrows its share of memory.
+#	Each read file is decompressed by its own process and passed to JELLYFISH as a separate generator stream.
 #	The output will be stored in AFLAP_tmp.
-#	The script will detect previous results and used them when able.
+#	The script will detect previous results and used them when able, as long as their read files and parameters are unchanged.
 ###########################################################
 
-def jellyfish_count(kmer:str, threads:str, f_type:str, ped_df:pd.DataFrame)->None:
-    if not os.path.getsize(f"AFLAP_tmp/Pedigree_{f_type}.txt"):
+def split_threads(threads:int, jobs:int, job_threads:int)->tuple[int, int]:
+    threads = max(1, threads)
+    # an explicit number of jobs takes precedence over the threads per job
+    if jobs:
+        jobs = min(jobs, threads)
+        job_threads = threads // jobs
+    else:
+        job_threads = max(1, min(job_threads, threads))
+        jobs = threads // job_threads
+
+    return jobs, job_threads
+
+def get_count_jobs(kmer:int, f_type:str, ped_df:pd.DataFrame, singleton_filter:bool)->list[tuple[str, str, list[str], str]]:
+    if ped_df.empty:
         print(f"No {f_type} individuals detected.")
-        return
-    print(f"Performing jellyfish {f_type} count:")
+        return list()
+    print(f"Checking {f_type} individuals for jellyfish count:")
 
-    # run jellyfish count on each individual
+    count_jobs = list()
     for ind in ped_df['Individual'].unique():
-        jc_file = f"AFLAP_tmp/01/{f_type}Count/{ind}.jf{kmer}"
-        if os.path.exists(jc_file) and os.path.getsize(jc_file):
-            print(f"\tHash detected for {ind}. Skipping.")
-            continue
-        print(f"\tRunning jellyfish count for {ind}...")
-        ind_df = ped_df[ped_df["Individual"] == ind].dropna()
+        ind_df = ped_df[ped_df["Individual"] == ind].dropna(subset=["Path"])
 
         # get files to pass into jellyfish count
         jfin = list()
@@ -31,21 +50,89 @@ def jellyfish_count(kmer:str, threads:str, f_type:str, ped_df:pd.DataFrame)->Non
             if not os.path.exists(path):
                 exit(f"An error occurred: {path} for {ind} not found. Make sure that your files' root path is in your current directory.")
             jfin.append(path)
-        jfin = ' '.join(jfin)
 
-        subprocess.run(args=f"jellyfish count -m {kmer} -C -s 1G -t {threads} -o AFLAP_tmp/01/{f_type}Count/{ind}.jf{kmer} <(zcat {jfin})",
+        jc_file = f"AFLAP_tmp/01/{f_type}Count/{ind}.jf{kmer}"
+        key = artifact_key("jellyfish_count", jfin, {"kmer": kmer, "singleton_filter": singleton_filter, "jellyfish": tool_version("jellyfish")})
+        if fetch_artifact(jc_file, key):
+            print(f"\tHash detected for {ind}. Skipping.")
+            continue
+        count_jobs.append((f_type, str(ind), jfin, key))
+
+    return count_jobs
+
+def size_count_jobs(count_jobs:list, f0_df:pd.DataFrame, kmer:int, mem_budget:int, sample:bool, singleton_filter:bool)->list[tuple]:
+    # estimate the genome size from parents with known coverage bounds
+    genome_sizes = list()
+    for parent in f0_df["Individual"].unique():
+        parent_df = f0_df[f0_df["Individual"] == parent]
+        lo, up = parent_df["LB"].iloc[0], parent_df["UB"].iloc[0]
+        if pd.isna(lo) or pd.isna(up): continue
+        bases = sum(estimate_bases(path, sample) for path in parent_df["Path"].dropna().unique() if os.path.exists(path))
+        genome_sizes.append(estimate_genome_size(bases, float(lo), float(up)))
+
+    sized_jobs = list()
+    for f_type, ind, jfin, key in count_jobs:
+        bases = sum(estimate_bases(path, sample) for path in jfin)
+        genome_size = statistics.median(genome_sizes) if genome_sizes else estimate_genome_size(bases)
+        distinct = estimate_distinct_kmers(bases, genome_size, kmer, singleton_filter)
+        size = fit_hash_size(distinct, kmer, mem_budget)
+        bc_size = fit_bloom_size(estimate_distinct_kmers(bases, genome_size, kmer), mem_budget) if singleton_filter else 0
+        print(f"\t{ind}: ~{bases} bases, ~{distinct} distinct {kmer}-mers. Hash size set to {size}" +
+              (f" with a bloom counter of size {bc_size}." if bc_size else '.'))
+        sized_jobs.append((f_type, ind, jfin, key, size, bc_size))
+
+    return sized_jobs
+
+def jellyfish_count(count_job:tuple, kmer:int, threads:int)->tuple[str, str, float, bool]:
+    f_type, ind, jfin, _, size, bc_size = count_job
+    jc_file = f"AFLAP_tmp/01/{f_type}Count/{ind}.jf{kmer}"
+    print(f"\tRunning jellyfish count for {ind} with {threads} threads...", flush=True)
+
+    # one decompressor per read file, all run concurrently by jellyfish
+    gen_file = f"AFLAP_tmp/01/{f_type}Count/{ind}.generators"
+    log_file = f"AFLAP_tmp/01/{f_type}Count/{ind}.decompress.log"
+    write_generators(jfin, gen_file, log_file, threads)
+    jf_input = f"-g {gen_file} -G {len(jfin)} -S /bin/sh"
+
+    start = time.time()
+    # drop singleton k-mers with a bloom counter pass before they enter the hash
+    bc_opt = ''
+    if bc_size:
+        bc_file = f"AFLAP_tmp/01/{f_type}Count/{ind}.bc{kmer}"
+        subprocess.run(args=f"jellyfish bc -m {kmer} -C -s {bc_size} -t {threads} -o {bc_file} {jf_input}",
                        shell=True, executable="/bin/bash")
-        # check if jellyfish worked
-        if not os.path.exists(jc_file) or not os.path.getsize(jc_file):
-            exit(f"An error occurred: Jellyfish for {ind} did not complete.")
-        print(f"\tHash for {ind} performed.")
+        bc_opt = f"--bc {bc_file} "
+        report_throughput(log_file, jfin, ind)
+        if os.path.exists(log_file): os.remove(log_file)
+    # --disk stops the hash from doubling past its memory share, spilling to disk instead
+    subprocess.run(args=f"jellyfish count -m {kmer} -C -s {size} -t {threads} --disk {bc_opt}-o {jc_file} {jf_input}",
+                   shell=True, executable="/bin/bash")
+    if bc_size and os.path.exists(bc_file): os.remove(bc_file)
+    wall_time = time.time() - start
+
+    report_throughput(log_file, jfin, ind)
+    for tmp_file in (gen_file, log_file):
+        if os.path.exists(tmp_file): os.remove(tmp_file)
 
-    print(f"Jellyfish {f_type} count complete.")
+    # check if jellyfish worked
+    return (f_type, ind, wall_time, os.path.exists(jc_file) and bool(os.path.getsize(jc_file)))
+
+def run_count_job(count_args:tuple)->tuple[str, str, float, bool]:
+    return jellyfish_count(*count_args)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='JELLYFISH', description="A script to obtain JELLYFISH hashes to be used when running AFLAP.")
-    parser.add_argument('-m', '--kmer', default=31, help="K-mer size. Default [31].")
-    parser.add_argument('-t', '--threads', default=4, help="Threads for JELLYFISH counting. Default [4].")
+    parser.add_argument('-m', '--kmer', type=int, default=31, help="K-mer size. Default [31].")
+    parser.add_argument('-t', '--threads', type=int, default=4, help="Total threads for JELLYFISH counting shared by all concurrent jobs. Default [4].")
+    parser.add_argument('-j', '--jobs', type=int, default=0, help="Number of individuals counted concurrently. Overrides --job-threads when set. Default [threads / job threads].")
+    parser.add_argument('--job-threads', type=int, default=4, help="Threads given to each JELLYFISH count job. Default [4].")
+    parser.add_argument('--mem-budget', type=str, default=None, help="Memory shared by all concurrent JELLYFISH jobs (e.g. 64G). Default [90%% of physical memory].")
+    parser.add_argument('--size-estimate', choices=["sample", "filesize"], default="sample", help="Estimate read bases from a sampled decompression pass or from file sizes only. Default [sample].")
+    parser.add_argument('--cache-dir', type=str, default=None, help="Shared directory in which hashes are stored by input digest and linked from, so unchanged individuals are never recounted. Default [None].")
+    parser.add_argument('--checksum', action='store_true', help="Identify read files by a full checksum instead of their size and modification time.")
+    parser.add_argument('--parents-only', action='store_true', help="Only count parents, e.g. when progeny are genotyped by scanning their reads in 04_Genotyping.py.")
+    parser.add_argument('-i', '--individuals', nargs='+', default=None, help="Only count these individuals. Default [all].")
+    parser.add_argument('--singleton-filter', action='store_true', help="Run a JELLYFISH bloom counter pass first so singleton k-mers never enter the hash. K-mers seen once will be reported as absent.")
     args = parser.parse_args()
 
     # make directories
@@ -53,13 +140,42 @@ if __name__ == "__main__":
     os.makedirs("AFLAP_tmp/01/F1Count", exist_ok=True)
     os.makedirs("AFLAP_tmp/01/F2Count", exist_ok=True)
 
+    # collect individuals without a hash (parents are queued first)
+    configure_cache(args.cache_dir, args.checksum)
+    count_jobs = list()
+    for f_type in (["F0"] if args.parents_only else ["F0", "F1", "F2"]):
+        ped_df = pd.read_csv(f"AFLAP_tmp/Pedigree_{f_type}.txt", sep='\t')
+        if f_type == "F0": f0_df = ped_df
+        if args.individuals is not None: ped_df = ped_df[ped_df["Individual"].astype(str).isin(args.individuals)]
+        count_jobs += get_count_jobs(args.kmer, f_type, ped_df, args.singleton_filter)
+    if not count_jobs:
+        print("All jellyfish hashes detected.")
+        exit(0)
+
+    jobs, job_threads = split_threads(args.threads, args.jobs, args.job_threads)
+    # hand spare threads to the remaining jobs when there are fewer individuals than job slots
+    jobs = min(jobs, len(count_jobs))
+    job_threads = max(job_threads, max(1, args.threads) // jobs)
+
+    # size each hash so that all concurrent jobs fit in the memory budget
+    mem_budget = parse_mem(args.mem_budget) if args.mem_budget else int(physical_mem() * 0.9)
+    print(f"Sizing jellyfish hashes with {mem_budget // jobs} bytes of memory per job:")
+    count_jobs = size_count_jobs(count_jobs, f0_df, args.kmer, mem_budget // jobs, args.size_estimate == "sample", args.singleton_filter)
+
     # perform jellyfish counting
-    ## parents
-    ped_df = pd.read_csv(f"AFLAP_tmp/Pedigree_F0.txt", sep='\t')
-    jellyfish_count(args.kmer, args.threads, "F0", ped_df)
-    ## F1 progeny
-    ped_df = pd.read_csv(f"AFLAP_tmp/Pedigree_F1.txt", sep='\t')
-    jellyfish_count(args.kmer, args.threads, "F1", ped_df)
-    ## F2 progeny
-    ped_df = pd.read_csv(f"AFLAP_tmp/Pedigree_F2.txt", sep='\t')
-    jellyfish_count(args.kmer, args.threads, "F2", ped_df)
+    print(f"Performing jellyfish count on {len(count_jobs)} individuals with {jobs} concurrent job(s) of {job_threads} thread(s)...")
+    failed = list()
+    keys = {(count_job[0], count_job[1]): count_job[3] for count_job in count_jobs}
+    with mp.Pool(processes=jobs) as pool:
+        count_args = [(count_job, args.kmer, job_threads) for count_job in count_jobs]
+        for f_type, ind, wall_time, completed in pool.imap_unordered(run_count_job, count_args):
+            if not completed:
+                print(f"\tJellyfish for {f_type} individual {ind} did not complete after {wall_time:.1f}s.")
+                failed.append(ind)
+                continue
+            store_artifact(f"AFLAP_tmp/01/{f_type}Count/{ind}.jf{args.kmer}", keys[(f_type, ind)])
+            print(f"\tHash for {f_type} individual {ind} performed in {wall_time:.1f}s.")
+
+    if failed:
+        exit(f"An error occurred: Jellyfish did not complete for {', '.join(failed)}.")
+    print("Jellyfish count complete.")
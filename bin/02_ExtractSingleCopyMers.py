@@ -1,35 +1,55 @@
 import argparse
+import numpy as np
 import os
-import subprocess
 
+from artifact_cache import configure_cache, tool_version, artifact_key, fetch_artifact, store_artifact
 from get_LA_info import get_LA_info
-from histoplot import histoplot
+from jf_stream import iter_jellyfish_kmers
+from kmer_set import check_packable, canonical_kmers, write_kmer_set, kmer_set_count
+from histoplot import read_histo, histoplot
+from plots import PlotQueue
 
 #################################################
 #	A Python script to generate and plot histograms of parental hashes.
 #	It will try to calculate peaks, if the user does not define them in the pedigree file, though this may be error prone.
-#	Finally, it extracts k-mers it estimates to be single copy.
+#	Finally, it extracts k-mers it estimates to be single copy into packed k-mer sets.
+#	The histogram and the k-mers within bounds are obtained from a single pass over each hash, optionally for several pairs of bounds.
+#	The dump is parsed in byte blocks with numpy, so every block adds to the histogram and the bounded sets without per-line work.
+#	Histogram plots are rendered in the background while the next hash is scanned.
 #################################################
 
-def create_histogram(G:int, kmer:int)->None:
-    histo_file = f"AFLAP_tmp/02/F0Histo/{G}.{kmer}.histo"
-    if os.path.exists(histo_file) and os.path.getsize(histo_file):
-        print(f"\tHistogram for {G} detected. Skipping.")
-        return
-    print(f"\tCreating histogram for {G}...")
-    subprocess.run(f"jellyfish histo AFLAP_tmp/01/F0Count/{G}.jf{kmer} > AFLAP_tmp/02/F0Histo/{G}.{kmer}.histo",
-                    shell=True, executable="/bin/bash")
+HISTO_HIGH = 10000  # jellyfish histo -h default
 
-    if not os.path.exists(histo_file) or not os.path.getsize(histo_file):
-        exit(f"An error occurred: Jellyfish did not create AFLAP_tmp/02/F0Histo/{G}.{kmer}.histo properly.")
-    print(f"\tHistogram for {G} generated. Bounds:" +
-          f"\t\tLower: {LO}\n" +
-          f"\t\tUpper: {UP}\n")
+def scan_hash(jf_file:str, kmer:int, histo_file:str, dumps:dict, keys:dict)->None:
+    # one pass over the hash builds the histogram and every requested bounded k-mer set
+    histo = np.zeros(HISTO_HIGH + 2, dtype=np.int64)
+    packed = {bounds: list() for bounds in dumps}
+    for kmers, counts in iter_jellyfish_kmers(f"jellyfish dump -c {jf_file}", kmer):
+        histo += np.bincount(np.minimum(counts, HISTO_HIGH + 1), minlength=HISTO_HIGH + 2)
+        for (lo, up) in dumps:
+            in_bounds = (counts >= lo) & (counts <= up)
+            if in_bounds.any(): packed[(lo, up)].append(canonical_kmers(kmers[in_bounds], kmer))
+    for (lo, up), kset_file in dumps.items():
+        kmers = np.concatenate(packed.pop((lo, up))) if packed[(lo, up)] else np.zeros(0, dtype=np.uint64)
+        write_kmer_set(kset_file, kmers, kmer, lo, up, keys[kset_file])
+
+    # write histogram in the jellyfish histo format (non-zero bins, counts above the high bin pooled)
+    if histo_file:
+        with open(histo_file, 'w') as fhisto:
+            for count in np.flatnonzero(histo[1:]) + 1:
+                fhisto.write(f"{count} {histo[count]}\n")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='ExtractingSingleCopyMers', description="A script to obtain single copy k-mers from parental JELLYFISH hashes.")
     parser.add_argument('-m', '--kmer', type=int, default=31, help='K-mer size. Default [31].')
+    parser.add_argument('-b', '--bounds', nargs='+', default=[], help='Additional LO:UP bounds to extract k-mers for in the same pass (e.g. 20:90 30:120).')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Shared directory in which artifacts are stored by input digest. Default [None].')
+    parser.add_argument('--checksum', action='store_true', help='Identify input files by a full checksum instead of their size and modification time.')
+    parser.add_argument('-p', '--parents', nargs='+', default=None, help='Only extract k-mers of these parents. Default [all].')
+    parser.add_argument('--no-plots', action='store_true', help='Do not render histogram plots.')
     args = parser.parse_args()
+    configure_cache(args.cache_dir, args.checksum)
+    check_packable(args.kmer)
 
     #  make directories
     os.makedirs("AFLAP_Results/Plots", exist_ok=True)
@@ -38,34 +58,62 @@ if __name__ == "__main__":
     print("Generating F0 histograms to undergo linkage analysis...")
     if not os.path.exists("AFLAP_tmp/LA.txt"):
         exit("An error occurred: AFLAP_tmp/LA.txt not found. Rerun 01_JELLYFISH.py.")
+    extra_bounds = list()
+    for bounds in args.bounds:
+        lo, up = bounds.split(':')
+        if int(lo) > int(up):
+            exit(f"An error occurred: Cannot have a lower bound higher than an upper bound ({bounds}).")
+        extra_bounds.append((int(lo), int(up)))
+
     list_of_Gs = get_LA_info()
+    plot_queue = PlotQueue(not args.no_plots)
     for G_info in list_of_Gs:
         G, LO, UP, P0, SEX = G_info
-        mer_count = 0
+        if args.parents is not None and G not in args.parents: continue
+        jf_file = f"AFLAP_tmp/01/F0Count/{G}.jf{args.kmer}"
+        if not os.path.exists(jf_file):
+            exit(f"An error occurred: {jf_file} not found. Rerun 01_JELLYFISH.py.")
 
-        create_histogram(G, args.kmer)
+        # find which of the histogram and bounded k-mer files need to be made
+        histo_file = f"AFLAP_tmp/02/F0Histo/{G}.{args.kmer}.histo"
+        histo_key = artifact_key("jellyfish_histo", [jf_file], {"high": HISTO_HIGH, "jellyfish": tool_version("jellyfish")})
+        histo_found = fetch_artifact(histo_file, histo_key)
+        if histo_found: print(f"\tHistogram for {G} detected. Skipping.")
+        dumps, dump_keys = dict(), dict()
+        for lo, up in [(LO, UP)] + extra_bounds:
+            kset_file = f"AFLAP_tmp/02/{G}_m{args.kmer}_L{lo}_U{up}.kset"
+            dump_keys[kset_file] = artifact_key("kmer_set", [jf_file], {"LO": lo, "UP": up, "jellyfish": tool_version("jellyfish")})
+            if fetch_artifact(kset_file, dump_keys[kset_file]):
+                print(f"\t{args.kmer}-mers for {G} within {lo}-{up} detected. Skipping.")
+            else:
+                dumps[(lo, up)] = kset_file
 
-        # extract k-mers
-        print(f"\tExtracting {args.kmer}-mers from {G}:")
-        fa_file = f"AFLAP_tmp/02/{G}_m{args.kmer}_L{LO}_U{UP}.fa"
-        if os.path.exists(fa_file):
-            print(f"\t\t{args.kmer}-mers for {G} detected. Skipping.")
-        else:
-            print(f"\t\tRunning jellyfish dump for {G}...")
-            subprocess.run(args=f"jellyfish dump -U {UP} -L {LO} -o {fa_file} AFLAP_tmp/01/F0Count/{G}.jf{args.kmer}",
-                           shell=True, executable="/bin/bash")
+        if dumps or not histo_found:
+            print(f"\tScanning hash of {G} for its histogram and {len(dumps)} set(s) of bounded {args.kmer}-mers...")
+            scan_hash(jf_file, args.kmer, None if histo_found else histo_file, dumps, dump_keys)
+            if not os.path.exists(histo_file) or not os.path.getsize(histo_file):
+                exit(f"An error occurred: Histogram {histo_file} was not created properly.")
+            if not histo_found: store_artifact(histo_file, histo_key)
+            for kset_file in dumps.values():
+                store_artifact(kset_file, dump_keys[kset_file])
+            print(f"\tHistogram for {G} generated. Bounds:\n" +
+                  f"\t\tLower: {LO}\n" +
+                  f"\t\tUpper: {UP}")
 
         # counting k-mers
-        print(f"\t{os.path.getsize(fa_file) // 2} {args.kmer}-mers counted for {G}.")
+        kset_file = f"AFLAP_tmp/02/{G}_m{args.kmer}_L{LO}_U{UP}.kset"
+        print(f"\t{kmer_set_count(kset_file)} {args.kmer}-mers counted for {G}.")
 
         # create histo.png
         png_file = f"AFLAP_Results/Plots/{G}_m{args.kmer}_L{LO}_U{UP}_histo.png"
+        if args.no_plots: continue
         if os.path.exists(png_file):
-            print(f"\tHistogram for {G} detected. Skipping.")
+            print(f"\tHistogram plot for {G} detected. Skipping.")
         else:
-            print(f"\tMaking histogram for {G}...")
-            histoplot(f"AFLAP_tmp/02/F0Histo/{G}.{args.kmer}.histo", LO, UP, png_file)
+            print(f"\tQueueing histogram plot for {G}...")
+            histo_x, histo_y = read_histo(histo_file)
+            plot_queue.submit(histoplot, png_file, histo_x, histo_y, LO, UP)
 
-            if not os.path.exists(png_file) or not os.path.getsize(png_file):
-                exit(f"An error occurred: {png_file} not found.")
-            print(f"\tHistogram for {G} constructed.")
+    # wait for plots to finish rendering
+    plot_queue.close()
+    if not args.no_plots: print("Histogram plots constructed.")
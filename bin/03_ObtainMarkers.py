@@ -1,23 +1,79 @@
 import argparse
-import glob
 import multiprocessing as mp
+import numpy as np
 import os
-import pandas as pd
-import shutil
 import subprocess
 
+from artifact_cache import configure_cache, tool_version, file_digest, artifact_key, fetch_artifact, store_artifact
+from find_identical_loci import LOCUS_COLUMNS, save_loci, update_locus_index, find_identical_loci
 from get_LA_info import get_LA_info
+from jf_stream import query_jellyfish
+from kmer_set import check_packable, pack_kmers, write_kmer_set, load_kmer_set, write_kmer_fasta, \
+                     kmer_set_isin, kmer_set_union, kmer_set_difference
+from unitigs import compact_unitigs
 
 #################################################
 #	A Python script to derive single copy k-mers that are unique to a parent. These are then used a markers.
-#	To reduce redundancy k-mers are assembled using ABySS.
+#	To reduce redundancy k-mers are assembled using ABySS, or compacted into unitigs by AFLAP itself.
 #	To enable the use of a consistent has size, the markers are reduced to a sequnce length equal to option m.
 #	This consistent marker length then only need to be surveyed against only one progeny hash.
+#	Each parental hash is queried once for the union of all parents' single copy k-mers; parent specificity is then found by sorted set operations.
 #################################################
 
-def abyss_assembly(k:int, G:str, LO:int, UP:int, kmer:int, abyss_file:str, fafile:str)->None:
+LOCUS_CHUNK = 2 ** 16
+
+def get_partners(P0:str)->list:
+    return list(dict.fromkeys(op for op in P0.split('_') if op))
+
+def kmer_presence(op:str, kmer:int, candidate_fa:str, candidates:np.ndarray, presence_file:str, key:str)->None:
+    # keep the candidate k-mers observed at least once in the hash of op (query output follows the candidate order)
+    present = list()
+    offset = 0
+    for _, counts in query_jellyfish(candidate_fa, f"AFLAP_tmp/01/F0Count/{op}.jf{kmer}"):
+        present.append(candidates[offset:(offset + len(counts))][counts > 0])
+        offset += len(counts)
+    if offset != len(candidates):
+        exit(f"An error occurred: Query of {op} returned {offset} of {len(candidates)} k-mers.")
+
+    num_present = write_kmer_set(presence_file, np.concatenate(present) if present else np.zeros(0, dtype=np.uint64), kmer, 1, 0, key)
+    store_artifact(presence_file, key)
+    print(f"\t{num_present} of {len(candidates)} candidate {kmer}-mers present in {op}.")
+
+def find_presence(list_of_Gs:list, kmer:int)->None:
+    # find which parents' single copy k-mers occur in each partner parent
+    kset_files = [f"AFLAP_tmp/02/{G}_m{kmer}_L{LO}_U{UP}.kset" for G, LO, UP, _, _ in list_of_Gs]
+    for path in kset_files:
+        if not os.path.exists(path): exit(f"An error occurred: {path} not found. Rerun 02_ExtractSingleCopyMers.py.")
+
+    missing = dict()
+    for op in dict.fromkeys(op for G_info in list_of_Gs for op in get_partners(G_info[3])):
+        jf_file = f"AFLAP_tmp/01/F0Count/{op}.jf{kmer}"
+        if not os.path.exists(jf_file): exit(f"An error occurred: {jf_file} not found. Rerun 01_JELLYFISH.py.")
+        presence_file = f"AFLAP_tmp/03/Presence/{op}_m{kmer}.kset"
+        key = artifact_key("kmer_presence", kset_files + [jf_file], {"kmer": kmer, "jellyfish": tool_version("jellyfish")})
+        if fetch_artifact(presence_file, key): print(f"\tPresence of candidate {kmer}-mers in {op} detected. Skipping.")
+        else: missing[op] = (presence_file, key)
+    if not missing: return
+
+    # query every partner hash once, concurrently, for the union of all single copy k-mers
+    candidates = kmer_set_union([load_kmer_set(path) for path in kset_files])
+    candidate_fa = f"AFLAP_tmp/03/Presence/candidates_m{kmer}.fa"
+    write_kmer_fasta(candidates, kmer, candidate_fa)
+    print(f"\tQuerying {len(missing)} parental hashes for {len(candidates)} candidate {kmer}-mers...")
+    processes = list()
+    for op, (presence_file, key) in missing.items():
+        p = mp.Process(target=kmer_presence, args=(op, kmer, candidate_fa, candidates, presence_file, key))
+        p.start()
+        processes.append(p)
+    for p in processes:
+        p.join()
+    os.remove(candidate_fa)
+    if any(p.exitcode for p in processes):
+        exit("An error occurred: Could not find the presence of candidate k-mers in every parent.")
+
+def abyss_assembly(k:int, G:str, LO:int, UP:int, kmer:int, abyss_file:str, fafile:str, key:str)->None:
     # check if abyss file for G already exists
-    if os.path.exists(abyss_file) and os.path.getsize(abyss_file):
+    if fetch_artifact(abyss_file, key):
         print(f"ABySS files for {G} detected. Skipping...")
     # run abyss otherwise
     else:
@@ -29,55 +85,76 @@ def abyss_assembly(k:int, G:str, LO:int, UP:int, kmer:int, abyss_file:str, fafil
         # check if abyss ran properly
         if not os.path.exists(abyss_file): exit(f"An error occurred: ABySS did not create {abyss_file}.")
         elif not os.path.getsize(abyss_file): exit(f"An error occurred: {abyss_file} is empty.")
+        store_artifact(abyss_file, key)
 
-def get_markers(G_info:tuple, kmer:int)->None:
+def unitig_assembly(k:int, G:str, kmer:int, unitig_file:str, kmers, key:str, threads:int)->None:
+    # check if unitig file for G already exists
+    if fetch_artifact(unitig_file, key):
+        print(f"Unitig files for {G} detected. Skipping...")
+    # compact k-mers otherwise
+    else:
+        with open(f"AFLAP_tmp/03/ReportLogs/{G}_unitig_report.txt", 'w') as frep:
+            frep.write(f"Compacting unitigs with k set to {k}...\n")
+            num_unitigs = compact_unitigs(kmers, int(kmer), k, unitig_file, threads)
+            frep.write(f"{num_unitigs} unitigs compacted from {len(kmers)} {kmer}-mers.\n")
+        if not os.path.getsize(unitig_file): exit(f"An error occurred: {unitig_file} is empty.")
+        store_artifact(unitig_file, key)
+
+def get_markers(G_info:tuple, kmer:int, assembler:str, threads:int)->None:
     G, LO, UP, P0, SEX = G_info
-    seq_groups = pd.DataFrame(columns=["Sequence", "Sequence ID", "Locus Sequence"])
     ak = 2 * int(kmer) - 1
 
+    # reuse markers whose k-mers, hashes and parameters are unchanged
+    marker_file = f"AFLAP_tmp/03/F0Markers/{G}_m{kmer}_MARKERS_L{LO}_U{UP}_{P0}.fa"
+    locus_file = f"AFLAP_tmp/03/SimGroups/{SEX}_{G}_loci.npz"
+    kset_02 = f"AFLAP_tmp/02/{G}_m{kmer}_L{LO}_U{UP}.kset"
+    presence_files = [f"AFLAP_tmp/03/Presence/{op}_m{kmer}.kset" for op in get_partners(P0)]
+    key_inputs = [kset_02] + presence_files
+    if not all(os.path.exists(path) for path in key_inputs):
+        exit(f"An error occurred: Inputs for {G} not found. Rerun 02_ExtractSingleCopyMers.py.")
+    assembler_version = tool_version("ABYSS") if assembler == "abyss" else assembler
+    params = {"kmer": kmer, "LO": LO, "UP": UP, "P0": P0, "assembler": assembler_version}
+    key, locus_key = artifact_key("markers", key_inputs, params), artifact_key("loci", key_inputs, params)
+    if all([fetch_artifact(marker_file, key), fetch_artifact(locus_file, locus_key)]):
+        print(f"Markers for {G} detected. Skipping.")
+        return
+
     print(f"Performing marker assembly on {G}...")
 
     # initialize stats report variables
     ml_count = fragment_count = fragments_eq_ak = fragments_over_ak \
         = marker_count = markers_eq_ak = markers_over_ak = 0
 
-    # copy .fa file
-    fafile_02 = f"AFLAP_tmp/02/{G}_m{kmer}_L{LO}_U{UP}.fa"
-    fafile_03 = f"AFLAP_tmp/03/{G}_m{kmer}_L{LO}_U{UP}.fa"
-    if not os.path.exists(fafile_02):
-        exit(f"An error occurred: {fafile_02} not found. Rerun 02_ExtractSingleCopyMers.py.")
-    shutil.copy(fafile_02, fafile_03)
-
-    # filter .fa file against other parents
-    for op in P0.split():
-        op = op.strip()
-
-        # check if .jf for other parent exists
-        opfile = f"AFLAP_tmp/01/F0Count/{op}.jf{kmer}"
-        if not os.path.exists(opfile):
-            exit(f"An error occurred: {opfile} not found. Rerun 01_JELLYFISH.py.")
-
-        # filter and overwrite .fa file
-        jf_out = subprocess.run(args=f"jellyfish query -s {fafile_03} {opfile}",
-                                shell=True, capture_output=True, text=True, executable="/bin/bash").stdout.split('\n')
-        with open(f"{fafile_03}", 'w') as ffa:
-            for line in jf_out:
-                line = line.strip().split()
-
-                # write unique sequences into .fa file
-                if len(line) and not int(line[1]):
-                    # update ml_count in stats
-                    ffa.write(f">{ml_count}\n{line[0]}\n")
-                    ml_count += 1
-
-    # perform ABySS assembly
+    # remove k-mers present in other parents
+    specific = kmer_set_difference(load_kmer_set(kset_02), [load_kmer_set(path) for path in presence_files])
+    ml_count = len(specific)
+
+    # perform ABySS assembly or unitig compaction
     if   int(kmer) == 31: k = 25
     elif int(kmer) == 25: k = 19
     else: k = int(kmer) - 2
-    abyss_file = f"AFLAP_tmp/03/{G}_m{kmer}_L{LO}_U{UP}_abyss.fa"
-    abyss_assembly(k, G, LO, UP, kmer, abyss_file, fafile_03)
+    if assembler == "abyss":
+        fafile_03 = f"AFLAP_tmp/03/{G}_m{kmer}_L{LO}_U{UP}.fa"
+        write_kmer_fasta(specific, kmer, fafile_03)
+        abyss_file = f"AFLAP_tmp/03/{G}_m{kmer}_L{LO}_U{UP}_abyss.fa"
+        abyss_key = artifact_key("abyss", key_inputs, {"kmer": kmer, "k": k, "LO": LO, "UP": UP, "P0": P0, "abyss": tool_version("ABYSS")})
+        abyss_assembly(k, G, LO, UP, kmer, abyss_file, fafile_03, abyss_key)
+    else:
+        abyss_file = f"AFLAP_tmp/03/{G}_m{kmer}_L{LO}_U{UP}_unitigs.fa"
+        unitig_key = artifact_key("unitigs", key_inputs, {"kmer": kmer, "k": k, "LO": LO, "UP": UP, "P0": P0})
+        unitig_assembly(k, G, kmer, abyss_file, specific, unitig_key, threads)
+
+    # extract fragments/subsequences into locus columns, packing them every LOCUS_CHUNK fragments
+    loci = {col: list() for col in LOCUS_COLUMNS}
+    buffer = {col: list() for col in LOCUS_COLUMNS}
+    def flush_loci()->None:
+        loci["frag_id"].append(np.array(buffer["frag_id"], dtype=np.int64))
+        loci["frag_len"].append(np.array(buffer["frag_len"], dtype=np.int64))
+        loci["sequence"].append(pack_kmers(buffer["sequence"], int(kmer)))
+        loci["locus_left"].append(pack_kmers(buffer["locus_left"], int(kmer) - 1))
+        loci["locus_right"].append(pack_kmers(buffer["locus_right"], int(kmer) - 1))
+        for col in LOCUS_COLUMNS: buffer[col].clear()
 
-    # extract fragments/subsequences
     abyss_subseq_file = f"AFLAP_tmp/03/{G}_m{kmer}_L{LO}_U{UP}_abyss_subseqs.fa"
     with open(abyss_file, 'r') as fab, open(abyss_subseq_file, 'w') as fabsub:
         while True:
@@ -103,50 +180,27 @@ def get_markers(G_info:tuple, kmer:int)->None:
                 if subseq > rc_subseq: subseq = rc_subseq
                 fabsub.write(f"{subseq}\n")
                 # get sequence locus via first and last couple of base pairs
-                seq_groups.loc[len(seq_groups.index)] = [subseq, id[1:], seq[0:(int(kmer) - 1)] + '|' + seq[(len(seq) - int(kmer) + 1):]]
-
-    # refilter against self
-    jf_cmd = f"jellyfish query -s {abyss_subseq_file} AFLAP_tmp/01/F0Count/{G}.jf{kmer}"
-    jf_out = subprocess.run(jf_cmd, shell=True, capture_output=True, text=True, executable="/bin/bash").stdout.split('\n')
-    jfqfile = f"AFLAP_tmp/03/{G}_m{kmer}_L{LO}_U{UP}_jf_query.fa"
-    with open(jfqfile, 'w') as fjq:
-        i = 1
-        for line in jf_out:
-            line = line.strip().split()
-
-            if len(line) and int(line[1]) >= int(LO) and int(line[1]) <= int(UP):
-                fjq.write(f">{i}\n{line[0]}\n")
-                i += 1
-
-    # refilter against other parents
-    for op in P0.split():
-        op = op.strip()
-
-        jf_cmd = f"jellyfish query -s {jfqfile} AFLAP_tmp/01/F0Count/{op}.jf{kmer}"
-        jf_out = subprocess.run(jf_cmd, shell=True, capture_output=True, text=True, executable="/bin/bash").stdout.split('\n')
-        with open(jfqfile, 'w') as fjq:
-            i = 1
-            for line in jf_out:
-                line = line.strip().split()
-
-                # write unique sequences back into file
-                if len(line) and not int(line[1]):
-                    fjq.write(f">{i}\n{line[0]}\n")
-                    i += 1
-
-    # create final marker file
-    with open(abyss_subseq_file, 'r') as fabsub, open(jfqfile, 'r') as fjq, open(f"AFLAP_tmp/03/F0Markers/{G}_m{kmer}_MARKERS_L{LO}_U{UP}_{P0}.fa", 'w') as fmark:
-        # identify markers from jf_query
-        fjq_set = set()
-        for line in fjq:
-            if not line.startswith('>'): fjq_set.add(line.strip())
-
-        # add fabsub markers found in jf_query to final marker file
-        while True:
+                frag_id, frag_len = id[1:].split('_')
+                buffer["frag_id"].append(int(frag_id))
+                buffer["frag_len"].append(int(frag_len))
+                buffer["sequence"].append(subseq)
+                buffer["locus_left"].append(seq[0:(int(kmer) - 1)])
+                buffer["locus_right"].append(seq[(len(seq) - int(kmer) + 1):])
+                if len(buffer["frag_id"]) == LOCUS_CHUNK: flush_loci()
+    flush_loci()
+    loci = {col: np.concatenate(arrays) for col, arrays in loci.items()}
+
+    # refilter against self and other parents (subsequences within bounds in G and absent in other parents are in the parent specific set)
+    passed = kmer_set_isin(loci["sequence"], specific)
+
+    # create final marker file (replacing rather than overwriting it, as it may be linked from the cache)
+    tmp_marker_file = f"{marker_file}.tmp"
+    with open(abyss_subseq_file, 'r') as fabsub, open(tmp_marker_file, 'w') as fmark:
+        # add fabsub markers that passed refiltering to final marker file
+        for keep in passed:
             head = fabsub.readline().strip()
             seq = fabsub.readline().strip()
-            if not head or not seq: break
-            if seq not in fjq_set: continue
+            if not keep: continue
 
             fmark.write(f"{head}\n{seq}\n")
 
@@ -156,6 +210,7 @@ def get_markers(G_info:tuple, kmer:int)->None:
                 markers_eq_ak += 1
             elif int(head[1]) > ak:
                 markers_over_ak += 1
+    os.replace(tmp_marker_file, marker_file)
 
     stats = f"Report for {G}:\n" + \
             f"\tNumber of {kmer}-mers input into assembly:      {ml_count}\n" + \
@@ -170,42 +225,59 @@ def get_markers(G_info:tuple, kmer:int)->None:
     print(stats)
     with open(f"{G}.MarkerReport.txt", 'w') as f: f.write(stats)
 
-    # determine if G is male or female
     if not os.path.exists("AFLAP_tmp/Crosses.txt"):
         exit("An error occurred: Could not find AFLAP_tmp/Crosses.txt. Rerun AFLAP.py.")
-    seq_groups.to_csv(f"AFLAP_tmp/03/SimGroups/{SEX}_{G}_locus_seqs.txt", sep='\t', index=False)
+    save_loci(locus_file, loci, int(kmer))
+    store_artifact(marker_file, key)
+    store_artifact(locus_file, locus_key)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='ObtainMarkers', description="A script to obtain single copy k-mers from parental JELLYFISH hashes.")
     parser.add_argument('-m', '--kmer', type=int, default=31, help='K-mer size. Default [31].')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='Threads shared by the parents when compacting unitigs. Default [4].')
+    parser.add_argument('-a', '--assembler', choices=["abyss", "unitig"], default="abyss", help='Assemble parent specific k-mers with ABySS or compact them into unitigs without it. Default [abyss].')
+    parser.add_argument('-s', '--steps', nargs='+', choices=["presence", "markers", "loci"], default=["presence", "markers", "loci"], help='Steps to run: k-mer presence in partners, markers per parent and identical loci. Default [all].')
+    parser.add_argument('-p', '--parents', nargs='+', default=None, help='Only identify markers of these parents. Default [all].')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Shared directory in which artifacts are stored by input digest. Default [None].')
+    parser.add_argument('--checksum', action='store_true', help='Identify input files by a full checksum instead of their size and modification time.')
     args = parser.parse_args()
+    configure_cache(args.cache_dir, args.checksum)
+    check_packable(args.kmer)
 
     # make directories
     os.makedirs("AFLAP_tmp/03/F0Markers", exist_ok=True)
+    os.makedirs("AFLAP_tmp/03/Presence", exist_ok=True)
     os.makedirs("AFLAP_tmp/03/ReportLogs", exist_ok=True)
     os.makedirs("AFLAP_tmp/03/SimGroups", exist_ok=True)
 
     # assemble for markers for parents whose bounds are identified
-    print("Identifying markers for all parents...")
-    processes = list()
-    for G_info in get_LA_info():
-        p = mp.Process(target=get_markers, args=(G_info, args.kmer))
-        p.start()
-        processes.append(p)
-    for p in processes:
-        p.join()
-    print("Identified markers for all parents.")
-
-    # find sequences of identical loci
-    mp_seqs = pd.DataFrame(columns=["Male Sequence", "Locus Sequence"])
-    for glob_path in glob.glob("AFLAP_tmp/03/SimGroups/male*"):
-        glob_path_seqs = pd.read_csv(glob_path, sep='\t').rename(columns={"Sequence": "Male Sequence", "Sequence ID": "Male Sequence ID"})
-        mp_seqs = pd.concat([mp_seqs, glob_path_seqs])
-    fp_seqs = pd.DataFrame(columns=["Female Sequence", "Locus Sequence"])
-    for glob_path in glob.glob("AFLAP_tmp/03/SimGroups/female*"):
-        glob_path_seqs = pd.read_csv(glob_path, sep='\t').rename(columns={"Sequence": "Female Sequence", "Sequence ID": "Female Sequence ID"})
-        fp_seqs = pd.concat([fp_seqs, glob_path_seqs])
-
-    comb_seqs = pd.merge(mp_seqs, fp_seqs, on="Locus Sequence", how='inner')[["Male Sequence", "Male Sequence ID", "Female Sequence", "Female Sequence ID", "Locus Sequence"]]
-    comb_seqs["Locus Sequence ID"] = comb_seqs.index.map(lambda index: f"F2_{index}")
+    list_of_Gs = get_LA_info()
+    if "presence" in args.steps:
+        print("Finding single copy k-mers shared between parents...")
+        find_presence(list_of_Gs, args.kmer)
+    if "markers" in args.steps:
+        marker_Gs = [G_info for G_info in list_of_Gs if args.parents is None or G_info[0] in args.parents]
+        print(f"Identifying markers for {', '.join(G_info[0] for G_info in marker_Gs)}...")
+        processes = list()
+        for G_info in marker_Gs:
+            p = mp.Process(target=get_markers, args=(G_info, args.kmer, args.assembler, max(1, args.threads // len(marker_Gs))))
+            p.start()
+            processes.append(p)
+        for p in processes:
+            p.join()
+        if any(p.exitcode for p in processes):
+            exit("An error occurred: Markers could not be identified for every parent.")
+        print("Identified markers for all parents.")
+    if "loci" not in args.steps: exit(0)
+
+    # find sequences of identical loci (parents whose loci are unchanged are not reinserted into the index)
+    print("Finding identical loci between male and female parents...")
+    locus_files = dict()
+    for G, LO, UP, P0, SEX in list_of_Gs:
+        locus_file = f"AFLAP_tmp/03/SimGroups/{SEX}_{G}_loci.npz"
+        if not os.path.exists(locus_file):
+            exit(f"An error occurred: Loci for {G} not found. Rerun 03_ObtainMarkers.py with -s markers.")
+        locus_files[G] = (SEX, locus_file)
+    locus_index = update_locus_index("AFLAP_tmp/03/SimGroups/LocusIndex.npz", locus_files, args.kmer, file_digest)
+    comb_seqs = find_identical_loci(locus_index, args.kmer)
     comb_seqs.to_csv(f"AFLAP_Results/IdenticalLoci.txt", sep='\t', index=False)
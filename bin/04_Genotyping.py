@@ -1,113 +1,215 @@
 import argparse
-import glob
+import multiprocessing as mp
 import pandas as pd
 import os
-import subprocess
+import time
 
+from artifact_cache import configure_cache, tool_version, file_digest, artifact_key, fetch_artifact, store_artifact
+from genotype_store import write_count_column, count_markers, read_store_index, build_store, append_store, write_genotype_table
 from get_LA_info import get_LA_info
+from get_prog_info import get_prog_info, has_progeny
+from jf_stream import init_query_worker, query_progeny
+from kmer_scan import read_fasta_seqs, build_marker_index, marker_positions, init_scan_worker, scan_progeny
+from kmer_set import write_kmer_fasta
 
 #################################################
 #	A Python script to call genotypes of progeny using markers derived from a parent and progeny JELLYFISH hashes.
 #	For optimal calls, a k-mer should be observed twice.
+#	Marker counts come from the progeny JELLYFISH hashes, or from scanning the progeny reads for marker k-mers directly.
+#	Either way, the markers of all parents of a progeny are counted in one pass and split back into per-parent count columns,
+#	which are gathered into one genotype store per parent holding the counts and calls of all of its progeny.
 #################################################
 
-def create_count(count_file:str, prog:str, f_type:str, parent:str, kmer:int, lo:int, up:int, p0:str)->None:
-    if os.path.exists(count_file) and os.path.getsize(count_file):
-        print(f"\t\t\tCount for {prog} detected. Skipping")
-        return
-
-    jf_out = subprocess.run(f"jellyfish query -s AFLAP_tmp/03/F0Markers/{parent}_m{kmer}_MARKERS_L{lo}_U{up}_{p0}.fa AFLAP_tmp/01/{f_type}Count/{prog}.jf{kmer}",
-                            shell=True, capture_output=True, text=True, executable="/bin/bash").stdout.split('\n')
-    with open(count_file, 'w') as f:
-        [f.write(f"{line}\n") if (len(line)) else None for line in jf_out]
-
-    if not os.path.getsize(count_file):
-        exit(f"An error occurred: Count file for {prog} was not created properly.")
-    print(f"\t\t\tCount for {prog} created.")
+def write_parent_counts(prog:str, f_type:str, kmer:int, parents:list, counts_of)->None:
+    # splits one progeny's marker counts back into per-parent count columns in marker file order
+    for G, LO, UP, P0, _, key in parents:
+        count_file = f"AFLAP_tmp/04/{f_type}/Count/{prog}_{G}_m{kmer}_L{LO}_U{UP}_{P0}.u16"
+        write_count_column(count_file, counts_of(G))
+        store_artifact(count_file, key)
+
+def create_query_counts(kmer:int, list_of_Gs:list, f_type:str, threads:int, io_jobs:int, progeny:list=None)->None:
+    prog_df = get_prog_info(f_type)
+    if progeny is not None: prog_df = prog_df[prog_df["Individual"].astype(str).isin(progeny)]
+
+    # find progeny lacking an up to date Count file for any of their parents
+    query_jobs = list()
+    for prog in prog_df["Individual"].unique():
+        ind_df = prog_df[prog_df["Individual"] == prog]
+        parents = set(ind_df["MP"].astype(str)) | set(ind_df["FP"].astype(str))
+        jf_file = f"AFLAP_tmp/01/{f_type}Count/{prog}.jf{kmer}"
+        if not os.path.exists(jf_file):
+            exit(f"An error occurred: {prog} not detected among {f_type} progeny. Rerun 01_JELLYFISH.py.")
 
-def create_call(call_file:str, count_file:str, prog:str, low_cov:int, f_type:str, sex:str)->None:
-    if os.path.exists(call_file) and os.path.getsize(call_file):
-        print(f"\t\t\tCall for {prog} detected. Skipping.")
+        missing = list()
+        for G, LO, UP, P0, SEX in list_of_Gs:
+            if G not in parents: continue
+            count_file = f"AFLAP_tmp/04/{f_type}/Count/{prog}_{G}_m{kmer}_L{LO}_U{UP}_{P0}.u16"
+            marker_file = f"AFLAP_tmp/03/F0Markers/{G}_m{kmer}_MARKERS_L{LO}_U{UP}_{P0}.fa"
+            key = artifact_key("marker_count", [marker_file, jf_file], {"engine": "jellyfish", "jellyfish": tool_version("jellyfish")})
+            if not fetch_artifact(count_file, key): missing.append((G, LO, UP, P0, SEX, key))
+        if missing: query_jobs.append((str(prog), jf_file, missing))
+    if not query_jobs:
+        print(f"\tMarker counts for all {f_type} progeny detected. Skipping query.")
         return
 
-    with open(count_file, 'r') as fcount, open(call_file, 'w') as fcall:
-        for line in fcount:
-            line = line.strip().split()
-            if int(line[1]) >= low_cov: fcall.write("1\n")
-            else:                       fcall.write("0\n")
-
-    if not os.path.getsize(call_file):
-        exit(f"An error occurred: Call file for {prog} was not created properly.")
-    print(f"\t\t\tCall for {prog} created.")
-
-def genotype_jfq(kmer:str, LowCov:str, G_info:tuple, f_type:str)->list:
-    ped_file = f"AFLAP_tmp/Pedigree_{f_type}.txt"
-    if not os.path.exists(ped_file):
-        exit(f"An error occurred: {ped_file} not found. Rerun AFLAP.py")
-    if not os.path.getsize(ped_file):
-        print(f"No {f_type} progeny detected. Skipping.")
+    # progeny missing counts for the same parents query one deduplicated union of those parents' markers
+    marker_seqs = dict()
+    for G, LO, UP, P0, _ in list_of_Gs:
+        marker_seqs[G] = read_fasta_seqs(f"AFLAP_tmp/03/F0Markers/{G}_m{kmer}_MARKERS_L{LO}_U{UP}_{P0}.fa")
+    query_dir = f"AFLAP_tmp/04/{f_type}/Query"
+    os.makedirs(query_dir, exist_ok=True)
+    unions = dict()
+    for _, _, missing in query_jobs:
+        Gs = tuple(parent[0] for parent in missing)
+        if Gs in unions: continue
+        markers = build_marker_index([marker_seqs[G] for G in Gs], kmer)
+        union_file = f"{query_dir}/{'_'.join(Gs)}_m{kmer}.{os.getpid()}.fa"
+        write_kmer_fasta(markers, kmer, union_file)
+        unions[Gs] = (union_file, markers, {G: marker_positions(markers, marker_seqs[G], kmer) for G in Gs})
+        print(f"\tQuerying {len(markers)} marker {kmer}-mers of {', '.join(Gs)} in one pass per progeny hash.")
+
+    # load each progeny hash once for the markers of all its parents, in a bounded pool of workers
+    # (io_jobs caps how many hashes are read from disk at once, as concurrent loads of multi-GB hashes thrash shared storage)
+    failed = list()
+    start = time.time()
+    try:
+        query_args = list()
+        for prog, jf_file, missing in query_jobs:
+            union_file, markers, _ = unions[tuple(parent[0] for parent in missing)]
+            query_args.append((prog, union_file, jf_file, len(markers)))
+        missing = {prog: parents for prog, _, parents in query_jobs}
+        workers = max(1, min(threads, len(query_jobs)))
+        print(f"\tQuerying {len(query_jobs)} {f_type} progeny hashes with {workers} worker(s), loading at most {io_jobs} at once...")
+        with mp.Pool(processes=workers, initializer=init_query_worker, initargs=(mp.Semaphore(max(1, io_jobs)),)) as pool:
+            for prog, counts, wall_time, waited, error in pool.imap_unordered(query_progeny, query_args):
+                if counts is None:
+                    print(f"\t\tQuery of {prog} failed after {wall_time:.1f}s: {error}")
+                    failed.append(prog)
+                    continue
+                positions = unions[tuple(parent[0] for parent in missing[prog])][2]
+                write_parent_counts(prog, f_type, kmer, missing[prog], lambda G: counts[positions[G]])
+                print(f"\t\tQueried {prog} for {', '.join(parent[0] for parent in missing[prog])} in {wall_time:.1f}s ({waited:.1f}s waiting to load).")
+    finally:
+        for union_file, _, _ in unions.values(): os.remove(union_file)
+    print(f"\tQueried {len(query_jobs) - len(failed)} of {len(query_jobs)} {f_type} progeny in {time.time() - start:.1f}s.")
+
+    if failed:
+        exit(f"An error occurred: Marker query did not complete for {', '.join(failed)}.")
+
+def create_scan_counts(kmer:int, list_of_Gs:list, f_type:str, threads:int, progeny:list=None)->None:
+    prog_df = get_prog_info(f_type)
+    if progeny is not None: prog_df = prog_df[prog_df["Individual"].astype(str).isin(progeny)]
+
+    # find progeny lacking an up to date Count file for any of their parents
+    scan_jobs = list()
+    for prog in prog_df["Individual"].unique():
+        ind_df = prog_df[prog_df["Individual"] == prog]
+        parents = set(ind_df["MP"].astype(str)) | set(ind_df["FP"].astype(str))
+        paths = ind_df["Path"].dropna().unique().tolist()
+        for path in paths:
+            if not os.path.exists(path):
+                exit(f"An error occurred: {path} for {prog} not found. Make sure that your files' root path is in your current directory.")
+
+        missing = list()
+        for G, LO, UP, P0, SEX in list_of_Gs:
+            if G not in parents: continue
+            count_file = f"AFLAP_tmp/04/{f_type}/Count/{prog}_{G}_m{kmer}_L{LO}_U{UP}_{P0}.u16"
+            key = artifact_key("marker_count", [f"AFLAP_tmp/03/F0Markers/{G}_m{kmer}_MARKERS_L{LO}_U{UP}_{P0}.fa"] + paths, {"engine": "scan"})
+            if not fetch_artifact(count_file, key): missing.append((G, LO, UP, P0, SEX, key))
+        if missing: scan_jobs.append((str(prog), paths, missing))
+    if not scan_jobs:
+        print(f"\tMarker counts for all {f_type} progeny detected. Skipping scan.")
         return
 
-    print(f"\tWorking on {f_type}...")
-    G, LO, UP, P0, SEX = G_info
-
-    # add progeny of parent to list
-    prog_list = list()
+    # load the canonical markers of all parents into one index
+    marker_seqs = dict()
+    for G, LO, UP, P0, _ in list_of_Gs:
+        marker_seqs[G] = read_fasta_seqs(f"AFLAP_tmp/03/F0Markers/{G}_m{kmer}_MARKERS_L{LO}_U{UP}_{P0}.fa")
+    markers = build_marker_index(list(marker_seqs.values()), kmer)
+    marker_idx = {G: marker_positions(markers, seqs, kmer) for G, seqs in marker_seqs.items()}
+    print(f"\tScanning reads of {len(scan_jobs)} {f_type} progeny for {len(markers)} marker {kmer}-mers...")
+
+    failed = list()
+    with mp.Pool(processes=max(1, min(threads, len(scan_jobs))), initializer=init_scan_worker, initargs=(markers,)) as pool:
+        scan_args = [(prog, paths, kmer) for prog, paths, _ in scan_jobs]
+        missing = {prog: parents for prog, _, parents in scan_jobs}
+        for prog, counts, wall_time, error in pool.imap_unordered(scan_progeny, scan_args):
+            if counts is None:
+                print(f"\t\tScan of {prog} failed after {wall_time:.1f}s: {error}")
+                failed.append(prog)
+                continue
+
+            write_parent_counts(prog, f_type, kmer, missing[prog], lambda G: counts[marker_idx[G]])
+            print(f"\t\tScanned {prog} in {wall_time:.1f}s.")
+
+    if failed:
+        exit(f"An error occurred: Marker scan did not complete for {', '.join(failed)}.")
+
+def get_parent_progeny(f_type:str, G:str)->list:
     prog_df = pd.read_csv(f"AFLAP_tmp/Pedigree_{f_type}.txt", sep='\t')
-    prog_list = prog_df[(prog_df["MP"].astype(str) == G) | (prog_df["FP"].astype(str) == G)]["Individual"].unique().tolist()
-    if not len(prog_list):
-        print(f"\t\tNo progeny of {G} found among given {f_type}.")
-
-    # perform jellyfish query
-    for prog in prog_list:
-        print(f"\t\tCreating Count and Call for {prog}...")
-        if not os.path.exists(f"AFLAP_tmp/01/{f_type}Count/{prog}.jf{kmer}"):
-            exit(f"An error occurred: {prog} not detected among {f_type} progeny. Rerun 01_JELLYFISH.py.")
-
-        count_file = f"AFLAP_tmp/04/{f_type}/Count/{prog}_{G}_m{kmer}_L{LO}_U{UP}_{P0}.txt"
-        create_count(count_file, prog, f_type, G, kmer, LO, UP, P0)
-        call_file = f"AFLAP_tmp/04/{f_type}/Call/{prog}_{G}_m{kmer}_L{LO}_U{UP}_{P0}.txt"
-        create_call(call_file, count_file, prog, int(LowCov), f_type, SEX)
-
-    num_count_files = len(list(filter(lambda x: True if (x[22:].split('_')[1] == G) else False, glob.glob(f"AFLAP_tmp/04/{f_type}/Count/*.txt"))))
-    num_call_files = len(list(filter(lambda x: True if (x[21:].split('_')[1] == G) else False, glob.glob(f"AFLAP_tmp/04/{f_type}/Call/*.txt"))))
-    if not num_count_files == num_call_files:
-        exit(f"An error occurred: Non-equivalent amount of Count and Call files were made for {f_type} progeny of {G}. Delete 04 directory in AFLAP_tmp and rerun 04_Genotyping.py.")
-
-    return prog_list
-
-def make_f2_genotype_table(marker_df:pd.DataFrame, ident_loci_df:pd.DataFrame, sex:str)->pd.DataFrame:
-    # edit identical loci dataframe
-    id_col_name = f"{sex.capitalize()} Sequence ID"
-    specific_loci_df = ident_loci_df[[id_col_name, "Locus Sequence", "Locus Sequence ID"]]
-    # TODO: fix warning
-    specific_loci_df[id_col_name] = specific_loci_df[id_col_name].apply(lambda x: x.split('_')[0])
-
-    # merge dataframes and replace marker ID with locus ID
-    marker_df = marker_df.merge(specific_loci_df, left_on="MarkerID", right_on=id_col_name, how='inner')
-    marker_df["MarkerSequence"] = marker_df["Locus Sequence"]
-    marker_df["MarkerID"] = marker_df["Locus Sequence ID"]
-
-    if sex == "male": marker_df.iloc[:, 3:] = marker_df.iloc[:, 3:].replace(['0', '1'], ['X', 'A'])
-    else:             marker_df.iloc[:, 3:] = marker_df.iloc[:, 3:].replace(['0', '1'], ['X', 'B'])
-
-    return marker_df.drop(columns=[id_col_name, "Locus Sequence", "Locus Sequence ID"])
+    return prog_df[(prog_df["MP"].astype(str) == G) | (prog_df["FP"].astype(str) == G)]["Individual"].unique().tolist()
+
+def update_genotype_store(kmer:int, low_cov:int, G_info:tuple, f_type:str, prog_list:list)->str:
+    # appends new progeny to the parent's store; it is rebuilt when its markers or LowCov changed or a stored progeny was removed or recounted
+    G, LO, UP, P0, _ = G_info
+    marker_file = f"AFLAP_tmp/03/F0Markers/{G}_m{kmer}_MARKERS_L{LO}_U{UP}_{P0}.fa"
+    store_dir = f"AFLAP_tmp/04/{f_type}/{G}_m{kmer}_L{LO}_U{UP}_{P0}.store"
+    count_files = {str(prog): f"AFLAP_tmp/04/{f_type}/Count/{prog}_{G}_m{kmer}_L{LO}_U{UP}_{P0}.u16" for prog in prog_list}
+    for prog, count_file in count_files.items():
+        if not os.path.exists(count_file):
+            exit(f"An error occurred: Count for {prog} not found. Rerun 04_Genotyping.py with the count step.")
+    marker_key = file_digest(marker_file)
+    count_keys = {prog: file_digest(count_file) for prog, count_file in count_files.items()}
+
+    index = read_store_index(store_dir)
+    if index is None or index["marker_key"] != marker_key or index["low_cov"] != low_cov or \
+       any(count_keys.get(prog) != key for prog, key in zip(index["progeny"], index["count_keys"])):
+        print(f"\tBuilding the genotype store for {len(prog_list)} {f_type} progeny of {G}...")
+        build_store(store_dir, marker_file, marker_key, list(count_files), list(count_files.values()), list(count_keys.values()), low_cov)
+        return store_dir
+
+    new_progs = [prog for prog in count_files if prog not in set(index["progeny"])]
+    if not new_progs:
+        print(f"\tGenotype store for {f_type} progeny of {G} is up to date. Skipping.")
+        return store_dir
+    print(f"\tAppending {len(new_progs)} new {f_type} progeny to the genotype store of {G}...")
+    append_store(store_dir, index, new_progs, [count_files[prog] for prog in new_progs], [count_keys[prog] for prog in new_progs])
+    return store_dir
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='Genotyping', description="A script to genotype progeny")
     parser.add_argument('-m', '--kmer', type=int, default=31, help='K-mer size. Default [31].')
     parser.add_argument('-x', '--LowCov', type=int, default=2, help='Run with low coverage parameters.')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='Progeny queried or scanned concurrently. Default [4].')
+    parser.add_argument('--io-jobs', type=int, default=2, help='Progeny JELLYFISH hashes loaded from disk at once by the jellyfish engine. Default [2].')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Shared directory in which artifacts are stored by input digest. Default [None].')
+    parser.add_argument('--checksum', action='store_true', help='Identify input files by a full checksum instead of their size and modification time.')
+    parser.add_argument('-e', '--engine', choices=["jellyfish", "scan"], default="jellyfish", help='Count markers by querying progeny JELLYFISH hashes or by scanning progeny reads directly. Default [jellyfish].')
+    parser.add_argument('-s', '--steps', nargs='+', choices=["count", "table"], default=["count", "table"], help='Steps to run: marker counts per progeny, and genotype stores per parent. Default [all].')
+    parser.add_argument('-p', '--parents', nargs='+', default=None, help='Only genotype progeny against the markers of these parents. Default [all].')
+    parser.add_argument('--progeny', nargs='+', default=None, help='Only count markers in these progeny. Default [all].')
+    parser.add_argument('--export-tsv', action='store_true', help='Also export each genotype store as a Genotypes.MarkerID.tsv table.')
+    parser.add_argument('-f', '--f-types', nargs='+', choices=["F1", "F2"], default=["F1", "F2"], help='Progeny generations to genotype. Default [F1 F2].')
     args = parser.parse_args()
+    configure_cache(args.cache_dir, args.checksum)
 
-    list_of_Gs = get_LA_info()
-    for f_type in ["F1", "F2"]:
-        if not len(os.listdir(f"AFLAP_tmp/01/{f_type}Count")):
+    list_of_Gs = [G_info for G_info in get_LA_info() if args.parents is None or G_info[0] in args.parents]
+    for f_type in args.f_types:
+        if not has_progeny(f_type):
             print(f"No {f_type} progeny found. Skipping.")
             continue
 
         # make directories
         os.makedirs(f"AFLAP_tmp/04/{f_type}/Count", exist_ok=True)
-        os.makedirs(f"AFLAP_tmp/04/{f_type}/Call", exist_ok=True)
+
+        # count markers of all parents in one pass over each progeny's reads or hash
+        if "count" in args.steps:
+            for G, LO, UP, P0, _ in list_of_Gs:
+                marker_file = f"AFLAP_tmp/03/F0Markers/{G}_m{args.kmer}_MARKERS_L{LO}_U{UP}_{P0}.fa"
+                if not os.path.exists(marker_file) or not os.path.getsize(marker_file):
+                    exit(f"An error occurred: {marker_file} not valid. Rerun 03_ObtainMarkers.py.")
+            if args.engine == "scan": create_scan_counts(args.kmer, list_of_Gs, f_type, args.threads, args.progeny)
+            else:                     create_query_counts(args.kmer, list_of_Gs, f_type, args.threads, args.io_jobs, args.progeny)
 
         # check for markers
         for G_info in list_of_Gs:
@@ -117,54 +219,27 @@ if __name__ == "__main__":
             marker_file = f"AFLAP_tmp/03/F0Markers/{G}_m{args.kmer}_MARKERS_L{LO}_U{UP}_{P0}.fa"
             if not os.path.exists(marker_file) or not os.path.getsize(marker_file):
                 exit(f"An error occurred: {marker_file} not valid. Rerun 03_ObtainMarkers.py.")
-            print(f"\t{os.path.getsize(marker_file) // 2} markers identified in {marker_file}. These will be surveyed against progeny.")
+            print(f"\t{count_markers(marker_file)} markers identified in {marker_file}. These will be surveyed against progeny.")
 
-            # get data for progeny
-            print(f"\tGetting {f_type} progeny data for {G}...")
-            prog_list = genotype_jfq(args.kmer, args.LowCov, G_info, f_type)
+            # gather the progeny counts of the parent into its genotype store
+            if "table" not in args.steps: continue
+            prog_list = get_parent_progeny(f_type, G)
             if not prog_list:
-                exit(f"An error occurred: Creating call and count of {f_type} progeny did not work.")
-
-            # extract info from marker file
-            marker_file = f"AFLAP_tmp/03/F0Markers/{G}_m{args.kmer}_MARKERS_L{LO}_U{UP}_{P0}.fa"
-            with open(marker_file, 'r') as f:
-                head_list = list()
-                seq_list = list()
-
-                while True:
-                    head = f.readline().strip().replace('>', '')
-                    if not head: break
-                    seq = f.readline().strip()
-                    head_list.append(head)
-                    seq_list.append(seq)
-
-                if len(head_list) != len(seq_list):
-                    exit(f"An error occurred: {marker_file} not extracted properly. Make sure every marker pairs with a sequence.")
-
-            # create genotype table
-            print(f"Creating a genotype table for {f_type} progeny of {G}...")
-            data = {"MarkerSequence": seq_list, "MarkerID": head_list}
-            for prog in prog_list:
-                with open(f"AFLAP_tmp/04/{f_type}/Call/{prog}_{G}_m{args.kmer}_L{LO}_U{UP}_{P0}.txt", 'r') as fcall:
-                    b_vals = list()
-                    for b_val in fcall: b_vals.append(b_val.strip())
-                data[prog] = b_vals
-            marker_df = pd.DataFrame(data=data)
-
-            ## split marker sequence and value and reorder
-            marker_df[["MarkerID", "MarkerLength"]] = marker_df["MarkerID"].str.split('_', expand=True)
-            marker_df = marker_df.reindex(columns=["MarkerSequence", "MarkerID", "MarkerLength"] + list(marker_df.columns[2:-1]))
-
-            if f_type == "F2":
-                identical_loci_id_df = pd.read_csv("AFLAP_Results/IdenticalLoci.txt", sep='\t')
-                if identical_loci_id_df.empty:
-                    exit("An error occurred: AFLAP_Results/IdenticalLoci.txt not found. Rerun 03_ObtainMarkers.py.")
-
-                marker_df = make_f2_genotype_table(marker_df, identical_loci_id_df, SEX)
-
-            ## create tsv file
-            marker_df.to_csv(f"AFLAP_tmp/04/{G}_{f_type}_m{args.kmer}_L{LO}_U{UP}_{P0}.Genotypes.MarkerID.tsv", sep='\t', index=False)
-
-            if not os.path.exists(f"AFLAP_tmp/04/{G}_{f_type}_m{args.kmer}_L{LO}_U{UP}_{P0}.Genotypes.MarkerID.tsv"):
-                exit("An error occurred: Genotypes.MarkerID.tsv was not made.")
-            print(f"\t{f_type} Genotypes.MarkerID.tsv for {G} has been created.")
+                print(f"\tNo {f_type} progeny of {G}. Skipping genotype store.")
+                continue
+            store_dir = update_genotype_store(args.kmer, args.LowCov, G_info, f_type, prog_list)
+            if not args.export_tsv: continue
+
+            # export the genotype table as a tsv file (only when the store or the identical loci changed)
+            identical_loci_id_df = None
+            if f_type == "F2" and not os.path.exists("AFLAP_Results/IdenticalLoci.txt"):
+                exit("An error occurred: AFLAP_Results/IdenticalLoci.txt not found. Rerun 03_ObtainMarkers.py.")
+            tsv_file = f"AFLAP_tmp/04/{G}_{f_type}_m{args.kmer}_L{LO}_U{UP}_{P0}.Genotypes.MarkerID.tsv"
+            key = artifact_key("genotype_tsv", ["AFLAP_Results/IdenticalLoci.txt"] if f_type == "F2" else [], {"store": read_store_index(store_dir)})
+            if fetch_artifact(tsv_file, key):
+                print(f"\t{f_type} Genotypes.MarkerID.tsv for {G} is up to date. Skipping.")
+                continue
+            if f_type == "F2": identical_loci_id_df = pd.read_csv("AFLAP_Results/IdenticalLoci.txt", sep='\t')
+            write_genotype_table(store_dir, f_type, G, SEX, tsv_file, identical_loci_id_df)
+            store_artifact(tsv_file, key)
+            print(f"\t{f_type} Genotypes.MarkerID.tsv for {G} has been exported.")
@@ -1,98 +1,76 @@
 import argparse
-import glob
-import math
+import functools
+import itertools
+import json
+import numpy as np
 import os
 import pandas as pd
 
 from get_LA_info import get_LA_info
+from artifact_cache import artifact_key, read_key, store_artifact
+from genotype_store import F2_A, F2_B, F2_XX, F2_AA, F2_BB, F2_AB, F2_GENOTYPES, configure_chunk_mem, iter_chunks, load_store, read_store_index, read_present, read_summary, parent_markers, store_codes, code_counts
+from get_prog_info import has_progeny
+from task_graph import parse_mem
+from plots import PlotQueue
 from seg_stats import get_seg_stats
 from kmercov_x_markercount import plot_cov_and_mcount
 
 #################################################
 #       A Python script to obtain segregation statistics and exclude progeny which have low coverage.
+#       Markers x progeny matrices are read, combined and written in chunks of marker rows sized by --chunk-mem,
+#       so only per-marker vectors grow with the number of markers.
 #################################################
 
-def get_count_frequency(df:pd.DataFrame)->pd.DataFrame:
-    return df.groupby("Frequency")["Frequency"].count().rename("Frequency Count").to_frame().reset_index(drop=False)
-
-def progeny_analysis(progs_df:pd.DataFrame, f_type:str, G_info:tuple, mc_df:pd.DataFrame, kmer:int)->pd.DataFrame:
-    G, LO, UP, P0, _ = G_info
-
-    for prog in progs_df["Individual"].unique().tolist():
-        prog_df = progs_df[progs_df["Individual"].astype(str) == prog]
-        if prog_df[(prog_df["MP"].astype(str) == G) | (prog_df["MP"].astype(str) == G)].empty: continue
-        prog_call_file = f"AFLAP_tmp/04/{f_type}/Call/{prog}_{G}_m{kmer}_L{LO}_U{UP}_{P0}.txt"
-        if not os.path.exists(prog_call_file):
-            exit(f"An error occurred: Count for {prog} could not be found. Rerun 04_Genotyping.py.")
-
-        # find progeny's marker count
-        with open(prog_call_file, 'r') as fcall:
-            call_vals = [int(line.strip()) for line in fcall]
-            marker_count = sum(call_vals)
-
-        # find progeny's coverage value
-        coverage = 0
-        count_df = pd.read_csv(f"AFLAP_tmp/04/{f_type}/Count/{prog}_{G}_m{kmer}_L{LO}_U{UP}_{P0}.txt", sep=' ',
-                               header=None, names=["Sequence", "Count"])
-        c_dict = count_df.groupby("Count").count().to_dict()["Sequence"]
-        del c_dict[0]   # remove 0 from dictionary
-
-        ## find most frequent count
-        max = -math.inf
-        for c in c_dict:
-            if c_dict[c] > max:
-                max = c_dict[c]
-                coverage = c
-
-        ## confirm if coverage peak is 1
-        if coverage == 1:
-            not1 = is1 = 0
-            for i in range(2, 6): del c_dict[i]
-            for c in c_dict:
-                if c == 1: is1 = c_dict[c]
-                not1 += c_dict[c]
-
-            if not1 > is1:
-                del c_dict[1]
-                # find most frequent count again
-                max = -math.inf
-                for c in c_dict:
-                    if c_dict[c] > max:
-                        max = c_dict[c]
-                        coverage = c
-
-        mc_df.loc[len(mc_df.index)] = [prog, marker_count, coverage]
-
-    return mc_df
-
-def genotype_table_stats(marker_df:pd.DataFrame, G_info:tuple, f_type:str, kmer:int, LOD:int, SDL:float, SDU:float)->tuple[pd.DataFrame, set]:
-    G, LO, UP, P0, _ = G_info
+def get_count_frequency(frequency:np.ndarray)->tuple[np.ndarray, np.ndarray]:
+    # returns each frequency and how many markers have it
+    return np.unique(frequency, return_counts=True)
+
+def coverage_peaks(histograms:np.ndarray)->np.ndarray:
+    # most frequent non-zero marker count of each progeny (0 if it has no counts)
+    coverage = np.where(histograms[:, 1:].any(axis=1), histograms[:, 1:].argmax(axis=1) + 1, 0)
+
+    # confirm if coverage peak is 1: if any marker is counted more than 5 times, use the most frequent of those counts instead
+    high = histograms[:, 6:]
+    repeak = (coverage == 1) & high.any(axis=1)
+    coverage[repeak] = high[repeak].argmax(axis=1) + 6
+    return coverage
+
+def is_up_to_date(paths:list, key:str)->bool:
+    return all(os.path.exists(path) and read_key(path) == key for path in paths)
+
+def progeny_stats(store_dir:str, index:dict)->pd.DataFrame:
+    # marker count and coverage of each progeny from the summaries kept in the parent's genotype store
+    marker_counts, histograms = read_summary(store_dir, index)
+    return pd.DataFrame({"Prog": index["progeny"], "Marker Count": marker_counts.astype(int), "K-mer Coverage": coverage_peaks(histograms)})
+
+def genotype_table_stats(G_info:tuple, f_type:str, kmer:int, LOD:int, SDL:float, SDU:float, plot_queue:PlotQueue, ident_loci_df:pd.DataFrame=None)->tuple[pd.DataFrame, np.ndarray, np.ndarray, list, set]:
+    # returns the parent's markers, their store rows, which of them are within the frequency bounds, its progeny and the low coverage progeny
+    G, LO, UP, P0, SEX = G_info
     filtered_progs = set()
 
-    # check number of calls for parent
-    call_files = glob.glob(f"AFLAP_tmp/04/{f_type}/Call/*.txt")
-    call_files = list(filter(lambda x: True if (x[21:].split('_')[1] == G) else False, call_files))
-    num_progs = len(call_files)
+    # check number of progeny in the parent's genotype store
+    store_dir = f"AFLAP_tmp/04/{f_type}/{G}_m{kmer}_L{LO}_U{UP}_{P0}.store"
+    marker_df, rows, index = parent_markers(store_dir, f_type, G, SEX, ident_loci_df)
+    num_progs = len(index["progeny"])
     if not num_progs: exit("An error occurred: Invalid number of progeny.")
     print(f"{num_progs} Genotype calls for {G} detected. Summarizing...")
 
-    # perform analysis on F2 progeny of G
-    mc_df = pd.DataFrame(columns=["Prog", "Marker Count", "K-mer Coverage"])
-    progs_df = pd.read_csv(f"AFLAP_tmp/Pedigree_{f_type}.txt", sep='\t')
-    mc_df = progeny_analysis(progs_df, f_type, G_info, mc_df, kmer)
+    # perform analysis on progeny of G
+    mc_df = progeny_stats(store_dir, index)
 
     # plot k-mer coverage and marker count
-    plot_cov_and_mcount(mc_df, f"AFLAP_Results/{G}_{f_type}_m{kmer}_L{LO}_U{UP}_{P0}_KmerCovXMarkerCount.png")
-
-    # get marker statistics
-    if f_type == "F1": marker_df["Frequency"] = marker_df.iloc[:, 3:].astype(int).sum(axis=1).div(num_progs)
-    else:              marker_df["Frequency"] = marker_df.iloc[:, 3:].astype(str).ne('X').sum(axis=1).div(num_progs)
-    marker_all = get_count_frequency(marker_df)
-    marker_equals = get_count_frequency(marker_df[marker_df["MarkerLength"].astype(int) == 61])
-    marker_over = get_count_frequency(marker_df[marker_df["MarkerLength"].astype(int) > 61])
+    plot_queue.submit(plot_cov_and_mcount, f"AFLAP_Results/{G}_{f_type}_m{kmer}_L{LO}_U{UP}_{P0}_KmerCovXMarkerCount.png",
+                      mc_df["K-mer Coverage"].to_numpy(dtype=int), mc_df["Marker Count"].to_numpy(dtype=int))
+
+    # get marker statistics from the store's running sums
+    frequency = read_present(store_dir, index)[rows] / num_progs
+    marker_lengths = marker_df["MarkerLength"].to_numpy(dtype=int)
+    marker_all = get_count_frequency(frequency)
+    marker_equals = get_count_frequency(frequency[marker_lengths == 61])
+    marker_over = get_count_frequency(frequency[marker_lengths > 61])
     seg_png = f"AFLAP_Results/{G}_{f_type}_m{kmer}_L{LO}_U{UP}_{P0}_MarkerSeg.png"
     ak = 2 * kmer - 1
-    get_seg_stats(marker_all, marker_equals, marker_over, ak, seg_png)
+    plot_queue.submit(get_seg_stats, seg_png, marker_all, marker_equals, marker_over, ak)
 
     # filter out progeny with coverage < LOD
     if not LOD == 2:
@@ -104,95 +82,344 @@ def genotype_table_stats(marker_df:pd.DataFrame, G_info:tuple, f_type:str, kmer:
         filtered_progs.add(low_cov['Prog'][i])
         print(f"\t{low_cov['Prog'][i]} appears to be low coverage. Will be excluded.")
 
-    # drop sequences outside of frequency bounds
-    marker_df = marker_df[marker_df["Frequency"].astype(float).between(SDL, SDU)]
-    marker_df = marker_df.drop(columns=["Frequency"])
-
-    return (marker_df, filtered_progs)
-
-def filter_f1(kmer:int, LOD:int, SDL:float, SDU:float)->None:
+    # mark sequences within frequency bounds
+    in_bounds = (frequency >= SDL) & (frequency <= SDU)
+    return (marker_df, rows, in_bounds, index["progeny"], filtered_progs)
+
+def write_code_table(marker_df:pd.DataFrame, codes:np.ndarray, progeny:list, tsv_file:str, header:bool=True)->None:
+    # genotype tables in AFLAP_tmp/05 hold the integer codes; 06 maps them to LepMap3 posteriors
+    # (chunks after the first are appended without a header)
+    pd.concat([marker_df.reset_index(drop=True), pd.DataFrame(codes, columns=progeny)], axis=1).to_csv(
+        tsv_file, sep='\t', index=False, header=header, mode='w' if header else 'a')
+
+def write_code_chunks(marker_df:pd.DataFrame, code_chunks, progeny:list, tsv_file:str)->None:
+    # writes a table chunk by chunk from (start, end, codes) of consecutive marker rows
+    marker_df = marker_df.reset_index(drop=True)
+    write_code_table(marker_df.iloc[:0], np.zeros((0, len(progeny)), dtype=np.int8), progeny, tsv_file)
+    for start, end, codes in code_chunks:
+        write_code_table(marker_df.iloc[start:end], codes, progeny, tsv_file, header=False)
+
+def f1_marker_ids(marker_df:pd.DataFrame)->pd.DataFrame:
+    # combine marker ID and marker length
+    return pd.DataFrame({"MarkerSequence": marker_df["MarkerSequence"],
+                         "MarkerID": marker_df["MarkerID"].astype(str) + '_' + marker_df["MarkerLength"].astype(str)})
+
+def filter_f1(kmer:int, LOD:int, SDL:float, SDU:float, plot_queue:PlotQueue)->None:
     for G_info in get_LA_info():
-        G, LO, UP, P0, _ = G_info
-        marker_df = pd.read_csv(f"AFLAP_tmp/04/{G}_F1_m{kmer}_L{LO}_U{UP}_{P0}.Genotypes.MarkerID.tsv", sep='\t')
-
-        # get genotype table statistics
-        marker_df, filtered_progs = genotype_table_stats(marker_df, G_info, "F1", kmer, LOD, SDL, SDU)
-
-        # remove LOD-filtered progeny from male and female dataframes
-        marker_df = marker_df.drop(columns=list(filtered_progs))
+        G, LO, UP, P0, SEX = G_info
 
-        # combine marker ID and marker length
-        marker_df["MarkerID"] = marker_df["MarkerID"].astype(str) + '_' + marker_df["MarkerLength"].astype(str)
-        marker_df = marker_df.drop(columns=["MarkerLength"])
+        # skip parents whose store has not changed since their table was filtered
+        store_dir = f"AFLAP_tmp/04/F1/{G}_m{kmer}_L{LO}_U{UP}_{P0}.store"
+        filtered_tsv = f"AFLAP_tmp/05/{G}_F1_m{kmer}_L{LO}_U{UP}_{P0}.Genotypes.MarkerID.Filtered.tsv"
+        key = artifact_key("f1_filtered", [], {"store": read_store_index(store_dir), "LOD": LOD, "SDL": SDL, "SDU": SDU})
+        if is_up_to_date([filtered_tsv], key):
+            print(f"F1 genotype table for {G} is up to date. Skipping.")
+            continue
 
-        marker_df.to_csv(f"AFLAP_tmp/05/{G}_F1_m{kmer}_L{LO}_U{UP}_{P0}.Genotypes.MarkerID.Filtered.tsv", sep='\t', index=False)
+        # get genotype table statistics
+        marker_df, rows, in_bounds, progeny, filtered_progs = genotype_table_stats(G_info, "F1", kmer, LOD, SDL, SDU, plot_queue)
+
+        # remove LOD-filtered progeny and sequences outside of frequency bounds
+        columns = np.array([i for i, prog in enumerate(progeny) if prog not in filtered_progs], dtype=np.int64)
+        kept_rows = rows[in_bounds]
+        code_chunks = ((start, end, store_codes(store_dir, "F1", SEX, kept_rows[start:end], columns)) for start, end in iter_chunks(len(kept_rows), len(columns)))
+        write_code_chunks(f1_marker_ids(marker_df[in_bounds]), code_chunks, [progeny[i] for i in columns], filtered_tsv)
+        store_artifact(filtered_tsv, key)
         print(f"Finished creating F1 genotype table for {G}.")
 
-def agg_function(series:pd.Series)->str:
-    unique_values = series.astype(str).unique()
-    return unique_values[0] if (len(unique_values)) else ''.join(unique_values)
+def iter_f2_codes(tables:list, progeny:list, num_loci:int):
+    # yields (start, end, codes) of consecutive chunks of the loci x progeny F2 codes:
+    # a locus appears at most once per parent, so the sum of the male (A) and female (B) codes is its F2 code
+    # (each table gives a function returning the parent's codes of given rows and columns, its rows, their loci and its progeny)
+    prog_col = {prog: i for i, prog in enumerate(progeny)}
+    sorted_tables = list()
+    for codes_of, rows, loci, progs in tables:
+        cols = np.array([i for i, prog in enumerate(progs) if prog in prog_col], dtype=np.int64)
+        if not len(cols) or not len(rows): continue
+        # order each parent's rows by locus, so the rows of a chunk of loci are one slice
+        order = np.argsort(loci, kind='stable')
+        sorted_tables.append((codes_of, rows[order], loci[order], cols, [prog_col[progs[i]] for i in cols]))
+    for start, end in iter_chunks(num_loci, len(progeny)):
+        comb_codes = np.zeros((end - start, len(progeny)), dtype=np.int8)
+        for codes_of, rows, loci, cols, comb_cols in sorted_tables:
+            first, last = np.searchsorted(loci, [start, end])
+            if first == last: continue
+            comb_codes[np.ix_(loci[first:last] - start, comb_cols)] += codes_of(rows[first:last], cols)
+        yield start, end, comb_codes
+
+def update_code_counts(state_file:str, state_key:str, tables:list, progeny:list, prog_keys:list, num_loci:int)->np.ndarray:
+    # running XX/AA/BB/AB counts of every locus over the included progeny; only progeny not counted before are read from the stores
+    counts = np.zeros((num_loci, len(F2_GENOTYPES)), dtype=np.int64)
+    counted = dict()
+    if os.path.exists(state_file):
+        with np.load(state_file) as npz:
+            if str(npz["key"]) == state_key and npz["counts"].shape == counts.shape:
+                counted = dict(zip(npz["progeny"].tolist(), npz["prog_keys"].tolist()))
+                counts = npz["counts"].astype(np.int64)
+    current = dict(zip(progeny, prog_keys))
+    if any(current.get(prog) != key for prog, key in counted.items()):
+        print("\tProgeny have been removed or recounted since the last run. Recounting all progeny...")
+        counts[:] = 0
+        counted = dict()
+
+    new_progs = [prog for prog in progeny if prog not in counted]
+    if new_progs:
+        print(f"\tAdding {len(new_progs)} progeny to the F2 frequency counts...")
+        for start, end, comb_codes in iter_f2_codes(tables, new_progs, num_loci):
+            counts[start:end] += code_counts(comb_codes, len(F2_GENOTYPES))
+    progs = list(counted) + new_progs
+    with open(f"{state_file}.tmp", 'wb') as f:
+        np.savez(f, key=np.array(state_key), progeny=np.array(progs, dtype=str),
+                 prog_keys=np.array([current[prog] for prog in progs], dtype=str), counts=counts)
+    os.replace(f"{state_file}.tmp", state_file)
+    return counts
+
+def drop_parent_codes(counts:np.ndarray, male_kept:np.ndarray, female_kept:np.ndarray)->np.ndarray:
+    # code counts of loci once the markers of one parent are filtered out: that parent's calls read as absent
+    counts = counts.copy()
+    for kept, absent, merged in [(male_kept, [F2_XX, F2_BB], [F2_AA, F2_AB]), (female_kept, [F2_XX, F2_AA], [F2_BB, F2_AB])]:
+        for to_code, from_code in zip(absent, merged):
+            counts[~kept, to_code] += counts[~kept, from_code]
+            counts[~kept, from_code] = 0
+    return counts
+
+def rank_loci(ident_loci_df:pd.DataFrame)->tuple[np.ndarray, pd.DataFrame]:
+    # number the identical loci in sorted order, so every parent's markers align on their locus without a join of the tables
+    num_loci = len(ident_loci_df.index)
+    order = np.lexsort((ident_loci_df["Locus Sequence ID"].to_numpy(dtype=str), ident_loci_df["Locus Sequence"].to_numpy(dtype=str)))
+    locus_rank = np.empty(num_loci, dtype=np.int64)
+    locus_rank[order] = np.arange(num_loci)
+    loci_df = pd.DataFrame({"MarkerSequence": ident_loci_df["Locus Sequence"].to_numpy()[order],
+                            "MarkerID": ident_loci_df["Locus Sequence ID"].to_numpy()[order]})
+    return locus_rank, loci_df
+
+def xx_quantile(xx_histogram:np.ndarray, num_progs:int, q:float=0.75)->float:
+    # the q quantile of the XX frequencies of loci counted in xx_histogram (loci per XX count), interpolated as np.quantile does
+    num_loci = int(xx_histogram.sum())
+    if not num_loci: return 0.0
+    position = q * (num_loci - 1)
+    lower = int(np.floor(position))
+    cumulative = np.cumsum(xx_histogram)
+    # the sorted XX count at index i is the first count whose cumulative number of loci exceeds i
+    below, above = np.searchsorted(cumulative, [lower, min(lower + 1, num_loci - 1)], side='right')
+    return float(np.quantile(np.array([below, above]) / max(num_progs, 1), position - lower))
+
+def select_f2_loci(counts:np.ndarray, parent_loci:list, num_progs:int, xx_filter:float=None)->tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # loci keeping the markers of at least one parent within frequency bounds, their genotype frequencies and which of them pass the XX filter
+    # (parent_loci holds the sex of each parent and the loci of its markers within bounds)
+    male_kept, female_kept = np.zeros(len(counts), dtype=bool), np.zeros(len(counts), dtype=bool)
+    for sex, loci in parent_loci:
+        (male_kept if sex == "male" else female_kept)[loci] = True
+    kept = male_kept | female_kept
+    chunks = list(iter_chunks(len(counts), len(F2_GENOTYPES)))
+    kept_counts = lambda start, end: drop_parent_codes(counts[start:end], male_kept[start:end], female_kept[start:end])[kept[start:end]]
+
+    # first pass: histogram of the XX counts of the kept loci, from which the XX quantile is found without sorting them
+    if xx_filter is None:
+        xx_histogram = np.zeros(num_progs + 1, dtype=np.int64)
+        for start, end in chunks:
+            xx_histogram += np.bincount(kept_counts(start, end)[:, F2_XX], minlength=num_progs + 1)
+        xx_filter = xx_quantile(xx_histogram, num_progs)
+
+    # second pass: frequencies of the kept loci and which of them pass the XX filter
+    frequencies = np.zeros((int(kept.sum()), len(F2_GENOTYPES)))
+    position = 0
+    for start, end in chunks:
+        chunk_freq = kept_counts(start, end) / max(num_progs, 1)
+        frequencies[position:position + len(chunk_freq)] = chunk_freq
+        position += len(chunk_freq)
+    return kept, frequencies, frequencies[:, F2_XX] <= xx_filter
+
+def write_f2_tables(loci_df:pd.DataFrame, tables:list, kept:np.ndarray, frequencies:np.ndarray, keep:np.ndarray, progeny:list, stats_tsv:str, filtered_tsv:str)->None:
+    # tables hold the code function, rows, loci and progeny of each parent together with which of its markers are within bounds
+    loci_df = loci_df[kept][keep].reset_index(drop=True)
+    freq_df = pd.DataFrame(frequencies[keep], columns=[f"{val} Frequency" for val in F2_GENOTYPES])
 
-def filter_f2(kmer:int, LOD:int, SDL:float, SDU:float, xx_filter:float=None)->None:
-    # get male and female marker dataframes
+    # create frequency stats table
+    pd.concat([loci_df, freq_df], axis=1).to_csv(stats_tsv, sep='\t', index=False)
+
+    # create filtered genotype table from the kept markers of the remaining loci
+    locus_pos = np.full(len(kept), -1, dtype=np.int64)
+    locus_pos[np.flatnonzero(kept)[keep]] = np.arange(int(keep.sum()))
+    kept_tables = list()
+    for codes_of, rows, loci, in_bounds, progs in tables:
+        row_kept = in_bounds & (locus_pos[loci] >= 0)
+        kept_tables.append((codes_of, rows[row_kept], locus_pos[loci[row_kept]], progs))
+    write_code_chunks(loci_df, iter_f2_codes(kept_tables, progeny, len(loci_df.index)), progeny, filtered_tsv)
+
+def filter_f2(kmer:int, LOD:int, SDL:float, SDU:float, plot_queue:PlotQueue, xx_filter:float=None)->None:
+    # get parents and their genotype stores
     parents = [[], []]
+    stores = dict()
+    if not os.path.exists("AFLAP_Results/IdenticalLoci.txt"):
+        exit("An error occurred: AFLAP_Results/IdenticalLoci.txt not found. Rerun 03_ObtainMarkers.py.")
+    for G, LO, UP, P0, SEX in get_LA_info():
+        stores[G] = read_store_index(f"AFLAP_tmp/04/F2/{G}_m{kmer}_L{LO}_U{UP}_{P0}.store")
+        parents[0 if SEX == "male" else 1].append(G)
+    if not parents[0] or not parents[1]:
+        exit("An error occurred: There should be two marker tables for the female and male parent. To fix this, rerun 04_Genotyping.py.")
+
+    # concatenate all parents of same sex together
+    parents = ['_'.join(p) for p in parents]
+    stats_tsv = f"AFLAP_tmp/05/{parents[0]}x{parents[1]}_F2_m{kmer}.FilteredFrequencyStats.tsv"
+    filtered_tsv = f"AFLAP_tmp/05/{parents[0]}x{parents[1]}_F2_m{kmer}.Genotypes.MarkerID.Filtered.tsv"
+    key = artifact_key("f2_filtered", ["AFLAP_Results/IdenticalLoci.txt"], {"stores": stores, "LOD": LOD, "SDL": SDL, "SDU": SDU, "fXX": xx_filter})
+    if is_up_to_date([stats_tsv, filtered_tsv], key):
+        print("F2 filtered genotype table is up to date. Skipping.")
+        return
+
+    # number the identical loci
+    ident_loci_df = pd.read_csv("AFLAP_Results/IdenticalLoci.txt", sep='\t', dtype={"Locus Sequence": str, "Locus Sequence ID": str})
+    locus_rank, loci_df = rank_loci(ident_loci_df)
+    num_loci = len(loci_df.index)
+
+    # get marker tables of all parents
+    tables = list()
     filtered_progs = set()
     for G_info in get_LA_info():
         G, LO, UP, P0, SEX = G_info
-        marker_df = pd.read_csv(f"AFLAP_tmp/04/{G}_F2_m{kmer}_L{LO}_U{UP}_{P0}.Genotypes.MarkerID.tsv", sep='\t')
-
-        # get genotype table statistics
-        marker_df, new_filtered_progs = genotype_table_stats(marker_df, G_info, "F2", kmer, LOD, SDL, SDU)
-        filtered_progs.union(new_filtered_progs)
-
-        # drop marker length (not used in F2's filtered table)
-        marker_df = marker_df.drop(columns=["MarkerLength"])
-
-        # extract necessary info for filtered table
-        if SEX == "male":
-            male_marker_df = marker_df
-            parents[0].append(G)
-        else:
-            female_marker_df = marker_df
-            parents[1].append(G)
-
-    # check if dataframes contain any sequences
-    if male_marker_df.empty or female_marker_df.empty:
+        marker_df, rows, in_bounds, progeny, new_filtered_progs = genotype_table_stats(G_info, "F2", kmer, LOD, SDL, SDU, plot_queue, ident_loci_df)
+        filtered_progs |= new_filtered_progs
+        codes_of = functools.partial(store_codes, f"AFLAP_tmp/04/F2/{G}_m{kmer}_L{LO}_U{UP}_{P0}.store", "F2", SEX)
+        tables.append((codes_of, SEX, rows, locus_rank[marker_df["Locus"].to_numpy(dtype=np.int64)], in_bounds, progeny))
+    if not any(len(rows) for _, _, rows, _, _, _ in tables):
         exit("An error occurred: There should be two marker tables for the female and male parent. To fix this, rerun 04_Genotyping.py.")
 
-    # concatenate all parents of same sex together
-    parents = ['_'.join(p) for p in parents]
+    # update the running code counts of all loci with progeny not counted before
+    progeny = list(dict.fromkeys(prog for *_, progs in tables for prog in progs if prog not in filtered_progs))
+    store_keys = [dict(zip(stores[G]["progeny"], stores[G]["count_keys"])) for G in stores]
+    prog_keys = [json.dumps([count_keys.get(prog, '') for count_keys in store_keys]) for prog in progeny]
+    state_key = artifact_key("f2_code_counts", ["AFLAP_Results/IdenticalLoci.txt"],
+                             {"markers": {G: [index["marker_key"], index["low_cov"]] for G, index in stores.items()}, "LOD": LOD})
+    counts = update_code_counts(f"AFLAP_tmp/05/{parents[0]}x{parents[1]}_F2_m{kmer}.CodeCounts.npz", state_key,
+                                [(codes_of, rows, loci, progs) for codes_of, _, rows, loci, _, progs in tables], progeny, prog_keys, num_loci)
+
+    # keep loci with markers within frequency bounds and, if necessary, filter out sequences by XX frequency
+    if xx_filter is None: print("XX Filter not specified. Using the 0.75 quantile of all XX Frequency values as a filter...")
+    kept, frequencies, keep = select_f2_loci(counts, [(sex, loci[in_bounds]) for _, sex, _, loci, in_bounds, _ in tables], len(progeny), xx_filter)
+
+    # create frequency stats and filtered genotype tables
+    write_f2_tables(loci_df, [(codes_of, rows, loci, in_bounds, progs) for codes_of, _, rows, loci, in_bounds, progs in tables],
+                    kept, frequencies, keep, progeny, stats_tsv, filtered_tsv)
+    store_artifact(stats_tsv, key)
+    store_artifact(filtered_tsv, key)
+    print("Finished creating F2 filtered genotype table.")
 
-    # remove LOD-filtered progeny from male and female dataframes
-    for df in [male_marker_df, female_marker_df]: df = df.drop(columns=list(filtered_progs))
-
-    # combine dataframes to make filtered F2 dataframe
-    comb_marker_df = pd.concat([male_marker_df, female_marker_df], ignore_index=True)
-    comb_marker_df = comb_marker_df.groupby(["MarkerSequence", "MarkerID"], as_index=False).agg({col: agg_function for col in comb_marker_df.columns[2:]})
-    replace_dict = {'A': 'AA', 'B': 'BB', 'X': 'XX', 'AX': 'AA', 'XB': 'BB'}
-    comb_marker_df[comb_marker_df.columns[2:].tolist()] = comb_marker_df[comb_marker_df.columns[2:].tolist()].replace(replace_dict)
-
-    # get sequence statistics
-    freq_df = pd.DataFrame()
-    freq_cols = list()
-    for val in ['XX', 'AA', 'BB', 'AB']:
-        freq_cols.append(pd.Series(comb_marker_df.iloc[:, 2:].astype(str).eq(val).sum(axis=1).div(comb_marker_df.shape[1] - 2), name=f"{val} Frequency"))
-    freq_df = pd.concat(freq_cols, axis=1)
-    comb_marker_df = pd.concat([comb_marker_df, freq_df], axis=1)
-
-    # if necessary, filter out sequences by XX frequency
-    if xx_filter is not None: comb_marker_df = comb_marker_df[comb_marker_df["XX Frequency"].astype(float) <= xx_filter]
-    else:
-        print("XX Filter not specified. Using median of all XX Frequency values as a filter...")
-        comb_marker_df = comb_marker_df[comb_marker_df["XX Frequency"].astype(float) <= comb_marker_df["XX Frequency"].astype(float).quantile(0.75)]
+def sweep_points(low_covs:list, SDLs:list, SDUs:list, xx_filters:list)->list:
+    # every combination of filter values, numbered from 1 in this order (LowCov outermost, so its calls are derived once)
+    return list(itertools.product(low_covs, SDLs, SDUs, xx_filters))
 
-    # create frequency stats table
-    freq_stats_df = comb_marker_df[["MarkerSequence", "MarkerID", "XX Frequency", "AA Frequency", "BB Frequency", "AB Frequency"]]
-    freq_stats_df.to_csv(f"AFLAP_tmp/05/{parents[0]}x{parents[1]}_F2_m{kmer}.FilteredFrequencyStats.tsv", sep='\t', index=False)
-    comb_marker_df = comb_marker_df.drop(columns=["XX Frequency", "AA Frequency", "BB Frequency", "AB Frequency"])
+def write_sweep_summary(summary:list, summary_tsv:str)->None:
+    pd.DataFrame(summary).to_csv(summary_tsv, sep='\t', index=False)
+    print(f"\tSweep summary written to {summary_tsv}.")
 
-    # create filtered genotype table
-    comb_marker_df.to_csv(f"AFLAP_tmp/05/{parents[0]}x{parents[1]}_F2_m{kmer}.Genotypes.MarkerID.Filtered.tsv", sep='\t', index=False)
-    print("Finished creating F2 filtered genotype table.")
+def count_calls(counts:np.ndarray, low_cov:int, columns:np.ndarray=None)->np.ndarray:
+    # how many progeny (all, or those in columns) have each marker called at low_cov, read in chunks of marker rows
+    called = np.zeros(counts.shape[0], dtype=np.int64)
+    for start, end in iter_chunks(counts.shape[0], counts.shape[1]):
+        calls = counts[start:end] >= low_cov
+        called[start:end] = (calls if columns is None else calls[:, columns]).sum(axis=1)
+    return called
+
+def sweep_f1(kmer:int, LOD:int, points:list, export_points:list)->None:
+    summary = list()
+    for G_info in get_LA_info():
+        G, LO, UP, P0, SEX = G_info
+
+        # read the parent's counts once for all points
+        store_dir = f"AFLAP_tmp/04/F1/{G}_m{kmer}_L{LO}_U{UP}_{P0}.store"
+        marker_df, rows, index = parent_markers(store_dir, "F1", G, SEX)
+        num_progs = len(index["progeny"])
+        if not num_progs: exit("An error occurred: Invalid number of progeny.")
+        print(f"Sweeping {len(points)} filter settings over {len(rows)} markers and {num_progs} F1 progeny of {G}...")
+        counts = load_store(store_dir)[2]
+        dropped = progeny_stats(store_dir, index)["K-mer Coverage"].to_numpy() < LOD
+        columns = np.flatnonzero(~dropped)
+
+        current = None
+        for point, (low_cov, SDL, SDU, xx_filter) in enumerate(points, 1):
+            low_cov = index["low_cov"] if low_cov is None else low_cov
+            if current is None or current[0] != low_cov:
+                # marker frequencies of all progeny and presence counts of the progeny kept at this LowCov
+                current = (low_cov, count_calls(counts, low_cov) / num_progs, count_calls(counts, low_cov, columns))
+            _, frequency, present = current
+
+            in_bounds = (frequency >= SDL) & (frequency <= SDU)
+            num_markers, num_present = int(in_bounds.sum()), int(present[in_bounds].sum())
+            num_cells = num_markers * len(columns)
+            summary.append({"Point": point, "Parent": G, "LowCov": low_cov, "SDL": SDL, "SDU": SDU, "fXX": xx_filter,
+                            "Markers": num_markers, "Progeny": len(columns), "Progeny Dropped": int(dropped.sum()),
+                            "Absent": num_cells - num_present, "Present": num_present, "Present Rate": num_present / max(num_cells, 1)})
+
+            if point not in export_points: continue
+            os.makedirs(f"AFLAP_tmp/05/Sweep/Point{point}", exist_ok=True)
+            kept_rows = rows[in_bounds]
+            code_chunks = ((start, end, (counts[np.ix_(kept_rows[start:end], columns)] >= low_cov).astype(np.int8))
+                           for start, end in iter_chunks(len(kept_rows), len(columns)))
+            write_code_chunks(f1_marker_ids(marker_df[in_bounds]), code_chunks, [index["progeny"][i] for i in columns],
+                              f"AFLAP_tmp/05/Sweep/Point{point}/{G}_F1_m{kmer}_L{LO}_U{UP}_{P0}.Genotypes.MarkerID.Filtered.tsv")
+            print(f"\tF1 genotype table of {G} for point {point} written to AFLAP_tmp/05/Sweep/Point{point}.")
+
+    write_sweep_summary(summary, f"AFLAP_Results/F1_m{kmer}.SegStatsSweep.tsv")
+
+def sweep_f2(kmer:int, LOD:int, points:list, export_points:list)->None:
+    parents = [[], []]
+    if not os.path.exists("AFLAP_Results/IdenticalLoci.txt"):
+        exit("An error occurred: AFLAP_Results/IdenticalLoci.txt not found. Rerun 03_ObtainMarkers.py.")
+    ident_loci_df = pd.read_csv("AFLAP_Results/IdenticalLoci.txt", sep='\t', dtype={"Locus Sequence": str, "Locus Sequence ID": str})
+    locus_rank, loci_df = rank_loci(ident_loci_df)
+    num_loci = len(loci_df.index)
+
+    # open the counts of all parents once for all points
+    stores = list()
+    dropped_progs = set()
+    for G, LO, UP, P0, SEX in get_LA_info():
+        store_dir = f"AFLAP_tmp/04/F2/{G}_m{kmer}_L{LO}_U{UP}_{P0}.store"
+        marker_df, rows, index = parent_markers(store_dir, "F2", G, SEX, ident_loci_df)
+        if not index["progeny"]: exit("An error occurred: Invalid number of progeny.")
+        mc_df = progeny_stats(store_dir, index)
+        dropped_progs |= set(mc_df.loc[mc_df["K-mer Coverage"] < LOD, "Prog"])
+        stores.append((SEX, index, rows, locus_rank[marker_df["Locus"].to_numpy(dtype=np.int64)], load_store(store_dir)[2]))
+        parents[0 if SEX == "male" else 1].append(G)
+    if not parents[0] or not parents[1]:
+        exit("An error occurred: There should be two marker tables for the female and male parent. To fix this, rerun 04_Genotyping.py.")
+    parents = ['_'.join(p) for p in parents]
+    progeny = list(dict.fromkeys(prog for _, index, *_ in stores for prog in index["progeny"] if prog not in dropped_progs))
+    print(f"Sweeping {len(points)} filter settings over {num_loci} loci and {len(progeny)} F2 progeny of {parents[0]}x{parents[1]}...")
+
+    summary = list()
+    current = None
+    for point, (low_cov, SDL, SDU, xx_filter) in enumerate(points, 1):
+        if current is None or current[0] != low_cov:
+            # calls, marker frequencies and the code counts of every locus at this LowCov
+            tables = list()
+            for sex, index, rows, loci, counts in stores:
+                call_cov = index["low_cov"] if low_cov is None else low_cov
+                code = np.int8(F2_A if sex == "male" else F2_B)
+                codes_of = lambda r, c, counts=counts, call_cov=call_cov, code=code: (counts[np.ix_(r, c)] >= call_cov).astype(np.int8) * code
+                tables.append((codes_of, sex, rows, loci, count_calls(counts, call_cov)[rows] / len(index["progeny"]), index["progeny"]))
+            locus_counts = np.zeros((num_loci, len(F2_GENOTYPES)), dtype=np.int64)
+            for start, end, comb_codes in iter_f2_codes([(codes_of, rows, loci, progs) for codes_of, _, rows, loci, _, progs in tables], progeny, num_loci):
+                locus_counts[start:end] = code_counts(comb_codes, len(F2_GENOTYPES))
+            current = (low_cov, tables, locus_counts)
+        _, tables, counts = current
+
+        in_bounds = [(frequency >= SDL) & (frequency <= SDU) for *_, frequency, _ in tables]
+        kept, frequencies, keep = select_f2_loci(counts, [(sex, loci[ib]) for (_, sex, _, loci, _, _), ib in zip(tables, in_bounds)], len(progeny), xx_filter)
+        totals = np.rint(frequencies[keep].sum(axis=0) * len(progeny)).astype(np.int64)
+        summary.append({"Point": point, "Cross": f"{parents[0]}x{parents[1]}", "LowCov": stores[0][1]["low_cov"] if low_cov is None else low_cov,
+                        "SDL": SDL, "SDU": SDU, "fXX": xx_filter, "Markers": int(keep.sum()), "Progeny": len(progeny), "Progeny Dropped": len(dropped_progs),
+                        **{val: int(total) for val, total in zip(F2_GENOTYPES, totals)}, "XX Rate": totals[F2_XX] / max(int(totals.sum()), 1)})
+
+        if point not in export_points: continue
+        point_dir = f"AFLAP_tmp/05/Sweep/Point{point}"
+        os.makedirs(point_dir, exist_ok=True)
+        write_f2_tables(loci_df, [(codes_of, rows, loci, ib, progs) for (codes_of, _, rows, loci, _, progs), ib in zip(tables, in_bounds)],
+                        kept, frequencies, keep, progeny, f"{point_dir}/{parents[0]}x{parents[1]}_F2_m{kmer}.FilteredFrequencyStats.tsv",
+                        f"{point_dir}/{parents[0]}x{parents[1]}_F2_m{kmer}.Genotypes.MarkerID.Filtered.tsv")
+        print(f"\tF2 filtered genotype table for point {point} written to {point_dir}.")
+
+    write_sweep_summary(summary, f"AFLAP_Results/{parents[0]}x{parents[1]}_F2_m{kmer}.SegStatsSweep.tsv")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='ObtainSegStats', description='A script to plot marker distributions in progeny.')
@@ -201,18 +428,43 @@ if __name__ == "__main__":
     parser.add_argument('-d', '--SDL', type=float, default=0.2, help='Lower boundary for marker cut off. Can be used to filter for segregation distortion. Default [0.2].')
     parser.add_argument('-D', '--SDU', type=float, default=0.8, help='Upper boundary for marker cut off. Can be used to filter for segregation distortion. Default [0.8].')
     parser.add_argument('-f', '--fXX', type=float, default=None, help='Limit for how many XX can exist in a row. If surpassed then sequence is not considered for analysis. Default [None].')
+    parser.add_argument('--no-plots', action='store_true', help='Do not render coverage and segregation plots.')
+    parser.add_argument('--chunk-mem', type=str, default="1G", help='Memory used to hold a chunk of marker rows while genotype tables are filtered (e.g. 512M). Default [1G].')
+    parser.add_argument('-x', '--LowCov', type=int, default=None, help='Minimum count of a marker call when sweeping without --sweep-LowCov. Default [LowCov of the genotype stores].')
+    parser.add_argument('--sweep-SDL', type=float, nargs='+', default=None, help='Lower boundaries to sweep instead of filtering the tables. Default [SDL].')
+    parser.add_argument('--sweep-SDU', type=float, nargs='+', default=None, help='Upper boundaries to sweep instead of filtering the tables. Default [SDU].')
+    parser.add_argument('--sweep-fXX', type=float, nargs='+', default=None, help='XX limits to sweep instead of filtering the tables. Default [fXX].')
+    parser.add_argument('--sweep-LowCov', type=int, nargs='+', default=None, help='Minimum marker counts of a call to sweep instead of filtering the tables. Default [LowCov].')
+    parser.add_argument('--sweep-export', type=int, nargs='+', default=[], help='Sweep points whose filtered tables are written to AFLAP_tmp/05/Sweep/Point<n>. Default [None].')
     args = parser.parse_args()
+    configure_chunk_mem(parse_mem(args.chunk_mem))
 
     # create directory
     os.makedirs("AFLAP_tmp/05", exist_ok=True)
 
+    # evaluate grids of filter settings instead of filtering the tables
+    if any(grid is not None for grid in [args.sweep_SDL, args.sweep_SDU, args.sweep_fXX, args.sweep_LowCov]):
+        points = sweep_points(args.sweep_LowCov or [args.LowCov], args.sweep_SDL or [args.SDL], args.sweep_SDU or [args.SDU], args.sweep_fXX or [args.fXX])
+        print(f"Sweeping {len(points)} filter settings...")
+        for f_type in ["F1", "F2"]:
+            if not has_progeny(f_type):
+                print(f"No {f_type} progeny found. Skipping.")
+                continue
+            if f_type == "F1": sweep_f1(args.kmer, args.LOD, points, set(args.sweep_export))
+            else:              sweep_f2(args.kmer, args.LOD, points, set(args.sweep_export))
+        exit(0)
+
     # analyze all parents whom we can create a genetic map for
     print("Performing segment statistics analysis...")
     list_of_Gs = get_LA_info()
+    plot_queue = PlotQueue(not args.no_plots)
     for f_type in ["F1", "F2"]:
-        if not len(os.listdir(f"AFLAP_tmp/01/{f_type}Count")):
+        if not has_progeny(f_type):
             print(f"No {f_type} progeny found. Skipping.")
             continue
 
-        if f_type == "F1": filter_f1(args.kmer, args.LOD, args.SDL, args.SDU)
-        else:              filter_f2(args.kmer, args.LOD, args.SDL, args.SDU, args.fXX)
+        if f_type == "F1": filter_f1(args.kmer, args.LOD, args.SDL, args.SDU, plot_queue)
+        else:              filter_f2(args.kmer, args.LOD, args.SDL, args.SDU, plot_queue, args.fXX)
+
+    # wait for plots to finish rendering
+    plot_queue.close()
@@ -1,70 +1,57 @@
 import argparse
 import os
-import pandas as pd
 
+from artifact_cache import artifact_key, read_key, store_artifact
+from genotype_store import configure_chunk_mem
 from get_LA_info import get_LA_info
+from get_prog_info import has_progeny
+from lepmap_export import LEPMAP_DATA, genotype_table, lepmap_file, open_lepmap, header_progeny, f1_lepmap, f2_lepmap, write_lepmap
+from task_graph import parse_mem
 
 #################################################
 #       A shell script to export the genotype table to LepMap3.
+#       Filtered tables are streamed in chunks of marker rows sized by --chunk-mem into a tsv or gzip file,
+#       or, with --lepmap-data pipe, left for 07_LepMap3.py to stream into LepMap3 directly.
 #################################################
 
-def create_f1_forlepmap(kmer:int)->None:
+def is_up_to_date(forlepmap_file:str, key:str)->bool:
+    return os.path.exists(forlepmap_file) and read_key(forlepmap_file) == key
+
+def create_f1_forlepmap(kmer:int, data:str, reduced:bool)->None:
     for G_info in get_LA_info():
         G, LO, UP, P0, SEX = G_info
         print(f"Working on F1 progeny from parent {G}...")
 
-        forlepmap_file = f"AFLAP_Results/{G}_F1_m{kmer}_L{LO}_U{UP}_{P0}.ForLepMap3.tsv"
+        forlepmap_file = lepmap_file(f"{G}_F1_m{kmer}_L{LO}_U{UP}_{P0}", data)
 
         # determine male and female parent
         if SEX == "male":     male, female = G, P0
         elif SEX == "female": male, female = P0, G
 
         # get info from filtered genotype table
-        filtered_tsv = f"AFLAP_tmp/05/{G}_F1_m{kmer}_L{LO}_U{UP}_{P0}.Genotypes.MarkerID.Filtered.tsv"
+        filtered_tsv = genotype_table(f"{G}_F1_m{kmer}_L{LO}_U{UP}_{P0}", reduced)
         if (not os.path.exists(filtered_tsv)):
-            exit(f"An error occurred: Filtered {filtered_tsv} file not found. Rerun 05_ObtainSegStats.py.")
-        ftsv_df = pd.read_csv(filtered_tsv, sep='\t')
-        ftsv_df.insert(0, "MarkerLoc", ftsv_df["MarkerID"].astype(str))
-        ftsv_df = ftsv_df.drop(["MarkerID"], axis=1)
-
-        # add columns for male and female parents
-        if SEX == "male":
-            ftsv_df.insert(2, "Male Parent", 1)
-            ftsv_df.insert(3, "Female Parent", 0)
-        elif SEX == "female":
-            ftsv_df.insert(2, "Male Parent", 0)
-            ftsv_df.insert(3, "Female Parent", 1)
-
-        ftsv_df = ftsv_df.replace([0, 1, 2], ['1 0 0 0 0 0 0 0 0 0', '0 1 0 0 0 0 0 0 0 0', '0 0 0 0 1 0 0 0 0 0'], regex=False)
-
-        # create lepmap header
-        data = [["CHR", "POS", f"{male}x{female}", f"{male}x{female}"],
-                ["CHR", "POS", male              , female            ],
-                ["CHR", "POS", '0'               , '0'               ],
-                ["CHR", "POS", '0'               , '0'               ],
-                ["CHR", "POS", '1'               , '2'               ],
-                ["CHR", "POS", '0'               , '0'               ]]
-        lepmap_df = pd.DataFrame(data)
-
-        # put all progeny of parent into header
-        prog_df = pd.read_csv(f"AFLAP_tmp/Pedigree_F1.txt", sep='\t')
-        prog_df = prog_df[(prog_df["MP"].astype(str).isin(male.split('_'))) | (prog_df["FP"].astype(str).isin(female.split('_')))]
-        included_progs = set(ftsv_df.columns[4:])
-        for prog in prog_df["Individual"].unique():
-            if prog in included_progs:
-                added_data = pd.Series([f"{male}x{female}", prog, male, female, '0', '0'])
-                lepmap_df = pd.concat([lepmap_df, added_data], axis=1)
-
-        # create lepmap data file
-        ftsv_df = ftsv_df.set_axis(list(lepmap_df.columns), axis=1)
-        lepmap_df = pd.concat([lepmap_df, ftsv_df], ignore_index=True)
-        lepmap_df.to_csv(forlepmap_file, sep='\t', header=False, index=False)
+            exit(f"An error occurred: Filtered {filtered_tsv} file not found. Rerun {'AFLAP.py with -U' if reduced else '05_ObtainSegStats.py'}.")
+        if data == "pipe":
+            print(f"\tF1 genotype table for {G} will be streamed into LepMap3 by 07_LepMap3.py.")
+            continue
+        # skip tables which have not changed since they were exported
+        progeny = header_progeny("F1", male, female, filtered_tsv, 2)
+        key = artifact_key("lepmap3", [filtered_tsv], {"male": male, "female": female, "progeny": progeny})
+        if is_up_to_date(forlepmap_file, key):
+            print(f"\tF1 LepMap3 tsv file for {G} is up to date. Skipping.")
+            continue
+
+        # create lepmap data file from the pedigree header and the posteriors of the genotype codes
+        with open_lepmap(forlepmap_file, data) as out:
+            write_lepmap(out, f1_lepmap(male, female, SEX, filtered_tsv, progeny))
 
         if not os.path.exists(forlepmap_file):
             exit(f"An error occurred: F1 tsv file for {G} has not been created.")
+        store_artifact(forlepmap_file, key)
         print(f"\tCompleted making an F1 LepMap3 tsv file for {G}.")
 
-def create_f2_forlepmap(kmer:int)->None:
+def create_f2_forlepmap(kmer:int, data:str, reduced:bool)->None:
     male = list()
     female = list()
     for G, _, _, _, SEX in get_LA_info():
@@ -73,60 +60,45 @@ def create_f2_forlepmap(kmer:int)->None:
     male = '_'.join(male)
     female = '_'.join(female)
 
-    forlepmap_file = f"AFLAP_Results/{male}x{female}_F2_m{kmer}.ForLepMap3.tsv"
+    forlepmap_file = lepmap_file(f"{male}x{female}_F2_m{kmer}", data)
 
     # get info from filtered genotype table
-    filtered_tsv = f"AFLAP_tmp/05/{male}x{female}_F2_m{kmer}.Genotypes.MarkerID.Filtered.tsv"
+    filtered_tsv = genotype_table(f"{male}x{female}_F2_m{kmer}", reduced)
     if (not os.path.exists(filtered_tsv)):
-        exit(f"An error occurred: Filtered {filtered_tsv} file not found. Rerun 05_ObtainSegStats.py.")
-    ftsv_df = pd.read_csv(filtered_tsv, sep='\t')
-    ftsv_df = ftsv_df.iloc[:, [1, 0] + list(range(2, ftsv_df.shape[1]))]
-
-    # add columns for male and female parents (F0 and F1)
-    ftsv_df.insert(2, "Male F0 Parent", 'AA')
-    ftsv_df.insert(3, "Female F0 Parent", 'BB')
-    ftsv_df.insert(4, "Male F1 Parent", 'AB')
-    ftsv_df.insert(5, "Female F1 Parent", 'AB')
-
-    # replace genotype table values to their chromosome data equivalents
-    ftsv_df = ftsv_df.replace(['XX', 'AA', 'BB', 'AB'], ['0.33 0.33 0 0 0.33 0 0 0 0 0', '1 0 0 0 0 0 0 0 0 0', '0 0 0 0 1 0 0 0 0 0', '0 1 0 0 0 0 0 0 0 0'], regex=False)
-
-    # create lepmap header
-    data = [["CHR", "POS", f"{male}x{female}" , f"{male}x{female}", f"{male}x{female}", f"{male}x{female}"],
-            ["CHR", "POS", male               , female            , "DUM1"            , "DUM2"            ],
-            ["CHR", "POS", '0'                , '0'               , male              , male              ],
-            ["CHR", "POS", '0'                , '0'               , female            , female            ],
-            ["CHR", "POS", '1'                , '2'               , '1'               , '2'               ],
-            ["CHR", "POS", '0'                , '0'               , '0'               , '0'               ]]
-    lepmap_df = pd.DataFrame(data)
-
-    # put all progeny into header
-    prog_df = pd.read_csv(f"AFLAP_tmp/Pedigree_F2.txt", sep='\t')
-    prog_df = prog_df[(prog_df["MP"].astype(str).isin(male.split('_'))) | (prog_df["FP"].astype(str).isin(female.split('_')))]
-    included_progs = set(ftsv_df.columns[6:])
-    for prog in prog_df["Individual"].unique():
-        if prog in included_progs:
-            added_data = pd.Series([f"{male}x{female}", prog, "DUM1", "DUM2", '0', '0'])
-            lepmap_df = pd.concat([lepmap_df, added_data], axis=1)
-
-    # create lepmap data file
-    ftsv_df = ftsv_df.set_axis(list(lepmap_df.columns), axis=1)
-    lepmap_df = pd.concat([lepmap_df, ftsv_df], ignore_index=True)
-    lepmap_df.to_csv(forlepmap_file, sep='\t', header=False, index=False)
+        exit(f"An error occurred: Filtered {filtered_tsv} file not found. Rerun {'AFLAP.py with -U' if reduced else '05_ObtainSegStats.py'}.")
+    if data == "pipe":
+        print(f"\tF2 genotype table for {male}x{female} will be streamed into LepMap3 by 07_LepMap3.py.")
+        return
+
+    # skip the table if it has not changed since it was exported
+    progeny = header_progeny("F2", male, female, filtered_tsv, 2)
+    key = artifact_key("lepmap3", [filtered_tsv], {"male": male, "female": female, "progeny": progeny})
+    if is_up_to_date(forlepmap_file, key):
+        print(f"\tF2 LepMap3 tsv file for {male}x{female} is up to date. Skipping.")
+        return
+
+    # create lepmap data file from the pedigree header and the posteriors of the genotype codes
+    with open_lepmap(forlepmap_file, data) as out:
+        write_lepmap(out, f2_lepmap(male, female, filtered_tsv, progeny))
 
     if not os.path.exists(forlepmap_file):
         exit(f"An error occurred: F2 tsv file for {male}x{female} has not been created.")
+    store_artifact(forlepmap_file, key)
     print(f"\tCompleted making an F2 LepMap3 tsv file for {male}x{female}.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='ExportToLepMap3', description="A script to export the genotype table to LepMap3.")
     parser.add_argument('-m', '--kmer', type=int, default=31, help='K-mer size. Default [31].')
+    parser.add_argument('--lepmap-data', choices=LEPMAP_DATA, default="tsv", help='Write LepMap3 data as a tsv file, a gzip-compressed tsv file, or nothing and let 07_LepMap3.py stream it into LepMap3 (pipe). Default [tsv].')
+    parser.add_argument('--reduced', action='store_true', help='Export the tables of marker bin representatives written for -U/--Max instead of the filtered tables.')
+    parser.add_argument('--chunk-mem', type=str, default="1G", help='Memory used to hold a chunk of marker rows while tables are converted (e.g. 512M). Default [1G].')
     args = parser.parse_args()
+    configure_chunk_mem(parse_mem(args.chunk_mem))
 
     for f_type in ["F1", "F2"]:
-        if not len(os.listdir(f"AFLAP_tmp/01/{f_type}Count")):
+        if not has_progeny(f_type):
             print(f"No {f_type} progeny found. Skipping.")
             continue
 
-        if f_type == "F1": create_f1_forlepmap(args.kmer)
-        else:              create_f2_forlepmap(args.kmer)
+        if f_type == "F1": create_f1_forlepmap(args.kmer, args.lepmap_data, args.reduced)
+        else:              create_f2_forlepmap(args.kmer, args.lepmap_data, args.reduced)
@@ -1,46 +1,79 @@
 import argparse
-import glob
+import functools
 import pandas as pd
 import os
 import multiprocessing as mp
 import subprocess
 
+from artifact_cache import artifact_key, read_key, store_artifact
+from genotype_store import configure_chunk_mem
 from get_LA_info import get_LA_info
+from get_prog_info import has_progeny
+from lepmap_export import LEPMAP_DATA, genotype_table, lepmap_file, stream_lepmap
+from task_graph import parse_mem
 
 #################################################
 #       A Python script to run LepMap3 and produce a genetic map which can be aligned to a genome assembly.
+#       LepMap3 reads its data from the ForLepMap3 tsv file, from the decompressed gzip file or, with --lepmap-data pipe,
+#       from the filtered genotype table streamed into its standard input (data=-).
+#       Results are keyed by the LepMap3 data or genotype table they were made from, and runs on the reduced tables of -U/--Max are kept under their own names.
 #################################################
 
-def run_sc2(lodfile:str, loderr:str, forlepmap_file:str, LOD:int, parent_header:str, num_threads:int)->None:
-    if os.path.exists(lodfile):
+def run_module(cmd:str, data:str, source, stdout, stderr)->None:
+    # source is the ForLepMap3 file, or for pipe a function writing the LepMap3 data to a binary stream
+    if data == "tsv":
+        subprocess.run(args=f"{cmd} data={source}", stdout=stdout, stderr=stderr, shell=True)
+    elif data == "gzip":
+        subprocess.run(args=f"zcat {source} | {cmd} data=-", stdout=stdout, stderr=stderr, shell=True, executable="/bin/bash")
+    else:
+        proc = subprocess.Popen(args=f"{cmd} data=-", stdin=subprocess.PIPE, stdout=stdout, stderr=stderr, shell=True)
+        try:
+            source(proc.stdin)
+        except BrokenPipeError:
+            pass
+        finally:
+            try: proc.stdin.close()
+            except BrokenPipeError: pass
+            proc.wait()
+
+def run_sc2(lodfile:str, loderr:str, data:str, source, LOD:int, parent_header:str, num_threads:int, data_file:str)->None:
+    key = artifact_key("SeparateChromosomes2", [data_file], {"LOD": LOD})
+    if os.path.exists(lodfile) and read_key(lodfile) == key:
         print(f"\tPrevious {LOD}-score results for {parent_header} detected. Skipping.")
         return
 
     with open(lodfile, 'w') as sc2_stdout, open(loderr, 'w') as sc2_stderr:
-        subprocess.run(args=f"java -cp $CONDA_PREFIX/bin/lepmap3/ SeparateChromosomes2 lodLimit={LOD} numThreads={num_threads} data={forlepmap_file}",
-                       stdout=sc2_stdout, stderr=sc2_stderr, shell=True)
+        run_module(f"java -cp $CONDA_PREFIX/bin/lepmap3/ SeparateChromosomes2 lodLimit={LOD} numThreads={num_threads}", data, source, sc2_stdout, sc2_stderr)
+    store_artifact(lodfile, key)
 
-def run_om2(txt_header:str, LOD:int, lg:int, outfile:str, errfile:str)->None:
+def run_om2(lodfile:str, data:str, source, lg:int, outfile:str, errfile:str, key:str)->None:
     with open(outfile, 'w') as outf, open(errfile, 'w') as errf:
-        subprocess.run(args=f"java -cp $CONDA_PREFIX/bin/lepmap3/ OrderMarkers2 useMorgan=1 numMergeIterations=20 chromosome={lg} map=AFLAP_Results/LOD{LOD}/{txt_header}.LOD{LOD}.txt data=AFLAP_Results/{txt_header}.ForLepMap3.tsv",
-                       stdout=outf, stderr=errf, shell=True)
+        run_module(f"java -cp $CONDA_PREFIX/bin/lepmap3/ OrderMarkers2 useMorgan=1 numMergeIterations=20 chromosome={lg} map={lodfile}", data, source, outf, errf)
+    store_artifact(outfile, key)
     print(f"\tAnalysis of linkage group {lg} complete.")
 
-def run_lepmap(parent_header:str, txt_header:str, f_type:str, num_threads:int, LOD:int, SEX:str=None, num_LGs:int=None)->None:
-    # check if tsv file for G exists
-    forlepmap_file = f"AFLAP_Results/{txt_header}.ForLepMap3.tsv"
-    if not os.path.exists(forlepmap_file):
-        exit(f"An error occurred: LepMap-ready genotype table for {parent_header} not found. Rerun 06_ExportToLepMap3.py.")
+def run_lepmap(parent_header:str, txt_header:str, f_type:str, num_threads:int, LOD:int, data:str, male:str, female:str, reduced:bool=False, SEX:str=None, num_LGs:int=None)->None:
+    # check if the LepMap3 data for G exists (piped data is streamed from the filtered genotype table)
+    filtered_tsv = genotype_table(txt_header, reduced)
+    if data == "pipe":
+        if not os.path.exists(filtered_tsv):
+            exit(f"An error occurred: {filtered_tsv} not found. Rerun 05_ObtainSegStats.py.")
+        source = functools.partial(stream_lepmap, f_type=f_type, male=male, female=female, SEX=SEX, filtered_tsv=filtered_tsv)
+    else:
+        source = lepmap_file(txt_header, data)
+        if not os.path.exists(source):
+            exit(f"An error occurred: LepMap-ready genotype table for {parent_header} not found. Rerun 06_ExportToLepMap3.py.")
 
     # begin LepMap3 analysis
     print(f"Initiating LepMap3 analysis on {f_type} progeny of {parent_header}...")
     print(f"\tWarning: If running an analysis on F2 populations, note that the program will run continuously until at least {num_LGs} linkage groups are found.")
+    lod_header = f"{txt_header}.Reduced" if reduced else txt_header
     while True:
         os.makedirs(f"AFLAP_Results/LOD{LOD}/{f_type}", exist_ok=True)
-        lodfile = f"AFLAP_Results/LOD{LOD}/{f_type}/{txt_header}.LOD{LOD}.txt"
-        loderr = f"AFLAP_Results/LOD{LOD}/{f_type}/{txt_header}.LOD{LOD}.stderr"
+        lodfile = f"AFLAP_Results/LOD{LOD}/{f_type}/{lod_header}.LOD{LOD}.txt"
+        loderr = f"AFLAP_Results/LOD{LOD}/{f_type}/{lod_header}.LOD{LOD}.stderr"
         # run LepMap3 - SeparateChromosomes2
-        run_sc2(lodfile, loderr, forlepmap_file, LOD, parent_header, num_threads)
+        run_sc2(lodfile, loderr, data, source, LOD, parent_header, num_threads, filtered_tsv if data == "pipe" else source)
         with open(lodfile, 'r') as flod: sc2_results = set(int(line.strip()) for line in flod.readlines() if not (line.strip().startswith('#')))
         # stop analysis if requirements satisfied
         if f_type == "F1" or len(sc2_results) >= num_LGs:
@@ -74,12 +107,13 @@ def run_lepmap(parent_header:str, txt_header:str, f_type:str, num_threads:int, L
     # process linkage groups
     om2_processes = list()
     for lg in lg_set:
-        if os.path.exists(f"AFLAP_Results/LOD{LOD}/{f_type}/{txt_header}.LOD{LOD}.LG{lg}.txt"):
+        om2_stdout = f"AFLAP_Results/LOD{LOD}/{f_type}/{lod_header}.LOD{LOD}.LG{lg}.txt"
+        om2_key = artifact_key("OrderMarkers2", [lodfile], {"chromosome": lg})
+        if os.path.exists(om2_stdout) and read_key(om2_stdout) == om2_key:
             print(f"\tAnalysis of linkage group {lg} detected. Skipping.")
         else:
-            om2_stdout = f"AFLAP_Results/LOD{LOD}/{f_type}/{txt_header}.LOD{LOD}.LG{lg}.txt"
-            om2_stderr = f"AFLAP_Results/LOD{LOD}/{f_type}/{txt_header}.LOD{LOD}.LG{lg}.stderr"
-            p = mp.Process(target=run_om2, args=(txt_header, LOD, lg, om2_stdout, om2_stderr))
+            om2_stderr = f"AFLAP_Results/LOD{LOD}/{f_type}/{lod_header}.LOD{LOD}.LG{lg}.stderr"
+            p = mp.Process(target=run_om2, args=(lodfile, data, source, lg, om2_stdout, om2_stderr, om2_key))
             p.start()
             om2_processes.append(p)
     for p in om2_processes:
@@ -87,26 +121,35 @@ def run_lepmap(parent_header:str, txt_header:str, f_type:str, num_threads:int, L
     print("Linkage group ordering complete.")
 
     # get row indices of marker sequences (used filtered genotype table as reference)
-    filtered_tsv = f"AFLAP_tmp/05/{txt_header}.Genotypes.MarkerID.Filtered.tsv"
     if not os.path.exists(filtered_tsv):
         exit(f"An error occurred: {filtered_tsv} not found. Rerun 05_ExportToLepMap3.py")
     markerid_df = pd.read_csv(filtered_tsv, sep='\t', usecols=["MarkerSequence", "MarkerID"])
     markerid_df["RowIndex"] = markerid_df.index + 1
 
-    # identify linkage groups to marker sequences
+    # identify linkage groups to marker sequences (only those of the current SeparateChromosomes2 result)
     lg_df = pd.DataFrame()
-    for glob_path in glob.glob(f"AFLAP_Results/LOD{LOD}/{f_type}/{txt_header}.LOD{LOD}.LG*.txt"):
+    for lg in sorted(lg_set):
+        lg_path = f"AFLAP_Results/LOD{LOD}/{f_type}/{lod_header}.LOD{LOD}.LG{lg}.txt"
+        if not os.path.exists(lg_path): continue
         if SEX == "male":     COLS_USED, COL_NAMES = [0, 1], ["RowIndex", "Position"]
         elif SEX == "female": COLS_USED, COL_NAMES = [0, 2], ["RowIndex", "Position"]
         ## note: above 2 conditions may not pass since SEX F1-specific
         else:                 COLS_USED, COL_NAMES = [0, 1, 2], ["RowIndex", "Male Position", "Female Position"]
-        lg_info = pd.read_csv(glob_path, sep='\t', names=COL_NAMES, skiprows=3, usecols=COLS_USED)
-        lg_info['LG'] = glob_path.removeprefix(f"AFLAP_Results/LOD{LOD}/{f_type}/{txt_header}.LOD{LOD}.LG").removesuffix(".txt")
+        lg_info = pd.read_csv(lg_path, sep='\t', names=COL_NAMES, skiprows=3, usecols=COLS_USED)
+        lg_info['LG'] = str(lg)
 
         lg_df = lg_info if (lg_df.empty) else pd.concat([lg_df, lg_info])
 
     joined_df = pd.merge(markerid_df, lg_df, on="RowIndex", how='inner')
-    joined_df.to_csv(f"AFLAP_Results/{txt_header}.LOD{LOD}.txt", sep='\t', index=False)
+    joined_df.to_csv(f"AFLAP_Results/{lod_header}.LOD{LOD}.txt", sep='\t', index=False)
+
+    # place every marker of a kept bin at the position of its representative
+    if reduced:
+        bins_df = pd.read_csv(f"AFLAP_Results/{txt_header}.MarkerBins.tsv", sep='\t', dtype={"MarkerID": str, "Representative": str})
+        rep_df = joined_df.drop(columns=["MarkerSequence", "RowIndex"]).rename(columns={"MarkerID": "Representative"})
+        rep_df["Representative"] = rep_df["Representative"].astype(str)
+        binned_df = pd.merge(bins_df[["MarkerSequence", "MarkerID", "Representative", "Distance"]], rep_df, on="Representative", how='inner')
+        binned_df.to_csv(f"AFLAP_Results/{lod_header}.LOD{LOD}.Binned.txt", sep='\t', index=False)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='LepMap3', description='A script to run LepMap3 and produce a genetic map which can be aligned to a genome assembly.')
@@ -114,13 +157,17 @@ if __name__ == "__main__":
     parser.add_argument('-t', '--threads', type=int, default=4, help='Threads for JELLYFISH counting. Default [4].')
     parser.add_argument('-L', '--LOD', type=int, default=2, help='LOD score - Will run LepMap3 with minimum LOD. Default [2].')
     parser.add_argument('-n', '--nLG', type=int, default=10, help='Minimum number of linkage groups needed to continue F2 LepMap3 analysis. Default [10].')
+    parser.add_argument('--lepmap-data', choices=LEPMAP_DATA, default="tsv", help='Read LepMap3 data from the tsv file, the gzip-compressed tsv file, or stream it from the filtered genotype tables (pipe). Default [tsv].')
+    parser.add_argument('--reduced', action='store_true', help='Run LepMap3 on the tables of marker bin representatives written for -U/--Max and place all binned markers.')
+    parser.add_argument('--chunk-mem', type=str, default="1G", help='Memory used to hold a chunk of marker rows while tables are streamed into LepMap3 (e.g. 512M). Default [1G].')
     args = parser.parse_args()
+    configure_chunk_mem(parse_mem(args.chunk_mem))
 
     if not os.environ.get("CONDA_PREFIX"):
         exit("An error occurred: $CONDA_PREFIX does not exist. Activate conda and ensure the AFLAP.yml environment is satisfied.")
 
     for f_type in ["F1", "F2"]:
-        if not len(os.listdir(f"AFLAP_tmp/01/{f_type}Count")):
+        if not has_progeny(f_type):
             print(f"No {f_type} progeny found. Skipping.")
             continue
 
@@ -128,7 +175,8 @@ if __name__ == "__main__":
             for G, LO, UP, P0, SEX in get_LA_info():
                 parent_header = G
                 txt_header = f"{G}_F1_m{args.kmer}_L{LO}_U{UP}_{P0}"
-                run_lepmap(parent_header, txt_header, f_type, args.threads, args.LOD, SEX=SEX)
+                male, female = (G, P0) if SEX == "male" else (P0, G)
+                run_lepmap(parent_header, txt_header, f_type, args.threads, args.LOD, args.lepmap_data, male, female, args.reduced, SEX=SEX)
         else:
             male = list()
             female = list()
@@ -140,4 +188,4 @@ if __name__ == "__main__":
 
             parent_header = f"{male}x{female}"
             txt_header = f"{parent_header}_F2_m{args.kmer}"
-            run_lepmap(parent_header, txt_header, f_type, args.threads, args.LOD, num_LGs=args.nLG)
+            run_lepmap(parent_header, txt_header, f_type, args.threads, args.LOD, args.lepmap_data, male, female, args.reduced, num_LGs=args.nLG)
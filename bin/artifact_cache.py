@@ -0,0 +1,97 @@
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+
+#################################################
+#	Helper functions to reuse intermediate files based on their inputs rather than their existence.
+#	Every artifact is keyed by a digest of its input files, its parameters and the tool version, recorded in a "{artifact}.key" file.
+#	With a cache directory set, artifacts are also stored there under their key and linked into AFLAP_tmp, so other projects can reuse them.
+#################################################
+
+CHECKSUM_BLOCK = 16 * 1024 ** 2
+
+cache_dir = None
+checksum = False
+
+def configure_cache(directory:str=None, full_checksum:bool=False)->None:
+    global cache_dir, checksum
+    cache_dir = os.path.abspath(directory) if directory else None
+    checksum = full_checksum
+    if cache_dir: os.makedirs(cache_dir, exist_ok=True)
+
+@functools.lru_cache(maxsize=None)
+def tool_version(tool:str)->str:
+    try:
+        return subprocess.run(f"{tool} --version", shell=True, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+def read_key(path:str)->str:
+    key_file = f"{path}.key"
+    if not os.path.exists(key_file): return None
+    with open(key_file, 'r') as f:
+        return f.read().strip()
+
+def file_digest(path:str)->str:
+    # artifacts made through the cache are identified by their own key
+    key = read_key(path)
+    if key: return key
+
+    stat = os.stat(path)
+    if not checksum:
+        return f"{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK), b''):
+            digest.update(block)
+    return f"{stat.st_size}:{digest.hexdigest()}"
+
+def artifact_key(kind:str, inputs:list[str], params:dict)->str:
+    description = {"kind": kind, "inputs": [file_digest(path) for path in inputs], "params": params}
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+def cache_path(key:str)->str:
+    return os.path.join(cache_dir, key[:2], key)
+
+def link_file(src:str, dst:str)->None:
+    if os.path.lexists(dst): os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        os.symlink(src, dst)
+
+def fetch_artifact(path:str, key:str)->bool:
+    if os.path.exists(path) and os.path.getsize(path):
+        recorded = read_key(path)
+        if recorded == key: return True
+        # results from before keys were recorded are trusted once
+        if recorded is None:
+            print(f"\tNo input key recorded for {path}. Assuming it matches the current inputs.")
+            store_artifact(path, key)
+            return True
+        print(f"\tInputs of {path} have changed. Regenerating.")
+        os.remove(path)
+
+    if cache_dir and os.path.exists(cache_path(key)):
+        link_file(cache_path(key), path)
+        with open(f"{path}.key", 'w') as f: f.write(key)
+        print(f"\t{path} linked from the cache.")
+        return True
+    # the artifact is made again as a new file, so a link into the cache is never written through
+    if os.path.lexists(path): os.remove(path)
+    return False
+
+def store_artifact(path:str, key:str)->None:
+    with open(f"{path}.key", 'w') as f: f.write(key)
+    if not cache_dir or os.path.exists(cache_path(key)): return
+
+    os.makedirs(os.path.dirname(cache_path(key)), exist_ok=True)
+    tmp_path = f"{cache_path(key)}.tmp{os.getpid()}"
+    try:
+        os.link(path, tmp_path)
+    except OSError:
+        shutil.copy2(path, tmp_path)
+    os.replace(tmp_path, cache_path(key))
@@ -1,13 +1,141 @@
+import numpy as np
+import os
 import pandas as pd
 
-# TODO: create 2 separate dataframes by parent and compare them to find equivalent locus sequences
+from kmer_set import unpack_kmers
 
-def find_identical_loci(mp_seqs:pd.DataFrame, fp_seqs:pd.DataFrame, mp:str, fp:str)->None:
-    # TODO: refactor if we can have more than one parent of same sex
-    mp_seqs = mp_seqs.rename(columns={"Sequence": "Male Sequence"})
-    fp_seqs = fp_seqs.rename(columns={"Sequence": "Female Sequence"})
-    comb_seqs = pd.merge(mp_seqs, fp_seqs, on="Locus Sequence", how='inner')
-    comb_seqs.to_csv(f"AFLAP_tmp/03/SimGroups/{mp}_and_{fp}_identical_loci.txt", sep='\t')
+#################################################
+#	Helper functions to store the loci of a parent's assembled fragments and to find loci shared between parents.
+#	Loci are kept in columns: fragment ID and length, the packed marker k-mer and the packed first and last k-1 bp of the fragment.
+#	All parents insert their loci once into a locus index sorted by a hash of the two packed locus ends,
+#	so the parents sharing each locus are found in one pass however many parents of each sex there are.
+#################################################
 
-# TESTING PURPOSES
-# if __name__ == "__main__":
+LOCUS_COLUMNS = ["frag_id", "frag_len", "sequence", "locus_left", "locus_right"]
+
+def save_loci(locus_file:str, loci:dict, kmer:int)->None:
+    # replaces rather than overwrites the file, as it may be linked from the cache
+    tmp_file = f"{locus_file}.tmp"
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, kmer=np.array([kmer]), **{col: loci[col] for col in LOCUS_COLUMNS})
+    os.replace(tmp_file, locus_file)
+
+def load_loci(locus_file:str)->dict:
+    with np.load(locus_file) as npz:
+        return {col: npz[col] for col in LOCUS_COLUMNS}
+
+def locus_hash(left:np.ndarray, right:np.ndarray)->np.ndarray:
+    # mixes both packed ends into one 64 bit key (collisions are resolved by comparing the ends)
+    with np.errstate(over='ignore'):
+        return (left * np.uint64(0x9E3779B97F4A7C15)) ^ (right + np.uint64(0x632BE59BD9B4E019) + (left >> np.uint64(17)))
+
+class LocusIndex:
+    def __init__(self, kmer:int):
+        # parents are stored once with their sex and the digest of the locus file they were inserted from
+        self.kmer = kmer
+        self.parents = list()
+        self.sexes = list()
+        self.digests = list()
+        self.entries = {col: np.zeros(0, dtype=np.uint64) for col in ["hash", "parent"] + LOCUS_COLUMNS}
+
+    @classmethod
+    def load(cls, index_file:str, kmer:int):
+        index = cls(kmer)
+        if not os.path.exists(index_file): return index
+        with np.load(index_file) as npz:
+            if int(npz["kmer"][0]) != kmer: return index
+            index.parents = npz["parents"].tolist()
+            index.sexes = npz["sexes"].tolist()
+            index.digests = npz["digests"].tolist()
+            index.entries = {col: npz[col] for col in index.entries}
+        return index
+
+    def save(self, index_file:str)->None:
+        tmp_file = f"{index_file}.tmp"
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, kmer=np.array([self.kmer]), parents=np.array(self.parents, dtype=str),
+                     sexes=np.array(self.sexes, dtype=str), digests=np.array(self.digests, dtype=str), **self.entries)
+        os.replace(tmp_file, index_file)
+
+    def digest(self, parent:str)->str:
+        return self.digests[self.parents.index(parent)] if parent in self.parents else None
+
+    def remove(self, parent:str)->None:
+        if parent not in self.parents: return
+        p = self.parents.index(parent)
+        keep = self.entries["parent"] != p
+        self.entries = {col: values[keep] for col, values in self.entries.items()}
+        self.entries["parent"][self.entries["parent"] > p] -= np.uint64(1)
+        del self.parents[p], self.sexes[p], self.digests[p]
+
+    def insert(self, parent:str, sex:str, loci:dict, digest:str)->None:
+        # replaces any loci the parent inserted before, then merges the new loci into the sorted entries
+        self.remove(parent)
+        self.parents.append(parent)
+        self.sexes.append(sex)
+        self.digests.append(digest)
+        new = {col: np.asarray(loci[col]).astype(np.uint64) for col in LOCUS_COLUMNS}
+        new["hash"] = locus_hash(new["locus_left"], new["locus_right"])
+        new["parent"] = np.full(len(new["hash"]), len(self.parents) - 1, dtype=np.uint64)
+        entries = {col: np.concatenate((self.entries[col], new[col])) for col in self.entries}
+        order = np.lexsort((entries["locus_right"], entries["locus_left"], entries["hash"]))
+        self.entries = {col: values[order] for col, values in entries.items()}
+
+    def groups(self)->np.ndarray:
+        # group number of every entry (entries of one locus are adjacent as they are sorted by hash and ends)
+        if not len(self.entries["hash"]): return np.zeros(0, dtype=np.int64)
+        new_group = (np.diff(self.entries["hash"]) != 0) | (np.diff(self.entries["locus_left"]) != 0) | \
+                    (np.diff(self.entries["locus_right"]) != 0)
+        return np.concatenate(([0], np.cumsum(new_group)))
+
+    def shared_pairs(self, first_sex:str, second_sex:str)->tuple[np.ndarray, np.ndarray]:
+        # every combination of an entry of a first_sex parent and an entry of a second_sex parent at the same locus
+        sexes = np.array(self.sexes, dtype=str)
+        entry_sex = sexes[self.entries["parent"].astype(np.int64)] if len(sexes) else np.zeros(0, dtype=str)
+        groups = self.groups()
+        first = np.flatnonzero(entry_sex == first_sex)
+        second = np.flatnonzero(entry_sex == second_sex)
+
+        # expand every first entry into the second entries of its locus
+        num_groups = int(groups[-1]) + 1 if len(groups) else 0
+        second_count = np.bincount(groups[second], minlength=num_groups)
+        second_start = np.cumsum(second_count) - second_count
+        num_hits = second_count[groups[first]]
+        first_idx = np.repeat(first, num_hits)
+        offsets = np.arange(num_hits.sum()) - np.repeat(np.cumsum(num_hits) - num_hits, num_hits)
+        second_idx = second[np.repeat(second_start[groups[first]], num_hits) + offsets]
+        return first_idx, second_idx
+
+def update_locus_index(index_file:str, locus_files:dict, kmer:int, digest)->LocusIndex:
+    # locus_files maps each parent to its (sex, locus file); only parents whose locus file changed are reinserted
+    index = LocusIndex.load(index_file, kmer)
+    for parent in list(index.parents):
+        if parent not in locus_files: index.remove(parent)
+    for parent, (sex, locus_file) in locus_files.items():
+        locus_digest = digest(locus_file)
+        if index.digest(parent) == locus_digest: continue
+        print(f"\tAdding loci of {parent} to the locus index...")
+        index.insert(parent, sex, load_loci(locus_file), locus_digest)
+    index.save(index_file)
+    return index
+
+def find_identical_loci(index:LocusIndex, kmer:int)->pd.DataFrame:
+    # one row per male and female parent combination sharing a locus, ordered by male parent and locus
+    mp_idx, fp_idx = index.shared_pairs("male", "female")
+    entries = index.entries
+    order = np.lexsort((entries["parent"][fp_idx], entries["frag_id"][mp_idx], entries["parent"][mp_idx]))
+    mp_idx, fp_idx = mp_idx[order], fp_idx[order]
+
+    parents = np.array(index.parents, dtype=str) if index.parents else np.zeros(0, dtype=str)
+    parent_name = lambda idx: parents[entries["parent"][idx].astype(np.int64)]
+    seq_id = lambda idx: pd.Series(entries["frag_id"][idx]).astype(str) + '_' + pd.Series(entries["frag_len"][idx]).astype(str)
+    comb_seqs = pd.DataFrame({"Male Parent": parent_name(mp_idx),
+                              "Male Sequence": unpack_kmers(entries["sequence"][mp_idx], kmer),
+                              "Male Sequence ID": seq_id(mp_idx),
+                              "Female Parent": parent_name(fp_idx),
+                              "Female Sequence": unpack_kmers(entries["sequence"][fp_idx], kmer),
+                              "Female Sequence ID": seq_id(fp_idx),
+                              "Locus Sequence": pd.Series(unpack_kmers(entries["locus_left"][mp_idx], kmer - 1)) + '|' +
+                                                pd.Series(unpack_kmers(entries["locus_right"][mp_idx], kmer - 1))})
+    comb_seqs["Locus Sequence ID"] = [f"F2_{i}" for i in range(len(comb_seqs.index))]
+    return comb_seqs
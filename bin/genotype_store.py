@@ -0,0 +1,231 @@
+import json
+import numpy as np
+import os
+import pandas as pd
+import shutil
+
+#################################################
+#	Helper functions to keep a parent's marker counts and calls for all of its progeny in one on-disk matrix store.
+#	A store is a directory holding markers x progeny matrices in column order, so the column of one progeny is contiguous:
+#	counts.u16 (uint16 counts), calls.bits (calls bit-packed along markers), present.u32 (calls per marker),
+#	summary.u32 (per progeny: its marker count and a histogram of its marker counts), markers.tsv and index.json (progeny names and input keys).
+#	New progeny are appended as new columns, and the per-marker call sums are updated with them.
+#	Stages 04 and 05 memory-map the matrices; genotype TSVs are only written on request.
+#	Genotypes leave the store as int8 codes, which are only turned into strings by the writers.
+#	Matrices are decoded and written in chunks of marker rows, so memory use is bounded by the chunk memory and not by the number of markers.
+#################################################
+
+COUNT_MAX = np.iinfo(np.uint16).max
+SUMMARY_BINS = 1001   # coverage histogram bins of 0 to 999 and a last bin for counts of 1000 and above
+CELL_BYTES = 32       # working memory per genotype cell while a chunk is decoded and formatted as text
+
+chunk_mem = 1024 ** 3
+
+# genotype codes
+F1_ABSENT, F1_PRESENT = 0, 1
+F2_X, F2_A, F2_B = 0, 1, 2                  # markers of one parent: absent, present from the male, present from the female parent
+F2_XX, F2_AA, F2_BB, F2_AB = 0, 1, 2, 3     # loci of both parents: the sum of the male and female codes
+PARENT_GENOTYPES = np.array(['X', 'A', 'B'])
+F2_GENOTYPES = np.array(['XX', 'AA', 'BB', 'AB'])
+
+def configure_chunk_mem(mem:int)->None:
+    global chunk_mem
+    chunk_mem = mem
+
+def chunk_rows(num_cols:int)->int:
+    # rows of a num_cols wide matrix that fit into the chunk memory
+    return max(1, chunk_mem // (max(1, num_cols) * CELL_BYTES))
+
+def iter_chunks(num_rows:int, num_cols:int):
+    # yields (start, end) of consecutive row chunks
+    step = chunk_rows(num_cols)
+    for start in range(0, num_rows, step):
+        yield start, min(start + step, num_rows)
+
+def write_count_column(count_file:str, counts:np.ndarray)->None:
+    # one progeny's marker counts, saturated at the uint16 maximum
+    tmp_file = f"{count_file}.tmp"
+    np.minimum(counts, COUNT_MAX).astype(np.uint16).tofile(tmp_file)
+    os.replace(tmp_file, count_file)
+
+def read_count_column(count_file:str, num_markers:int)->np.ndarray:
+    counts = np.fromfile(count_file, dtype=np.uint16)
+    if len(counts) != num_markers:
+        exit(f"An error occurred: {count_file} holds {len(counts)} of {num_markers} marker counts. Rerun 04_Genotyping.py with the count step.")
+    return counts
+
+def read_marker_file(marker_file:str)->pd.DataFrame:
+    with open(marker_file, 'r') as f:
+        lines = [line.strip() for line in f if line.strip()]
+    heads, seqs = lines[0::2], lines[1::2]
+    if len(heads) != len(seqs) or not all(head.startswith('>') for head in heads):
+        exit(f"An error occurred: {marker_file} not extracted properly. Make sure every marker pairs with a sequence.")
+    markers = pd.DataFrame({"MarkerSequence": seqs, "MarkerID": [head[1:] for head in heads]})
+    markers[["MarkerID", "MarkerLength"]] = markers["MarkerID"].str.split('_', n=1, expand=True)
+    markers["MarkerLength"] = markers["MarkerLength"].astype(int)
+    return markers
+
+def count_markers(marker_file:str)->int:
+    # number of marker records, without loading their sequences
+    with open(marker_file, 'r') as f:
+        return sum(1 for line in f if line.startswith('>'))
+
+def read_store_index(store_dir:str)->dict:
+    index_file = os.path.join(store_dir, "index.json")
+    if not os.path.exists(index_file): return None
+    with open(index_file, 'r') as f:
+        return json.load(f)
+
+def write_store_index(store_dir:str, index:dict)->None:
+    # the index is replaced last, so it only ever lists columns that are complete on disk
+    tmp_file = os.path.join(store_dir, "index.json.tmp")
+    with open(tmp_file, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_file, os.path.join(store_dir, "index.json"))
+
+def read_present(store_dir:str, index:dict)->np.ndarray:
+    # running sum of calls per marker over all progeny in the store
+    # (the file starts with the number of columns it sums; an append interrupted before its index was written leaves complete
+    # call columns the index does not list yet, whose calls are taken off again)
+    present_file = os.path.join(store_dir, "present.u32")
+    num_progs = len(index["progeny"])
+    present = np.fromfile(present_file, dtype=np.uint32) if os.path.exists(present_file) else np.zeros(0, dtype=np.uint32)
+    if len(present) != index["markers"] + 1 or present[0] < num_progs:
+        exit(f"An error occurred: Genotype store {store_dir} is incomplete. Delete it and rerun 04_Genotyping.py.")
+    column_bytes = (index["markers"] + 7) // 8
+    for column in range(num_progs, int(present[0])):
+        calls = np.fromfile(os.path.join(store_dir, "calls.bits"), dtype=np.uint8, count=column_bytes, offset=column * column_bytes)
+        present[1:] -= unpack_calls(calls, index["markers"]).astype(np.uint32)
+    return present[1:]
+
+def progeny_summary(counts:np.ndarray, calls:np.ndarray)->np.ndarray:
+    # marker count of one progeny followed by the histogram of its marker counts
+    histogram = np.bincount(np.minimum(counts, SUMMARY_BINS - 1), minlength=SUMMARY_BINS)
+    return np.concatenate(([calls.sum()], histogram)).astype(np.uint32)
+
+def read_summary(store_dir:str, index:dict)->tuple[np.ndarray, np.ndarray]:
+    # marker counts and coverage histograms (progeny x SUMMARY_BINS) of all progeny in the store
+    num_progs = len(index["progeny"])
+    summary_file = os.path.join(store_dir, "summary.u32")
+    if not os.path.exists(summary_file) or os.path.getsize(summary_file) < num_progs * (SUMMARY_BINS + 1) * 4:
+        exit(f"An error occurred: Genotype store {store_dir} is incomplete. Delete it and rerun 04_Genotyping.py.")
+    summary = np.fromfile(summary_file, dtype=np.uint32, count=num_progs * (SUMMARY_BINS + 1)).reshape(num_progs, SUMMARY_BINS + 1)
+    return summary[:, 0], summary[:, 1:]
+
+def write_columns(store_dir:str, index:dict, progeny:list, count_files:list, count_keys:list)->dict:
+    # appends count and call columns and progeny summaries to the store and adds the calls to the running sums
+    num_markers = index["markers"]
+    num_progs = len(index["progeny"])
+    present = read_present(store_dir, index).astype(np.uint32)
+    count_path, call_path = os.path.join(store_dir, "counts.u16"), os.path.join(store_dir, "calls.bits")
+    summary_path = os.path.join(store_dir, "summary.u32")
+    for path, column_bytes in [(count_path, num_markers * 2), (call_path, (num_markers + 7) // 8), (summary_path, (SUMMARY_BINS + 1) * 4)]:
+        # drop anything an interrupted append left behind the indexed columns
+        with open(path, 'ab') as f: f.truncate(num_progs * column_bytes)
+    with open(count_path, 'ab') as fcount, open(call_path, 'ab') as fcall, open(summary_path, 'ab') as fsummary:
+        for count_file in count_files:
+            counts = read_count_column(count_file, num_markers)
+            calls = counts >= index["low_cov"]
+            fcount.write(counts.tobytes())
+            fcall.write(np.packbits(calls).tobytes())
+            fsummary.write(progeny_summary(counts, calls).tobytes())
+            present += calls
+    np.concatenate(([num_progs + len(count_files)], present)).astype(np.uint32).tofile(os.path.join(store_dir, "present.u32.tmp"))
+    os.replace(os.path.join(store_dir, "present.u32.tmp"), os.path.join(store_dir, "present.u32"))
+
+    index = dict(index, progeny=index["progeny"] + [str(prog) for prog in progeny], count_keys=index["count_keys"] + count_keys)
+    write_store_index(store_dir, index)
+    return index
+
+def build_store(store_dir:str, marker_file:str, marker_key:str, progeny:list, count_files:list, count_keys:list, low_cov:int)->dict:
+    # writes the store into a temporary directory and swaps it in, so a failed build leaves no partial store
+    markers = read_marker_file(marker_file)
+    tmp_dir = f"{store_dir}.tmp"
+    if os.path.exists(tmp_dir): shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    markers.to_csv(os.path.join(tmp_dir, "markers.tsv"), sep='\t', index=False)
+    index = {"markers": len(markers.index), "marker_key": marker_key, "low_cov": low_cov, "progeny": [], "count_keys": []}
+    # a new store has empty columns and summaries and no calls per marker
+    for name in ["counts.u16", "calls.bits", "summary.u32"]:
+        open(os.path.join(tmp_dir, name), 'wb').close()
+    np.zeros(len(markers.index) + 1, dtype=np.uint32).tofile(os.path.join(tmp_dir, "present.u32"))
+    index = write_columns(tmp_dir, index, progeny, count_files, count_keys)
+    if os.path.exists(store_dir): shutil.rmtree(store_dir)
+    os.replace(tmp_dir, store_dir)
+    return index
+
+def append_store(store_dir:str, index:dict, progeny:list, count_files:list, count_keys:list)->dict:
+    # adds new progeny to an existing store without rewriting the columns already in it
+    return write_columns(store_dir, index, progeny, count_files, count_keys)
+
+def load_store(store_dir:str)->tuple[dict, pd.DataFrame, np.ndarray, np.ndarray]:
+    # returns the index, the marker table, the counts (markers x progeny) and the packed calls ((markers + 7) // 8 x progeny)
+    index = read_store_index(store_dir)
+    if index is None:
+        exit(f"An error occurred: Genotype store {store_dir} not found. Rerun 04_Genotyping.py.")
+    markers = pd.read_csv(os.path.join(store_dir, "markers.tsv"), sep='\t', dtype={"MarkerID": str})
+    shape = (index["markers"], len(index["progeny"]))
+    packed_shape = ((index["markers"] + 7) // 8, len(index["progeny"]))
+    if not shape[0] or not shape[1]:
+        return index, markers, np.zeros(shape, dtype=np.uint16), np.zeros(packed_shape, dtype=np.uint8)
+    counts = np.memmap(os.path.join(store_dir, "counts.u16"), dtype=np.uint16, mode='r', shape=shape, order='F')
+    calls = np.memmap(os.path.join(store_dir, "calls.bits"), dtype=np.uint8, mode='r', shape=packed_shape, order='F')
+    return index, markers, counts, calls
+
+def unpack_calls(calls:np.ndarray, num_markers:int)->np.ndarray:
+    # markers x progeny matrix of 0/1 calls
+    return np.unpackbits(calls, axis=0, count=num_markers)
+
+def unpack_rows(calls:np.ndarray, rows:np.ndarray, columns:np.ndarray=None)->np.ndarray:
+    # 0/1 calls of the given marker rows and progeny columns, decoding only the bytes holding them
+    # (packbits stores the call of marker i in bit 7 - i % 8 of byte i // 8)
+    rows = np.asarray(rows, dtype=np.int64)
+    packed = calls[rows // 8] if columns is None else calls[np.ix_(rows // 8, columns)]
+    return (packed >> (7 - rows % 8).astype(np.uint8)[:, None]) & np.uint8(1)
+
+def code_counts(codes:np.ndarray, num_codes:int)->np.ndarray:
+    # markers x num_codes matrix of how many progeny have each code
+    rows = np.repeat(np.arange(codes.shape[0]), codes.shape[1])
+    return np.bincount(rows * num_codes + codes.ravel().astype(np.int64), minlength=codes.shape[0] * num_codes).reshape(-1, num_codes)
+
+def parent_markers(store_dir:str, f_type:str, G:str, sex:str, ident_loci_df:pd.DataFrame=None)->tuple[pd.DataFrame, np.ndarray, dict]:
+    # the marker table of a parent, the store row of each marker and the store index
+    # (F2 markers are renamed to the identical loci they belong to, so a marker can appear once per locus, and carry the row of their locus in ident_loci_df)
+    index = read_store_index(store_dir)
+    if index is None:
+        exit(f"An error occurred: Genotype store {store_dir} not found. Rerun 04_Genotyping.py.")
+    markers = pd.read_csv(os.path.join(store_dir, "markers.tsv"), sep='\t', dtype={"MarkerID": str})
+    markers = markers[["MarkerSequence", "MarkerID", "MarkerLength"]]
+    if f_type == "F1": return markers, np.arange(len(markers.index)), index
+
+    # fragment IDs are only unique within one parent
+    id_col_name = f"{sex.capitalize()} Sequence ID"
+    specific_loci_df = ident_loci_df.assign(Locus=np.arange(len(ident_loci_df.index)))
+    specific_loci_df = specific_loci_df.loc[specific_loci_df[f"{sex.capitalize()} Parent"].astype(str) == G, [id_col_name, "Locus Sequence", "Locus Sequence ID", "Locus"]]
+    specific_loci_df[id_col_name] = specific_loci_df[id_col_name].astype(str).str.split('_').str[0]
+
+    # merge marker rows with loci and replace marker ID with locus ID
+    marker_df = markers.assign(Row=np.arange(len(markers.index))).merge(specific_loci_df, left_on="MarkerID", right_on=id_col_name, how='inner')
+    rows = marker_df["Row"].to_numpy()
+    marker_df = pd.DataFrame({"MarkerSequence": marker_df["Locus Sequence"], "MarkerID": marker_df["Locus Sequence ID"],
+                              "MarkerLength": marker_df["MarkerLength"], "Locus": marker_df["Locus"]})
+    return marker_df, rows, index
+
+def store_codes(store_dir:str, f_type:str, sex:str, rows:np.ndarray, columns:np.ndarray=None)->np.ndarray:
+    # int8 genotype codes of the given store rows and columns (all progeny by default);
+    # F2 calls are coded F2_A for male and F2_B for female parents
+    _, _, _, calls = load_store(store_dir)
+    codes = unpack_rows(calls, rows, columns).astype(np.int8)
+    if f_type == "F1": return codes
+    return codes * np.int8(F2_A if sex == "male" else F2_B)
+
+def write_genotype_table(store_dir:str, f_type:str, G:str, sex:str, tsv_file:str, ident_loci_df:pd.DataFrame=None)->None:
+    # the genotype table of a parent as a tsv file written in chunks: calls are 0/1 for F1 and X/A or X/B for F2 progeny
+    marker_df, rows, index = parent_markers(store_dir, f_type, G, sex, ident_loci_df)
+    marker_df = marker_df[["MarkerSequence", "MarkerID", "MarkerLength"]].reset_index(drop=True)
+    pd.DataFrame(columns=list(marker_df.columns) + index["progeny"]).to_csv(tsv_file, sep='\t', index=False)
+    for start, end in iter_chunks(len(rows), len(index["progeny"])):
+        codes = store_codes(store_dir, f_type, sex, rows[start:end])
+        calls = codes if f_type == "F1" else PARENT_GENOTYPES[codes]
+        chunk_df = pd.concat([marker_df.iloc[start:end].reset_index(drop=True), pd.DataFrame(calls, columns=index["progeny"])], axis=1)
+        chunk_df.to_csv(tsv_file, sep='\t', index=False, header=False, mode='a')
@@ -0,0 +1,12 @@
+import os
+import pandas as pd
+
+def get_prog_info(f_type:str)->pd.DataFrame:
+    ped_file = f"AFLAP_tmp/Pedigree_{f_type}.txt"
+    if not os.path.exists(ped_file):
+        exit(f"An error occurred: {ped_file} not found. Rerun AFLAP.py")
+
+    return pd.read_csv(ped_file, sep='\t')
+
+def has_progeny(f_type:str)->bool:
+    return not get_prog_info(f_type).empty
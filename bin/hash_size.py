@@ -0,0 +1,73 @@
+import bz2
+import gzip
+import math
+import os
+
+from read_streams import read_format
+
+#################################################
+#	Helper functions to size JELLYFISH hashes from an individual's read files and a memory budget.
+#	Distinct k-mers are estimated as genome k-mers plus error k-mers (G + k * e * bases).
+#################################################
+
+ERROR_RATE = 0.01           # per-base error rate used to estimate error k-mers
+DEFAULT_COVERAGE = 30       # k-mer coverage assumed when no parental bounds are available
+COUNTER_BITS = 7            # jellyfish count -c default
+REPROBE_BITS = 7            # bits used to store the default 126 reprobes
+BLOOM_FPR = 0.01            # jellyfish bc -f default
+MIN_HASH_SIZE = 2 ** 20
+SAMPLE_BYTES = 16 * 1024 ** 2
+# approximate bases per byte of read file when no sampling is done
+FILESIZE_BASE_RATIO = {"bgzf": 1.6, "gz": 1.6, "bz2": 2.0, "zst": 1.6, "plain": 0.45}
+
+def estimate_bases(path:str, sample:bool=True)->int:
+    fmt = read_format(path)
+    file_size = os.path.getsize(path)
+    openers = {"bgzf": lambda raw: gzip.GzipFile(fileobj=raw), "gz": lambda raw: gzip.GzipFile(fileobj=raw),
+               "bz2": bz2.BZ2File, "plain": lambda raw: raw}
+    if not sample or fmt not in openers:
+        return int(file_size * FILESIZE_BASE_RATIO[fmt])
+
+    # decompress the start of the file and extrapolate bases per compressed byte
+    with open(path, 'rb') as raw:
+        fin = openers[fmt](raw)
+        bases = read_bytes = 0
+        fastq = None
+        for i, line in enumerate(fin):
+            if fastq is None: fastq = line.startswith(b'@')
+            read_bytes += len(line)
+            if (fastq and i % 4 == 1) or (not fastq and not line.startswith(b'>')):
+                bases += len(line.rstrip())
+            if read_bytes >= SAMPLE_BYTES: break
+        consumed = raw.tell()
+
+    if read_bytes < SAMPLE_BYTES or not consumed: return bases
+    return int(bases * file_size / consumed)
+
+def estimate_genome_size(bases:int, lo:float=None, up:float=None)->int:
+    if lo is None or up is None or math.isnan(lo) or math.isnan(up):
+        return bases // DEFAULT_COVERAGE
+    return int(bases / max((lo + up) / 2, 1))
+
+def estimate_distinct_kmers(bases:int, genome_size:int, kmer:int, singleton_filter:bool=False)->int:
+    # error k-mers are mostly singletons and are dropped by the bloom counter pre-pass
+    if singleton_filter: return int(genome_size * 1.25)
+    return min(bases, int(genome_size + kmer * ERROR_RATE * bases))
+
+def hash_bytes(size:int, kmer:int)->int:
+    size = 2 ** math.ceil(math.log2(max(size, 2)))
+    entry_bits = max(2 * kmer - int(math.log2(size)), 0) + REPROBE_BITS + COUNTER_BITS
+    return size * entry_bits // 8
+
+def bloom_bytes(size:int)->int:
+    # two bits per bloom counter entry record 0, 1 or 2+ occurrences
+    return int(-size * math.log(BLOOM_FPR) / math.log(2) ** 2) * 2 // 8
+
+def fit_hash_size(distinct:int, kmer:int, mem_budget:int)->int:
+    size = 2 ** math.ceil(math.log2(max(distinct, MIN_HASH_SIZE)))
+    while size > MIN_HASH_SIZE and hash_bytes(size, kmer) > mem_budget:
+        size //= 2
+    return size
+
+def fit_bloom_size(distinct:int, mem_budget:int)->int:
+    return max(min(distinct, int(mem_budget * 8 / 2 * math.log(2) ** 2 / -math.log(BLOOM_FPR))), MIN_HASH_SIZE)
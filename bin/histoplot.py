@@ -1,28 +1,17 @@
-from matplotlib import pyplot as plt
-import os
+import numpy as np
 
-def histoplot(infilepath:str, LO:int, HI:int, outfilepath:str)->None:
-    # check if file exists
-    if not os.path.exists(infilepath):
-        exit(f"An error occurred: {infilepath} not found.")
+from plots import get_pyplot
 
-    # get data
-    histo_x = histo_y = list()
-    with open(infilepath) as fin:
-        for line in fin:
-            line = line.strip().split()
-            histo_x.append(int(line[0]))
-            histo_y.append(int(line[1]))
+def read_histo(infilepath:str)->tuple[np.ndarray, np.ndarray]:
+    histo = np.loadtxt(infilepath, dtype=np.int64, ndmin=2)
+    return histo[:, 0], histo[:, 1]
+
+def histoplot(histo_x:np.ndarray, histo_y:np.ndarray, LO:int, HI:int, outfilepath:str)->None:
+    plt = get_pyplot()
 
     # find maximum y bound
-    max_y = 0
-    print(f"Length of histo_y: {len(histo_y)}")
-    print(f"LO: {LO}\nHI: {HI}")
-    if len(histo_y) < LO: max_y = max(histo_y)
-    else:
-        max_y = 0
-        for i in range(LO, HI + 1):
-            if max_y < histo_y[i]: max_y = histo_y[i]
+    in_bounds = (histo_x >= LO) & (histo_x <= HI)
+    max_y = histo_y[in_bounds].max() if in_bounds.any() else histo_y.max()
 
     # plot histogram
     plt.plot(histo_x, histo_y, 'k')
@@ -34,4 +23,4 @@ def histoplot(infilepath:str, LO:int, HI:int, outfilepath:str)->None:
 
     # create png
     plt.savefig(outfilepath)
-    plt.clf()
\ No newline at end of file
+    plt.clf()
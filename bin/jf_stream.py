@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import subprocess
+import time
+
+from kmer_set import pack_kmer_bytes
+
+#################################################
+#	Helper functions to stream the column output of JELLYFISH commands in typed chunks.
+#	Output is parsed incrementally, so memory does not grow with the number of k-mers.
+#	Dumps of whole hashes are parsed from raw byte blocks with numpy, packing k-mers without building a string per line.
+#	A command exiting with a non-zero code stops AFLAP rather than leaving an empty or truncated file behind.
+#	Progeny hashes can be queried by pool workers, which share a limit on how many hashes are loaded from disk at once.
+#################################################
+
+CHUNK_SIZE = 2 ** 20
+BLOCK_BYTES = 2 ** 24
+NEWLINE, SPACE, ZERO = ord('\n'), ord(' '), ord('0')
+
+io_slots = None
+
+def iter_jellyfish(cmd:str, chunksize:int=CHUNK_SIZE):
+    # yields (sequences, counts) arrays from "SEQ COUNT" lines
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, executable="/bin/bash")
+    try:
+        for chunk in pd.read_csv(proc.stdout, sep=' ', header=None, names=["Sequence", "Count"],
+                                 dtype={"Sequence": str, "Count": np.int64}, chunksize=chunksize):
+            yield chunk["Sequence"].to_numpy(), chunk["Count"].to_numpy()
+    except pd.errors.EmptyDataError:
+        pass
+    finally:
+        proc.stdout.close()
+        if proc.wait():
+            exit(f"An error occurred: '{cmd}' exited with code {proc.returncode}.")
+
+def parse_kmer_lines(buf:np.ndarray, kmer:int)->tuple[np.ndarray, np.ndarray]:
+    # packed k-mers and counts of a block of complete "SEQ COUNT" lines
+    ends = np.flatnonzero(buf == NEWLINE)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    if (ends - starts <= kmer + 1).any() or (buf[starts + kmer] != SPACE).any():
+        exit(f"An error occurred: Unexpected line in the JELLYFISH dump of {kmer}-mers.")
+    packed = pack_kmer_bytes(buf[starts[:, None] + np.arange(kmer)])
+
+    # counts are read right to left, one digit place at a time
+    widths = ends - starts - kmer - 1
+    counts = np.zeros(len(ends), dtype=np.int64)
+    for place in range(int(widths.max())):
+        has_digit = widths > place
+        counts[has_digit] += (buf[ends[has_digit] - 1 - place].astype(np.int64) - ZERO) * 10 ** place
+    return packed, counts
+
+def iter_jellyfish_kmers(cmd:str, kmer:int, blocksize:int=BLOCK_BYTES):
+    # yields (packed k-mers, counts) arrays from the "SEQ COUNT" lines of a jellyfish dump -c
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, executable="/bin/bash")
+    try:
+        rest = b''
+        while True:
+            block = proc.stdout.read(blocksize)
+            if not block: break
+            block = rest + block
+            complete = block.rfind(b'\n') + 1
+            rest = block[complete:]
+            if complete: yield parse_kmer_lines(np.frombuffer(block, dtype=np.uint8, count=complete), kmer)
+        if rest.strip(): yield parse_kmer_lines(np.frombuffer(rest.strip() + b'\n', dtype=np.uint8), kmer)
+    finally:
+        proc.stdout.close()
+        if proc.wait():
+            exit(f"An error occurred: '{cmd}' exited with code {proc.returncode}.")
+
+def query_jellyfish(fa_file:str, jf_file:str, chunksize:int=CHUNK_SIZE):
+    # yields (sequences, counts) of the k-mers in fa_file, in file order
+    yield from iter_jellyfish(f"jellyfish query -s {fa_file} {jf_file}", chunksize)
+
+def init_query_worker(slots)->None:
+    global io_slots
+    io_slots = slots
+
+def query_progeny(query_args:tuple)->tuple[str, np.ndarray, float, float, str]:
+    # pool worker: returns the counts, the wall time, the time spent waiting for an I/O slot and an error message if the query failed
+    prog, fa_file, jf_file, num_kmers = query_args
+    start = time.time()
+    try:
+        with io_slots:
+            waited = time.time() - start
+            counts = [chunk_counts for _, chunk_counts in query_jellyfish(fa_file, jf_file)]
+    except SystemExit as e:
+        return (prog, None, time.time() - start, 0.0, str(e.code))
+    except (OSError, ValueError) as e:
+        return (prog, None, time.time() - start, 0.0, str(e))
+    counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+    if len(counts) != num_kmers:
+        return (prog, None, time.time() - start, waited, f"Query returned {len(counts)} of {num_kmers} markers")
+    return (prog, counts, time.time() - start, waited, '')
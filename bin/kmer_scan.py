@@ -0,0 +1,72 @@
+import itertools
+import numpy as np
+import subprocess
+import time
+
+from kmer_set import BASE_CODES, check_packable, pack_kmers, canonical_kmers, scan_kmers
+from read_streams import decompress_command
+
+#################################################
+#	Helper functions to count marker k-mers directly from progeny reads without building a JELLYFISH hash.
+#	The canonical markers of all parents are loaded once into a sorted uint64 index, and each progeny's reads are streamed through it.
+#	Reads may be FASTQ or FASTA; k-mers spanning line breaks of multi-line FASTA records are not counted.
+#################################################
+
+CHUNK_READS = 16384
+
+marker_index = np.zeros(0, dtype=np.uint64)
+
+def read_fasta_seqs(fa_file:str)->list[str]:
+    with open(fa_file, 'r') as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('>')]
+
+def build_marker_index(marker_seqs:list[list[str]], kmer:int)->np.ndarray:
+    check_packable(kmer)
+    packed = [canonical_kmers(pack_kmers(seqs, kmer), kmer) for seqs in marker_seqs]
+    return np.unique(np.concatenate(packed)) if packed else np.zeros(0, dtype=np.uint64)
+
+def marker_positions(markers:np.ndarray, seqs:list[str], kmer:int)->np.ndarray:
+    return np.searchsorted(markers, canonical_kmers(pack_kmers(seqs, kmer), kmer))
+
+def count_chunk(lines:list[bytes], fastq:bool, markers:np.ndarray, counts:np.ndarray, kmer:int)->None:
+    seqs = lines[1::4] if fastq else [line for line in lines if not line.startswith(b'>')]
+    # reads are joined with an N so no k-mer spans two reads
+    codes = BASE_CODES[np.frombuffer(b'N'.join(seq.rstrip() for seq in seqs), dtype=np.uint8)]
+    canon = scan_kmers(codes, kmer)
+
+    idx = np.searchsorted(markers, canon)
+    idx[idx == len(markers)] = 0
+    hit = markers[idx] == canon
+    np.add.at(counts, idx[hit], 1)
+
+def scan_reads(paths:list[str], markers:np.ndarray, kmer:int)->np.ndarray:
+    counts = np.zeros(len(markers), dtype=np.uint32)
+    if not len(markers): return counts
+
+    for path in paths:
+        proc = subprocess.Popen(decompress_command(path), shell=True, stdout=subprocess.PIPE)
+        fastq = None
+        while True:
+            lines = list(itertools.islice(proc.stdout, 4 * CHUNK_READS))
+            if not lines: break
+            if fastq is None: fastq = lines[0].startswith(b'@')
+            count_chunk(lines, fastq, markers, counts, kmer)
+        proc.stdout.close()
+        if proc.wait():
+            raise RuntimeError(f"Decompression of {path} exited with code {proc.returncode}")
+
+    return counts
+
+def init_scan_worker(markers:np.ndarray)->None:
+    global marker_index
+    marker_index = markers
+
+def scan_progeny(scan_args:tuple)->tuple[str, np.ndarray, float, str]:
+    # pool worker: returns the counts, the wall time and an error message if the scan failed
+    prog, paths, kmer = scan_args
+    start = time.time()
+    try:
+        counts = scan_reads(paths, marker_index, kmer)
+    except (OSError, RuntimeError) as e:
+        return (prog, None, time.time() - start, str(e))
+    return (prog, counts, time.time() - start, '')
@@ -0,0 +1,119 @@
+import numpy as np
+
+#################################################
+#	Helper functions to handle k-mers 2-bit packed into uint64 values (A=0, C=1, G=2, T=3).
+#	Canonical k-mers are the smaller of a k-mer and its reverse complement, which matches the alphabetical choice made elsewhere in AFLAP.
+#	K-mer sets are stored as a 64 byte header (k, bounds, count, source digest) followed by a sorted uint64 array, so they can be memory-mapped.
+#################################################
+
+MAX_PACKED_KMER = 32
+FASTA_CHUNK = 2 ** 20
+
+KSET_MAGIC = b"AFLAPKS1"
+KSET_HEADER = np.dtype([("magic", "S8"), ("kmer", "<u4"), ("lo", "<u4"), ("up", "<u4"), ("reserved", "<u4"),
+                        ("count", "<u8"), ("digest", "u1", (32,))])   # raw digest bytes, as S32 would drop trailing NUL bytes
+
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for i, base in enumerate(b"ACGT"):
+    BASE_CODES[base] = i
+    BASE_CODES[base + 32] = i   # lowercase
+CODE_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+def check_packable(kmer:int)->None:
+    if int(kmer) > MAX_PACKED_KMER:
+        exit(f"An error occurred: K-mers longer than {MAX_PACKED_KMER} cannot be packed into 64 bits.")
+
+def pack_kmers(seqs, kmer:int)->np.ndarray:
+    if not len(seqs): return np.zeros(0, dtype=np.uint64)
+    return pack_kmer_bytes(np.frombuffer(''.join(seqs).encode(), dtype=np.uint8).reshape(-1, kmer))
+
+def pack_kmer_bytes(buf:np.ndarray)->np.ndarray:
+    # packs a k-mers x k matrix of ASCII bases
+    codes = BASE_CODES[buf]
+    if (codes > 3).any():
+        exit("An error occurred: Non-ACGT base found while packing k-mers.")
+
+    packed = np.zeros(len(buf), dtype=np.uint64)
+    for j in range(buf.shape[1]):
+        packed = (packed << np.uint64(2)) | codes[:, j].astype(np.uint64)
+    return packed
+
+def unpack_kmers(packed:np.ndarray, kmer:int)->np.ndarray:
+    out = np.empty((len(packed), kmer), dtype=np.uint8)
+    for j in range(kmer):
+        out[:, kmer - 1 - j] = CODE_BASES[(packed >> np.uint64(2 * j)) & np.uint64(3)]
+    return out.view(f"S{kmer}").ravel().astype(str)
+
+def reverse_complement(packed:np.ndarray, kmer:int)->np.ndarray:
+    comp = ~packed
+    rc = np.zeros(len(packed), dtype=np.uint64)
+    for j in range(kmer):
+        rc = (rc << np.uint64(2)) | ((comp >> np.uint64(2 * j)) & np.uint64(3))
+    return rc
+
+def canonical_kmers(packed:np.ndarray, kmer:int)->np.ndarray:
+    return np.minimum(packed, reverse_complement(packed, kmer))
+
+def scan_kmers(codes:np.ndarray, kmer:int)->np.ndarray:
+    # canonical k-mers of every window of base codes without an invalid (non-ACGT) base
+    n = len(codes) - kmer + 1
+    if n <= 0: return np.zeros(0, dtype=np.uint64)
+    invalid = np.concatenate(([0], np.cumsum(codes > 3)))
+    valid = (invalid[kmer:] - invalid[:-kmer]) == 0
+
+    codes = np.where(codes > 3, 0, codes).astype(np.uint64)
+    fw = np.zeros(n, dtype=np.uint64)
+    rc = np.zeros(n, dtype=np.uint64)
+    for j in range(kmer):
+        fw = (fw << np.uint64(2)) | codes[j:j + n]
+        rc |= (np.uint64(3) - codes[j:j + n]) << np.uint64(2 * j)
+    return np.minimum(fw, rc)[valid]
+
+def write_kmer_set(path:str, packed:np.ndarray, kmer:int, lo:int=0, up:int=0, digest:str='')->int:
+    # sorts and deduplicates the k-mers before writing them
+    packed = np.unique(np.asarray(packed, dtype=np.uint64))
+    header = np.zeros(1, dtype=KSET_HEADER)
+    header[0] = (KSET_MAGIC, kmer, lo, up, 0, len(packed), np.frombuffer(bytes.fromhex(digest)[:32].ljust(32, b'\0'), dtype=np.uint8))
+    with open(path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(packed.astype("<u8").tobytes())
+    return len(packed)
+
+def read_kmer_set_header(path:str)->dict:
+    header = np.fromfile(path, dtype=KSET_HEADER, count=1)
+    if not len(header) or header[0]["magic"] != KSET_MAGIC:
+        exit(f"An error occurred: {path} is not an AFLAP k-mer set.")
+    return {"kmer": int(header[0]["kmer"]), "lo": int(header[0]["lo"]), "up": int(header[0]["up"]),
+            "count": int(header[0]["count"]), "digest": header[0]["digest"].tobytes().hex() if header[0]["digest"].any() else ''}
+
+def kmer_set_count(path:str)->int:
+    return read_kmer_set_header(path)["count"]
+
+def load_kmer_set(path:str)->np.ndarray:
+    # k-mers are memory-mapped rather than read, so slicing a set only touches the pages needed
+    count = kmer_set_count(path)
+    if not count: return np.zeros(0, dtype=np.uint64)
+    return np.memmap(path, dtype="<u8", mode='r', offset=KSET_HEADER.itemsize, shape=(count,))
+
+def write_kmer_fasta(packed:np.ndarray, kmer:int, fa_file:str)->None:
+    # FASTA is only made for external tools, in chunks to bound memory
+    with open(fa_file, 'w') as ffa:
+        for start in range(0, len(packed), FASTA_CHUNK):
+            seqs = unpack_kmers(np.asarray(packed[start:start + FASTA_CHUNK]), kmer)
+            ffa.write(''.join(map(">{}\n{}\n".format, range(start, start + len(seqs)), seqs)))
+
+def kmer_set_isin(packed:np.ndarray, kset:np.ndarray)->np.ndarray:
+    # membership of k-mers in a sorted k-mer set by binary search, without sorting the set again
+    if not len(kset): return np.zeros(len(packed), dtype=bool)
+    idx = np.minimum(np.searchsorted(kset, packed), len(kset) - 1)
+    return np.asarray(kset[idx]) == packed
+
+def kmer_set_union(ksets:list)->np.ndarray:
+    if not ksets: return np.zeros(0, dtype=np.uint64)
+    return np.unique(np.concatenate([np.asarray(kset, dtype=np.uint64) for kset in ksets]))
+
+def kmer_set_difference(kset:np.ndarray, others:list)->np.ndarray:
+    # k-mers of a sorted set found in none of the other sorted sets
+    keep = np.ones(len(kset), dtype=bool)
+    for other in others: keep &= ~kmer_set_isin(kset, other)
+    return np.asarray(kset)[keep]
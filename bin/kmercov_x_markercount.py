@@ -1,13 +1,13 @@
-import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
 
-def plot_cov_and_mcount(mc:pd.DataFrame, outfile_name:str)->None:
-    x = mc["K-mer Coverage"]
-    y = mc["Marker Count"]
+from plots import get_pyplot
 
-    plt.scatter(x, y, c='k')
+def plot_cov_and_mcount(coverage:np.ndarray, marker_count:np.ndarray, outfile_name:str)->None:
+    plt = get_pyplot()
+
+    plt.scatter(coverage, marker_count, c='k')
     plt.xlabel("K-mer Coverage")
     plt.ylabel("Marker Count")
 
     plt.savefig(outfile_name)
-    plt.clf()
\ No newline at end of file
+    plt.clf()
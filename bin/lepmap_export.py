@@ -0,0 +1,78 @@
+import gzip
+import numpy as np
+import pandas as pd
+
+from genotype_store import F1_ABSENT, F1_PRESENT, F2_AA, F2_BB, F2_AB, chunk_rows
+
+#################################################
+#	Helper functions to write LepMap3 data files from the filtered genotype tables.
+#	The 6 pedigree lines are written first, then marker rows are streamed in chunks with each genotype code looked up in precomputed posterior strings.
+#	Output goes to a tsv file, a gzip-compressed tsv file or any binary stream such as the standard input of a LepMap3 module (data=-).
+#################################################
+
+# LepMap3 genotype posteriors indexed by genotype code
+F1_POSTERIORS = np.array(['1 0 0 0 0 0 0 0 0 0', '0 1 0 0 0 0 0 0 0 0', '0 0 0 0 1 0 0 0 0 0'])
+F2_POSTERIORS = np.array(['0.33 0.33 0 0 0.33 0 0 0 0 0', '1 0 0 0 0 0 0 0 0 0', '0 0 0 0 1 0 0 0 0 0', '0 1 0 0 0 0 0 0 0 0'])
+
+LEPMAP_DATA = ["tsv", "gzip", "pipe"]
+
+def genotype_table(txt_header:str, reduced:bool=False)->str:
+    # the filtered genotype table, or the table of bin representatives written by marker_reduction.py for -U/--Max
+    return f"AFLAP_tmp/05/{txt_header}.Genotypes.MarkerID.{'Reduced' if reduced else 'Filtered'}.tsv"
+
+def lepmap_file(txt_header:str, data:str)->str:
+    return f"AFLAP_Results/{txt_header}.ForLepMap3.tsv" + (".gz" if data == "gzip" else '')
+
+def open_lepmap(forlepmap_file:str, data:str):
+    return gzip.open(forlepmap_file, 'wb') if data == "gzip" else open(forlepmap_file, 'wb')
+
+def header_progeny(f_type:str, male:str, female:str, filtered_tsv:str, first_prog_col:int)->list:
+    # progeny of the parents in pedigree order which remain in the filtered genotype table
+    prog_df = pd.read_csv(f"AFLAP_tmp/Pedigree_{f_type}.txt", sep='\t')
+    prog_df = prog_df[(prog_df["MP"].astype(str).isin(male.split('_'))) | (prog_df["FP"].astype(str).isin(female.split('_')))]
+    included_progs = set(pd.read_csv(filtered_tsv, sep='\t', nrows=0).columns[first_prog_col:])
+    return [prog for prog in prog_df["Individual"].astype(str).unique() if prog in included_progs]
+
+def lepmap_header(columns:list)->str:
+    # the 6 pedigree lines (family, individual, father, mother, sex and phenotype) from one 6-tuple per column
+    columns = [("CHR",) * 6, ("POS",) * 6] + columns
+    return ''.join('\t'.join(column[line] for column in columns) + '\n' for line in range(6))
+
+def lepmap_rows(filtered_tsv:str, progeny:list, parent_codes:list, posteriors:np.ndarray):
+    # yields the marker lines of consecutive chunks of the filtered table: marker ID and sequence, parent posteriors and progeny posteriors
+    # (progeny columns are selected by name, as they follow the order in which progeny were added to the genotype stores)
+    parent_posteriors = '\t'.join(posteriors[parent_codes])
+    id_cols = ["MarkerID", "MarkerSequence"]
+    for ftsv_df in pd.read_csv(filtered_tsv, sep='\t', dtype={col: str for col in id_cols}, chunksize=chunk_rows(len(progeny) + len(parent_codes))):
+        ids = ftsv_df[id_cols].to_numpy(dtype=str)
+        codes = ftsv_df[progeny].to_numpy(dtype=np.int64)
+        yield ''.join('\t'.join((*marker, parent_posteriors, *calls)) + '\n' for marker, calls in zip(ids, posteriors[codes]))
+
+def f1_lepmap(male:str, female:str, SEX:str, filtered_tsv:str, progeny:list)->tuple[str, object]:
+    # the parent G carrying the markers is present, the other parent absent
+    family = f"{male}x{female}"
+    header = lepmap_header([(family, male, '0', '0', '1', '0'), (family, female, '0', '0', '2', '0')] +
+                           [(family, prog, male, female, '0', '0') for prog in progeny])
+    parent_codes = [F1_PRESENT, F1_ABSENT] if SEX == "male" else [F1_ABSENT, F1_PRESENT]
+    return header, lepmap_rows(filtered_tsv, progeny, parent_codes, F1_POSTERIORS)
+
+def f2_lepmap(male:str, female:str, filtered_tsv:str, progeny:list)->tuple[str, object]:
+    # F0 parents are AA and BB, and two dummy F1 parents are AB
+    family = f"{male}x{female}"
+    header = lepmap_header([(family, male, '0', '0', '1', '0'), (family, female, '0', '0', '2', '0'),
+                            (family, "DUM1", male, female, '1', '0'), (family, "DUM2", male, female, '2', '0')] +
+                           [(family, prog, "DUM1", "DUM2", '0', '0') for prog in progeny])
+    return header, lepmap_rows(filtered_tsv, progeny, [F2_AA, F2_BB, F2_AB, F2_AB], F2_POSTERIORS)
+
+def write_lepmap(out, lepmap:tuple[str, object])->None:
+    # writes the header and then every chunk of marker lines to a binary stream
+    header, rows = lepmap
+    out.write(header.encode())
+    for lines in rows:
+        out.write(lines.encode())
+
+def stream_lepmap(out, f_type:str, male:str, female:str, SEX:str, filtered_tsv:str)->None:
+    # writes the LepMap3 data of a filtered table straight to a binary stream
+    progeny = header_progeny(f_type, male, female, filtered_tsv, 2)
+    if f_type == "F1": write_lepmap(out, f1_lepmap(male, female, SEX, filtered_tsv, progeny))
+    else:              write_lepmap(out, f2_lepmap(male, female, filtered_tsv, progeny))
@@ -1,23 +1,200 @@
+import numpy as np
 import os
-import random
+import pandas as pd
 
+from bin.artifact_cache import artifact_key, read_key, store_artifact
+from bin.genotype_store import F2_AA, F2_BB, F2_AB, chunk_rows, iter_chunks
 from bin.get_LA_info import get_LA_info
+from bin.get_prog_info import has_progeny
 
-def marker_reduction(kmer:int, max_markers:int)->None:
+#################################################
+#	Helper functions to reduce the markers of the filtered genotype tables given to LepMap3 (-U/--Max).
+#	Genotype vectors are bit-packed into one bit plane per code bit. Markers with identical vectors share a bin,
+#	and with a distance d, the most frequent vectors lead bins of the vectors differing from them in at most d progeny.
+#	One representative is kept per bin and a membership table records the bin of every marker, so all markers can be placed on the map afterwards.
+#	Bins are only thinned if there are more than the maximum, keeping the largest bins of every segregation class in proportion.
+#################################################
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+NUM_CLASSES = 10   # frequency classes of each segregation type
+MAX_OFFSET = 1024  # patterns of a bucket compared with each pattern, so buckets of uninformative byte groups do not cost quadratic time
+
+def read_packed_table(filtered_tsv:str, num_bits:int)->tuple[pd.DataFrame, np.ndarray, np.ndarray, list]:
+    # marker IDs and sequences, bit-packed genotype vectors (markers x planes x bytes), non-XX/present call counts and progeny of a filtered table
+    progeny = list(pd.read_csv(filtered_tsv, sep='\t', nrows=0).columns[2:])
+    marker_dfs, packed, call_counts = list(), list(), list()
+    for ftsv_df in pd.read_csv(filtered_tsv, sep='\t', dtype={"MarkerID": str, "MarkerSequence": str}, chunksize=chunk_rows(len(progeny))):
+        codes = ftsv_df[progeny].to_numpy(dtype=np.uint8)
+        marker_dfs.append(ftsv_df[["MarkerID", "MarkerSequence"]])
+        packed.append(np.stack([np.packbits((codes >> bit) & 1, axis=1) for bit in range(num_bits)], axis=1))
+        call_counts.append(np.stack([(codes == code).sum(axis=1) for code in range(1, 2 ** num_bits)], axis=1))
+    if not marker_dfs:
+        return pd.DataFrame(columns=["MarkerID", "MarkerSequence"]), np.zeros((0, num_bits, (len(progeny) + 7) // 8), dtype=np.uint8), \
+               np.zeros((0, 2 ** num_bits - 1), dtype=np.int64), progeny
+    return pd.concat(marker_dfs, ignore_index=True), np.concatenate(packed), np.concatenate(call_counts), progeny
+
+def hamming(first:np.ndarray, second:np.ndarray)->np.ndarray:
+    # number of progeny whose codes differ: a progeny differs if any of its bits differ
+    differ = np.bitwise_or.reduce(first ^ second, axis=-2)
+    return POPCOUNT[differ].sum(axis=-1, dtype=np.int64)
+
+def leader_bins(num_patterns:int, first:np.ndarray, second:np.ndarray, rank:np.ndarray)->np.ndarray:
+    # leader clustering of the patterns joined by the edges first[i]-second[i]: in rank order, a pattern not yet in a bin leads a new bin of its unbinned neighbours
+    # (in each round the unbinned patterns outranking all their unbinned neighbours lead, so the result matches taking patterns one by one)
+    src, dst = np.concatenate((first, second)), np.concatenate((second, first))
+    unbinned = np.ones(num_patterns, dtype=bool)
+    leader = np.zeros(num_patterns, dtype=bool)
+    while unbinned.any():
+        outranked = np.zeros(num_patterns, dtype=bool)
+        outranked[src[unbinned[src] & unbinned[dst] & (rank[dst] < rank[src])]] = True
+        leads = unbinned & ~outranked
+        leader |= leads
+        unbinned &= ~leads
+        unbinned[dst[leads[src]]] = False
+
+    # every other pattern joins its best ranked neighbouring leader, which is the leader that took it
+    best = np.where(leader, rank, num_patterns)
+    joins = leader[src] & ~leader[dst]
+    np.minimum.at(best, dst[joins], rank[src[joins]])
+    return np.argsort(rank)[best]
+
+def near_pattern_bins(patterns:np.ndarray, max_distance:int, rank:np.ndarray)->np.ndarray:
+    # bin of every distinct pattern, led by the best ranked pattern within max_distance of all its members
+    # (pigeonhole: split the packed bytes into max_distance + 1 groups, so patterns within max_distance are identical in at least one group)
+    # pairs of a bucket are compared by their offset in the sorted buckets, so each offset is one vectorised pass over all buckets at once
+    # (patterns are sorted, so in buckets larger than MAX_OFFSET + 1 each pattern is only compared with the MAX_OFFSET patterns sorted after it)
+    num_patterns = len(patterns)
+    first, second = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    if max_distance > 0 and num_patterns > 1:
+        byte_groups = np.array_split(np.arange(patterns.shape[-1]), max_distance + 1)
+        for group in byte_groups:
+            keys = np.ascontiguousarray(patterns[:, :, group].reshape(num_patterns, -1))
+            keys = keys.view(np.dtype((np.void, keys.shape[1]))).ravel() if keys.shape[1] else np.zeros(num_patterns, dtype=np.int8)
+            _, bucket, bucket_size = np.unique(keys, return_inverse=True, return_counts=True)
+            bucket = bucket.ravel()
+            order = np.argsort(bucket, kind='stable')
+            # patterns left in their bucket after every sorted position
+            left = bucket_size[bucket[order]] - (np.arange(num_patterns) - np.searchsorted(bucket[order], bucket[order])) - 1
+            active = np.flatnonzero(left > 0)
+            if len(active) and left.max() > MAX_OFFSET:
+                print(f"\tA bucket of {left.max() + 1} genotype patterns is only compared over the next {MAX_OFFSET} patterns of each pattern.")
+            offset = 1
+            while len(active) and offset <= MAX_OFFSET:
+                for start, end in iter_chunks(len(active), patterns[0].size):
+                    pos = active[start:end]
+                    near = hamming(patterns[order[pos]], patterns[order[pos + offset]]) <= max_distance
+                    first.append(order[pos[near]])
+                    second.append(order[pos[near] + offset])
+                offset += 1
+                active = active[left[active] >= offset]
+    leaders = leader_bins(num_patterns, np.concatenate(first), np.concatenate(second), rank)
+    return np.unique(leaders, return_inverse=True)[1].ravel()
+
+def bin_markers(packed:np.ndarray, max_distance:int)->tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # bin and representative marker of every marker, and the Hamming distance to its representative
+    num_markers = len(packed)
+    if not num_markers:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    flat = np.ascontiguousarray(packed.reshape(num_markers, -1))
+    keys = flat.view(np.dtype((np.void, flat.shape[1]))).ravel() if flat.shape[1] else np.zeros(num_markers, dtype=np.int8)
+    _, first_marker, pattern_of, pattern_size = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    pattern_of = pattern_of.ravel()
+    # patterns are ranked by frequency, then by their first marker
+    rank = np.empty(len(first_marker), dtype=np.int64)
+    rank[np.lexsort((first_marker, -pattern_size))] = np.arange(len(first_marker))
+    pattern_bin = near_pattern_bins(packed[first_marker], max_distance, rank)
+
+    # the representative of a bin is the first marker of its most frequent pattern, which is the pattern leading the bin
+    order = np.lexsort((first_marker, -pattern_size, pattern_bin))
+    is_first = np.concatenate(([True], np.diff(pattern_bin[order]) != 0))
+    rep_pattern = np.empty(pattern_bin.max() + 1, dtype=np.int64)
+    rep_pattern[pattern_bin[order][is_first]] = order[is_first]
+
+    # number bins in the order of their representatives
+    bin_rep = first_marker[rep_pattern]
+    bin_order = np.argsort(bin_rep, kind='stable')
+    bin_number = np.empty(len(bin_rep), dtype=np.int64)
+    bin_number[bin_order] = np.arange(len(bin_rep))
+    marker_bin = bin_number[pattern_bin[pattern_of]]
+    representative = bin_rep[pattern_bin[pattern_of]]
+    return marker_bin, representative, hamming(packed, packed[representative])
+
+def segregation_classes(f_type:str, call_counts:np.ndarray, num_progs:int)->np.ndarray:
+    # F1 markers are classed by their frequency of present calls; F2 markers by whether they carry AA, BB and AB calls and their frequency of non-XX calls
+    called = call_counts.sum(axis=1)
+    frequency_class = np.minimum((called * NUM_CLASSES) // max(num_progs, 1), NUM_CLASSES - 1)
+    if f_type == "F1": return frequency_class
+    carries = call_counts[:, [F2_AA - 1, F2_BB - 1, F2_AB - 1]] > 0
+    seg_type = carries[:, 0] * 1 + carries[:, 1] * 2 + carries[:, 2] * 4
+    return seg_type * NUM_CLASSES + frequency_class
+
+def thin_bins(bin_sizes:np.ndarray, bin_classes:np.ndarray, max_markers:int)->np.ndarray:
+    # bins kept when there are more bins than max_markers: every class keeps its share of max_markers (largest remainders first), filled with its largest bins
+    num_bins = len(bin_sizes)
+    if num_bins <= max_markers: return np.ones(num_bins, dtype=bool)
+    classes, class_of, class_sizes = np.unique(bin_classes, return_inverse=True, return_counts=True)
+    class_of = class_of.ravel()
+    shares = max_markers * class_sizes / num_bins
+    quota = np.floor(shares).astype(np.int64)
+    remainder_order = np.lexsort((np.arange(len(classes)), -(shares - quota)))
+    quota[remainder_order[:max_markers - int(quota.sum())]] += 1
+
+    kept = np.zeros(num_bins, dtype=bool)
+    order = np.lexsort((np.arange(num_bins), -bin_sizes, class_of))
+    rank = np.arange(num_bins) - np.searchsorted(class_of[order], class_of[order])
+    kept[order[rank < quota[class_of[order]]]] = True
+    return kept
+
+def reduce_table(f_type:str, filtered_tsv:str, reduced_tsv:str, bins_tsv:str, max_markers:int, max_distance:int)->None:
+    key = artifact_key("marker_reduction", [filtered_tsv], {"Max": max_markers, "distance": max_distance, "binning": "leader"})
+    if all(os.path.exists(path) and read_key(path) == key for path in [reduced_tsv, bins_tsv]):
+        print(f"\tReduced genotype table {reduced_tsv} is up to date. Skipping.")
+        return
+
+    # bin markers by their genotype vectors
+    marker_df, packed, call_counts, progeny = read_packed_table(filtered_tsv, 1 if f_type == "F1" else 2)
+    marker_bin, representative, distance = bin_markers(packed, max_distance)
+    num_bins = int(marker_bin.max()) + 1 if len(marker_bin) else 0
+    print(f"\t{len(marker_df.index)} markers detected in genotype file, forming {num_bins} bins within a distance of {max_distance}.")
+
+    # thin bins only if there are still too many
+    bin_reps = np.unique(representative)
+    bin_kept = thin_bins(np.bincount(marker_bin, minlength=num_bins), segregation_classes(f_type, call_counts[bin_reps], len(progeny)), max_markers)
+    if not bin_kept.all(): print(f"\tThinning to {max_markers} bins, stratified by segregation class...")
+
+    # record the bin of every marker and write the representatives of kept bins
+    marker_ids = marker_df["MarkerID"].to_numpy(dtype=str)
+    pd.DataFrame({"MarkerID": marker_ids, "MarkerSequence": marker_df["MarkerSequence"], "Bin": marker_bin,
+                  "Representative": marker_ids[representative],
+                  "Distance": distance, "Kept": bin_kept[marker_bin].astype(int)}).to_csv(bins_tsv, sep='\t', index=False)
+    keep_rows = np.zeros(len(marker_ids), dtype=bool)
+    keep_rows[bin_reps[bin_kept]] = True
+    header, position = True, 0
+    for ftsv_df in pd.read_csv(filtered_tsv, sep='\t', dtype={"MarkerID": str, "MarkerSequence": str}, chunksize=chunk_rows(len(progeny))):
+        ftsv_df[keep_rows[position:position + len(ftsv_df.index)]].to_csv(reduced_tsv, sep='\t', index=False, header=header, mode='w' if header else 'a')
+        header, position = False, position + len(ftsv_df.index)
+    if header: pd.read_csv(filtered_tsv, sep='\t', nrows=0).to_csv(reduced_tsv, sep='\t', index=False)
+    store_artifact(reduced_tsv, key)
+    store_artifact(bins_tsv, key)
+    print(f"\t{int(keep_rows.sum())} markers written to {reduced_tsv}. Bins of all markers are in {bins_tsv}.")
+
+def marker_reduction(kmer:int, max_markers:int, max_distance:int=0)->None:
     if not os.path.exists("AFLAP_tmp/LA.txt"):
-        raise FileNotFoundError("Error in marker_reduction.py: AFLAP_tmp/LA.txt not found.")
-
-    for G_info in get_LA_info():
-        G, LO, UP, P0 = G_info
-
-        with open(f"AFLAP_tmp/05/{G}_m{kmer}_L{LO}_U{UP}_{P0}.Filtered.Genotypes.MarkerID.tsv", 'r') as ftsv:
-            MARKER_COUNT = len(ftsv.readlines())
-
-        print(f"{MARKER_COUNT} markers detected in genotype file.")
-        if (MARKER_COUNT > max_markers):
-            print(f"Pruning til marker count is {max_markers}...")
-            with open(f"AFLAP_tmp/05/{G}_m{kmer}_L{LO}_U{UP}_{P0}.Filtered.Genotypes.MarkerID.tsv", 'r+') as ftsv:
-                lines = ftsv.readlines()
-                lines = random.sample(lines, k=max_markers)
-                ftsv.seek(0)
-                ftsv.writelines(lines)
+        exit("An error occurred: AFLAP_tmp/LA.txt not found.")
+
+    txt_headers = list()
+    if has_progeny("F1"):
+        for G, LO, UP, P0, SEX in get_LA_info():
+            txt_headers.append(("F1", f"{G}_F1_m{kmer}_L{LO}_U{UP}_{P0}"))
+    if has_progeny("F2"):
+        male = '_'.join(G for G, *_, SEX in get_LA_info() if SEX == "male")
+        female = '_'.join(G for G, *_, SEX in get_LA_info() if SEX != "male")
+        txt_headers.append(("F2", f"{male}x{female}_F2_m{kmer}"))
+
+    for f_type, txt_header in txt_headers:
+        filtered_tsv = f"AFLAP_tmp/05/{txt_header}.Genotypes.MarkerID.Filtered.tsv"
+        if not os.path.exists(filtered_tsv):
+            exit(f"An error occurred: {filtered_tsv} not found. Rerun 05_ObtainSegStats.py.")
+        print(f"Reducing markers of {txt_header}...")
+        reduce_table(f_type, filtered_tsv, f"AFLAP_tmp/05/{txt_header}.Genotypes.MarkerID.Reduced.tsv",
+                     f"AFLAP_Results/{txt_header}.MarkerBins.tsv", max_markers, max_distance)
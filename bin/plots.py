@@ -0,0 +1,42 @@
+import multiprocessing as mp
+import os
+
+#################################################
+#	Helper functions to render plots off the critical path of a stage.
+#	Plot specs (a plotting function and its NumPy arrays) are rendered by a background pool of workers using the Agg backend.
+#	Matplotlib is only imported by a worker when a plot is actually rendered.
+#################################################
+
+def get_pyplot():
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+    return plt
+
+class PlotQueue:
+    def __init__(self, enabled:bool=True, workers:int=2):
+        self.enabled = enabled
+        self.pool = mp.Pool(processes=workers) if enabled else None
+        self.pending = list()
+
+    def submit(self, plot_func, outfile:str, *args)->None:
+        if not self.enabled: return
+        self.pending.append((outfile, self.pool.apply_async(plot_func, args=(*args, outfile))))
+
+    def close(self)->None:
+        if not self.enabled: return
+        self.pool.close()
+
+        # wait for every plot and check it was written
+        failed = list()
+        for outfile, result in self.pending:
+            try:
+                result.get()
+            except Exception as e:
+                print(f"\tPlotting {outfile} failed: {e}")
+            if not os.path.exists(outfile) or not os.path.getsize(outfile):
+                failed.append(outfile)
+        self.pool.join()
+
+        if failed:
+            exit(f"An error occurred: {', '.join(failed)} not created.")
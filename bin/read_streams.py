@@ -0,0 +1,50 @@
+import os
+import shlex
+import shutil
+
+#################################################
+#	Helper functions to decompress read files in parallel for JELLYFISH.
+#	Every read file gets its own decompressor which JELLYFISH runs as a generator stream.
+#################################################
+
+def read_format(path:str)->str:
+    with open(path, 'rb') as f:
+        header = f.read(18)
+    if header.startswith(b'\x1f\x8b'):
+        # BGZF blocks carry a 'BC' subfield in the gzip extra field
+        if len(header) >= 14 and header[3] & 4 and header[12:14] == b'BC': return "bgzf"
+        return "gz"
+    elif header.startswith(b'BZh'):                 return "bz2"
+    elif header.startswith(b'\x28\xb5\x2f\xfd'):    return "zst"
+    return "plain"
+
+def decompress_command(path:str, threads:int=1)->str:
+    fmt = read_format(path)
+    path = shlex.quote(path)
+    if fmt == "bgzf" and shutil.which("bgzip"): return f"bgzip -dc -@ {threads} {path}"
+    elif fmt in ("bgzf", "gz"):
+        if shutil.which("pigz"):                    return f"pigz -dc -p {threads} {path}"
+        return f"gzip -dc {path}"
+    elif fmt == "bz2":
+        if shutil.which("pbzip2"):                  return f"pbzip2 -dc -p{threads} {path}"
+        return f"bzip2 -dc {path}"
+    elif fmt == "zst":                              return f"zstd -dcq -T{threads} {path}"
+    return f"cat {path}"
+
+def write_generators(paths:list[str], gen_file:str, log_file:str, threads:int)->None:
+    # time each decompressor, logging to a file so the read stream itself stays clean
+    dc_threads = max(1, threads // len(paths))
+    with open(gen_file, 'w') as fgen:
+        for i, path in enumerate(paths):
+            fgen.write(f"s=$(date +%s.%N); {decompress_command(path, dc_threads)}; " +
+                       f"echo \"$s $(date +%s.%N) {i}\" >> {shlex.quote(log_file)}\n")
+    if os.path.exists(log_file): os.remove(log_file)
+
+def report_throughput(log_file:str, paths:list[str], ind:str)->None:
+    if not os.path.exists(log_file): return
+    with open(log_file, 'r') as flog:
+        for line in flog:
+            start, end, i = line.strip().split()
+            path = paths[int(i)]
+            elapsed = max(float(end) - float(start), 1e-6)
+            print(f"\t\t{ind}: decompressed {path} at {os.path.getsize(path) / elapsed / 1024 ** 2:.1f} MB/s ({elapsed:.1f}s).")
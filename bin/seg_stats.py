@@ -1,22 +1,17 @@
-import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
 
-def normalize_data(markers:pd.DataFrame)->pd.DataFrame:
-    return markers["Frequency Count"] / markers["Frequency Count"].sum()
+from plots import get_pyplot
 
-def get_datapoints(markers:pd.DataFrame)->tuple[np.ndarray, np.ndarray]:
-    return markers["Frequency"].to_numpy(), markers["Frequency Count"].to_numpy()
+def normalize_data(counts:np.ndarray)->np.ndarray:
+    return counts / counts.sum() if counts.sum() else counts
 
-def get_seg_stats(markers_all:pd.DataFrame, markers_equal:pd.DataFrame, markers_over:pd.DataFrame, ak:int, oufile_name:str)->None:
-    # normalize data
-    markers_all["Frequency Count"]      = normalize_data(markers_all)
-    markers_equal["Frequency Count"]    = normalize_data(markers_equal)
-    markers_over["Frequency Count"]     = normalize_data(markers_over)
+def get_seg_stats(markers_all:tuple, markers_equal:tuple, markers_over:tuple, ak:int, oufile_name:str)->None:
+    plt = get_pyplot()
 
-    x1, y1 = get_datapoints(markers_equal)
-    x2, y2 = get_datapoints(markers_over)
-    x3, y3 = get_datapoints(markers_all)
+    # normalize data (each marker set is a tuple of frequencies and their counts)
+    x1, y1 = markers_equal[0], normalize_data(markers_equal[1])
+    x2, y2 = markers_over[0], normalize_data(markers_over[1])
+    x3, y3 = markers_all[0], normalize_data(markers_all[1])
 
     # plot data
     plt.scatter(x1, y1, c='r', label=f'={ak}')
@@ -30,4 +25,4 @@ def get_seg_stats(markers_all:pd.DataFrame, markers_equal:pd.DataFrame, markers_
 
     # create png
     plt.savefig(oufile_name)
-    plt.clf()
\ No newline at end of file
+    plt.clf()
@@ -0,0 +1,148 @@
+import fnmatch
+import glob
+import json
+import multiprocessing as mp
+import os
+import subprocess
+import time
+
+#################################################
+#	Helper functions to run AFLAP as a graph of per-individual tasks rather than as a sequence of stages.
+#	A task starts as soon as the tasks it depends on have finished and enough threads and memory are free.
+#	Finished tasks are recorded in a state file with the state of the files they read, so an interrupted run resumes where it stopped
+#	and tasks whose inputs have changed since are run again.
+#################################################
+
+POLL_INTERVAL = 0.5
+
+class Task:
+    def __init__(self, name:str, cmd:str=None, deps:list=(), threads:int=1, mem=0, io:int=0, func=None, args:tuple=(), inputs:list=(), params:dict=None):
+        # mem may be a function, evaluated when the task is ready (e.g. from the size of a hash made by a dependency)
+        # io is the number of disk heavy reads the task makes at once, such as loading a progeny hash
+        # inputs are glob patterns of the files the task reads and params the pedigree values it uses, so edits to either rerun the task
+        self.name = name
+        self.cmd = cmd
+        self.deps = list(deps)
+        self.threads = threads
+        self.mem = mem
+        self.io = io
+        self.func = func
+        self.args = args
+        self.inputs = list(inputs)
+        self.params = params
+
+    def signature(self)->dict:
+        return {"cmd": self.cmd if self.cmd is not None else f"{self.func.__name__}{self.args}", "deps": sorted(self.deps),
+                "params": self.params, "inputs": [input_stamp(path) for pattern in self.inputs for path in sorted(glob.glob(pattern)) if not path.endswith(".key")]}
+
+def input_stamp(path:str)->str:
+    # files made through the artifact cache are identified by their recorded key, other files by their size and modification time
+    key_file = f"{path}.key"
+    if os.path.exists(key_file):
+        with open(key_file, 'r') as f:
+            return f"{path}:{f.read().strip()}"
+    stat = os.stat(path)
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def parse_mem(mem:str)->int:
+    # memory sizes such as 512M or 64G in bytes
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    mem = str(mem).strip().upper().removesuffix('B')
+    if mem and mem[-1] in units:
+        return int(float(mem[:-1]) * units[mem[-1]])
+    return int(float(mem))
+
+def physical_mem()->int:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+def read_state(state_file:str)->dict:
+    if not os.path.exists(state_file): return dict()
+    with open(state_file, 'r') as f:
+        return json.load(f)
+
+def write_state(state_file:str, state:dict)->None:
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_file, state_file)
+
+def forget_tasks(state_file:str, patterns:list[str])->None:
+    # tasks matching any of the patterns (e.g. query:*:P01) are run again by the next run
+    state = read_state(state_file)
+    kept = {name: sig for name, sig in state.items() if not any(fnmatch.fnmatch(name, pattern) for pattern in patterns)}
+    if len(kept) != len(state): write_state(state_file, kept)
+
+def start_task(task:Task, log_dir:str):
+    log_file = os.path.join(log_dir, f"{task.name.replace(':', '_')}.log")
+    if task.cmd is not None:
+        with open(log_file, 'w') as flog:
+            return subprocess.Popen(task.cmd, shell=True, stdout=flog, stderr=subprocess.STDOUT, executable="/bin/bash")
+    proc = mp.Process(target=task.func, args=task.args)
+    proc.start()
+    return proc
+
+def task_exitcode(proc)->int:
+    return proc.poll() if isinstance(proc, subprocess.Popen) else proc.exitcode
+
+def run_task_graph(tasks:list, max_threads:int, max_mem:int, state_file:str, log_dir:str, max_io:int=None)->None:
+    by_name = {task.name: task for task in tasks}
+    for task in tasks:
+        for dep in task.deps:
+            if dep not in by_name: exit(f"An error occurred: Task {task.name} depends on unknown task {dep}.")
+    os.makedirs(log_dir, exist_ok=True)
+
+    # tasks finished in a previous run are skipped if their command, pedigree values and input files and all their dependencies are unchanged
+    state = read_state(state_file)
+    done = set()
+    changed = True
+    while changed:
+        changed = False
+        for task in tasks:
+            if task.name not in done and state.get(task.name) == task.signature() and all(dep in done for dep in task.deps):
+                done.add(task.name)
+                changed = True
+    state = {name: sig for name, sig in state.items() if name in done}
+    write_state(state_file, state)
+    if done: print(f"\t{len(done)} of {len(tasks)} tasks completed in a previous run. Resuming.")
+
+    pending = [task for task in tasks if task.name not in done]
+    running = dict()
+    failed = list()
+    used_threads = used_mem = used_io = 0
+    while pending or running:
+        # start ready tasks in order while threads, memory and I/O slots allow (a task larger than the limits runs alone)
+        if not failed:
+            for task in list(pending):
+                if not all(dep in done for dep in task.deps): continue
+                if callable(task.mem): task.mem = task.mem()
+                if running and (used_threads + task.threads > max_threads or used_mem + task.mem > max_mem or
+                                (max_io is not None and task.io and used_io + task.io > max_io)): continue
+                running[task.name] = (start_task(task, log_dir), time.time())
+                used_threads += task.threads
+                used_mem += task.mem
+                used_io += task.io
+                pending.remove(task)
+                print(f"\tStarted {task.name}.")
+        if not running:
+            if failed: break
+            exit(f"An error occurred: Tasks {', '.join(task.name for task in pending)} can never start.")
+
+        time.sleep(POLL_INTERVAL)
+        for name, (proc, start) in list(running.items()):
+            exitcode = task_exitcode(proc)
+            if exitcode is None: continue
+            del running[name]
+            used_threads -= by_name[name].threads
+            used_mem -= by_name[name].mem
+            used_io -= by_name[name].io
+            if exitcode:
+                failed.append(name)
+                print(f"\tTask {name} failed with exit code {exitcode} after {time.time() - start:.1f}s. See {log_dir} for its log.")
+                continue
+            done.add(name)
+            state[name] = by_name[name].signature()
+            write_state(state_file, state)
+            print(f"\t[{len(done)}/{len(tasks)}] {name} finished in {time.time() - start:.1f}s.")
+
+    if failed:
+        exit(f"An error occurred: Tasks {', '.join(failed)} failed. Rerun AFLAP.py to resume from the completed tasks.")
@@ -0,0 +1,135 @@
+import multiprocessing as mp
+import numpy as np
+
+from kmer_set import CODE_BASES, unpack_kmers, reverse_complement, canonical_kmers, kmer_set_union
+
+#################################################
+#	Helper functions to compact a packed k-mer set into the unitigs of its de Bruijn graph, as an alternative to ABySS.
+#	Nodes are the canonical assembly k-mers found in the input k-mers, and each node is used in both orientations (2 * node + strand).
+#	Edges are looked up by binary search in worker processes, and unitigs are the maximal chains of nodes with a single edge between them.
+#	Unlike ABySS, tips are not trimmed and bubbles are not popped.
+#################################################
+
+EDGE_CHUNK = 2 ** 20
+
+nodes = None
+rc_nodes = None
+
+def graph_nodes(packed:np.ndarray, kmer:int, k:int)->np.ndarray:
+    # canonical k-mers of every input kmer-mer, sorted
+    mask = np.uint64((1 << (2 * k)) - 1)
+    node_sets = list()
+    for start in range(0, len(packed), EDGE_CHUNK):
+        chunk = np.asarray(packed[start:(start + EDGE_CHUNK)], dtype=np.uint64)
+        subs = [(chunk >> np.uint64(2 * (kmer - k - i))) & mask for i in range(kmer - k + 1)]
+        node_sets.append(np.unique(canonical_kmers(np.concatenate(subs), k)))
+    return kmer_set_union(node_sets)
+
+def init_edge_worker(shared_nodes:np.ndarray, shared_rc_nodes:np.ndarray)->None:
+    global nodes, rc_nodes
+    nodes, rc_nodes = shared_nodes, shared_rc_nodes
+
+def find_edges(job:tuple)->tuple[np.ndarray, np.ndarray]:
+    # out-degree and single successor of the oriented nodes [start, end)
+    start, end, k = job
+    mask = np.uint64((1 << (2 * k)) - 1)
+    oriented = np.empty(2 * (end - start), dtype=np.uint64)
+    oriented[0::2] = nodes[start:end]
+    oriented[1::2] = rc_nodes[start:end]
+
+    out_degree = np.zeros(len(oriented), dtype=np.int8)
+    successor = np.full(len(oriented), -1, dtype=np.int64)
+    for base in range(4):
+        nxt = ((oriented << np.uint64(2)) | np.uint64(base)) & mask
+        rc_nxt = reverse_complement(nxt, k)
+        canonical = np.minimum(nxt, rc_nxt)
+        idx = np.minimum(np.searchsorted(nodes, canonical), len(nodes) - 1)
+        found = nodes[idx] == canonical
+        out_degree += found
+        successor[found] = 2 * idx[found] + (nxt[found] != nodes[idx[found]])
+    successor[out_degree != 1] = -1
+    return out_degree, successor
+
+def chain_nodes(nxt:np.ndarray)->tuple[np.ndarray, np.ndarray]:
+    # assigns every oriented node a chain and its rank within the chain
+    num = len(nxt)
+    chain = np.full(num, -1, dtype=np.int64)
+    rank = np.zeros(num, dtype=np.int64)
+    has_prev = np.zeros(num, dtype=bool)
+    has_prev[nxt[nxt >= 0]] = True
+
+    # walk all linear chains at once from their heads
+    cur = np.flatnonzero(~has_prev)
+    ids = np.arange(len(cur))
+    step = 0
+    while len(cur):
+        chain[cur] = ids
+        rank[cur] = step
+        cur = nxt[cur]
+        keep = cur >= 0
+        cur, ids = cur[keep], ids[keep]
+        step += 1
+
+    # remaining nodes lie on cycles, which are opened at their smallest node
+    # (the reverse cycle is opened at the reverse of the tail, so both orientations have mirrored heads and tails)
+    num_chains = int(chain.max()) + 1 if num else 0
+    for head in np.flatnonzero(chain < 0):
+        while head >= 0 and chain[head] < 0:
+            node, step = head, 0
+            while chain[node] < 0:
+                chain[node] = num_chains
+                rank[node] = step
+                tail, node, step = node, nxt[node], step + 1
+            num_chains += 1
+            head = tail ^ 1
+    return chain, rank
+
+def compact_unitigs(packed:np.ndarray, kmer:int, k:int, unitig_file:str, threads:int=1)->int:
+    global nodes, rc_nodes
+    nodes = graph_nodes(packed, kmer, k)
+    rc_nodes = reverse_complement(nodes, k)
+    if not len(nodes):
+        open(unitig_file, 'w').close()
+        return 0
+
+    # find edges between oriented nodes in parallel
+    jobs = [(start, min(start + EDGE_CHUNK, len(nodes)), k) for start in range(0, len(nodes), EDGE_CHUNK)]
+    if threads > 1 and len(jobs) > 1:
+        with mp.Pool(processes=min(threads, len(jobs)), initializer=init_edge_worker, initargs=(nodes, rc_nodes)) as pool:
+            results = pool.map(find_edges, jobs)
+    else:
+        results = [find_edges(job) for job in jobs]
+    out_degree = np.concatenate([result[0] for result in results])
+    successor = np.concatenate([result[1] for result in results])
+
+    # an edge is followed when it is the only edge out of a node and the only edge into the next node
+    # (the in-degree of an oriented node is the out-degree of its reverse complement)
+    oriented = np.arange(len(successor))
+    nxt = successor.copy()
+    has_next = nxt >= 0
+    has_next[has_next] = (out_degree[nxt[has_next] ^ 1] == 1) & (nxt[has_next] != oriented[has_next]) & \
+                         (nxt[has_next] != (oriented[has_next] ^ 1))
+    nxt[~has_next] = -1
+    chain, rank = chain_nodes(nxt)
+
+    # every unitig is found in both orientations; keep the one whose head is smaller than the reverse of its tail
+    order = np.lexsort((rank, chain))
+    bounds = np.flatnonzero(np.diff(chain[order])) + 1
+    heads = order[np.concatenate(([0], bounds))]
+    tails = order[np.concatenate((bounds - 1, [len(order) - 1]))]
+    keep_chain = heads <= (tails ^ 1)
+
+    # the sequence of a unitig is its head k-mer followed by the last base of every following node
+    oriented_seqs = np.empty(len(oriented), dtype=np.uint64)
+    oriented_seqs[0::2] = nodes
+    oriented_seqs[1::2] = rc_nodes
+    last_bases = CODE_BASES[(oriented_seqs[order] & np.uint64(3)).astype(np.uint8)].tobytes().decode()
+    head_seqs = unpack_kmers(oriented_seqs[heads[keep_chain]], k)
+    starts = np.concatenate(([0], bounds))[keep_chain]
+    ends = np.concatenate((bounds, [len(order)]))[keep_chain]
+
+    with open(unitig_file, 'w') as funi:
+        for unitig_id, (head_seq, start, end) in enumerate(zip(head_seqs, starts, ends)):
+            seq = head_seq + last_bases[(start + 1):end]
+            funi.write(f">{unitig_id} {len(seq)}\n{seq}\n")
+    return len(head_seqs)
@@ -1,6 +1,9 @@
 import glob
 import pandas as pd
 import os
+import shutil
+
+from bin.task_graph import forget_tasks
 
 def remove_files(paths:list[str], parent_path:str)->None:
     tmpfiles = list()
@@ -9,7 +12,13 @@ def remove_files(paths:list[str], parent_path:str)->None:
     if not tmpfiles:
         print(f"WARNING: No files have been removed from {parent_path}.")
     for tmpf in tmpfiles:
-        os.remove(tmpf)
+        if os.path.isdir(tmpf): shutil.rmtree(tmpf)
+        else:                   os.remove(tmpf)
+
+def forget_individual(patterns:list[str])->None:
+    # the graph executor reruns these tasks instead of trusting its record of them
+    for state_file in ["AFLAP_tmp/TaskState.json", "AFLAP_tmp/TaskState.sweep.json"]:
+        forget_tasks(state_file, patterns)
 
 def update_individual(rem_ind:str, pedigree:str)->None:
     # identify the individual to be removed
@@ -31,18 +40,24 @@ def update_individual(rem_ind:str, pedigree:str)->None:
             # remove 02 files
             remove_files([f"AFLAP_tmp/02/{rem_ind}*", f"AFLAP_tmp/02/F0Histo/{rem_ind}*"], "AFLAP_tmp/02")
             # remove 03 files
-            remove_files([f"AFLAP_tmp/03/{rem_ind}*", f"AFLAP_tmp/03/F0Markers/{rem_ind}*", f"AFLAP_tmp/03/ReportLogs/{rem_ind}*", f"AFLAP_tmp/03/SimGroups/*_{rem_ind}_*", "AFLAP_tmp/03/SimGroups/identical_loci.txt"], "AFLAP_tmp/03")
+            remove_files([f"AFLAP_tmp/03/{rem_ind}*", f"AFLAP_tmp/03/F0Markers/{rem_ind}*", f"AFLAP_tmp/03/ReportLogs/{rem_ind}*", f"AFLAP_tmp/03/Presence/{rem_ind}_*", f"AFLAP_tmp/03/SimGroups/*_{rem_ind}_*", "AFLAP_tmp/03/SimGroups/identical_loci.txt"], "AFLAP_tmp/03")
             # remove 04 files
-            remove_files([f"AFLAP_tmp/04/{rem_ind}*", f"AFLAP_tmp/04/*/Call/*_{rem_ind}_*", f"AFLAP_tmp/*/04/Count/*_{rem_ind}_*"], "AFLAP_tmp/04")
+            remove_files([f"AFLAP_tmp/04/{rem_ind}*", f"AFLAP_tmp/04/*/{rem_ind}_*.store", f"AFLAP_tmp/04/*/Count/*_{rem_ind}_*"], "AFLAP_tmp/04")
             # remove 05 files
             remove_files([f"AFLAP_tmp/05/*{rem_ind}*"], "AFLAP_tmp/05")
+            # rerun every task after the count of the parent
+            forget_individual([f"count:{rem_ind}", "dump:*", "presence", "markers:*", "loci", "query:*", "table:*", "sweep", "stats", "reduce", "export", "lepmap3"])
         case 1: # FIX
             # remove jellyfish count
             remove_files([f"AFLAP_tmp/01/F1Count/{rem_ind}*"], "AFLAP_tmp/01")
-            # remove count and call
-            remove_files([f"AFLAP_tmp/04/Call/{rem_ind}*", f"AFLAP_tmp/04/Count/{rem_ind}*"], "AFLAP_tmp/04")
+            # remove marker counts (genotype stores drop the progeny when they are next updated)
+            remove_files([f"AFLAP_tmp/04/F1/Count/{rem_ind}_*"], "AFLAP_tmp/04")
+            # rerun the tasks of the progeny and every task after its genotype tables
+            forget_individual([f"count:{rem_ind}", f"query:F1:{rem_ind}", "table:F1:*", "sweep", "stats", "reduce", "export", "lepmap3"])
         case 2: # FIX
             # remove jellyfish count
             remove_files([f"AFLAP_tmp/01/F2Count/{rem_ind}*"], "AFLAP_tmp/01")
-            # remove count and call
-            remove_files([f"AFLAP_tmp/04/Call/{rem_ind}*", f"AFLAP_tmp/04/Count/{rem_ind}*"], "AFLAP_tmp/04")
\ No newline at end of file
+            # remove marker counts (genotype stores drop the progeny when they are next updated)
+            remove_files([f"AFLAP_tmp/04/F2/Count/{rem_ind}_*"], "AFLAP_tmp/04")
+            # rerun the tasks of the progeny and every task after its genotype tables
+            forget_individual([f"count:{rem_ind}", f"query:F2:{rem_ind}", "table:F2:*", "sweep", "stats", "reduce", "export", "lepmap3"])